@@ -1,44 +1,51 @@
+import argparse
 import io
+import json
 import logging
+import os
 import socketserver
+from collections import OrderedDict
 from http import server
-from threading import Condition
+from threading import Condition, Lock, Thread
 from picamera2 import Picamera2
 from picamera2.encoders import JpegEncoder
 from picamera2.outputs import FileOutput
-from Cryptodome.Cipher import AES, PKCS1_OAEP
-from Cryptodome.PublicKey import RSA
+from Cryptodome.Cipher import AES
+from Cryptodome.Hash import SHA256
+from Cryptodome.Protocol.DH import key_agreement
+from Cryptodome.Protocol.KDF import HKDF
+from Cryptodome.PublicKey import ECC, RSA
 from Cryptodome.Random import get_random_bytes
+from Cryptodome.Signature import pkcs1_15
+from Cryptodome.Util.Padding import pad
 import base64
+import struct
 import time
+from urllib.parse import parse_qs, urlsplit
 
-# Generate RSA keys
-RSA_KEY = RSA.generate(2048)
-PUBLIC_KEY = RSA_KEY.publickey()
-
-# Diffie-Hellman Parameters
-DH_PRIME = 0xFFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD1
-DH_GENERATOR = 2
+# Stream key shared by every viewer, handed out per client through /handshake
+KEY = get_random_bytes(32)
+IV = get_random_bytes(16)   # AES requires 16 bytes IV
 
-# Generate Diffie-Hellman private and public keys
-private_key = get_random_bytes(32)
-public_key = pow(DH_GENERATOR, int.from_bytes(private_key, byteorder='big'), DH_PRIME)
+# Frame cipher: 'ctr' and 'gcm' use a fresh nonce per frame, need no padding and are
+# decrypted by WebCrypto in the browser. 'cbc' is the original fixed-IV PKCS7 path.
+AES_MODE = 'gcm'
 
-# Encrypt the Diffie-Hellman public key using RSA public key
-rsa_cipher = PKCS1_OAEP.new(PUBLIC_KEY)
-ENCRYPTED_PUBLIC_KEY = rsa_cipher.encrypt(public_key.to_bytes((public_key.bit_length() + 7) // 8, byteorder='big'))
+# Long-term RSA identity that signs every handshake. Created on first use and kept
+# on disk, so server start never waits for a 2048-bit key generation.
+IDENTITY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stream_identity.pem')
 
-# Placeholder: Receive the peer's encrypted public key and decrypt it
-peer_encrypted_public_key = ENCRYPTED_PUBLIC_KEY  # In practice, this would come from the peer
-peer_public_key_bytes = PKCS1_OAEP.new(RSA_KEY).decrypt(peer_encrypted_public_key)
-peer_public_key = int.from_bytes(peer_public_key_bytes, byteorder='big')
+# Resumption tickets: a reconnecting browser gets the stream key back in one round trip
+TICKET_LIFETIME = 3600  # seconds
+TICKET_CACHE_SIZE = 256
 
-# Calculate shared secret
-shared_secret = pow(peer_public_key, int.from_bytes(private_key, byteorder='big'), DH_PRIME)
+# Embed the stream key in the page for plain-http viewers without WebCrypto (insecure)
+EMBED_KEY = False
+HANDSHAKE_INFO = b'cryptostream handshake v1'
 
-# Derive AES key from shared secret
-KEY = shared_secret.to_bytes(32, byteorder='big')[:32]
-IV = get_random_bytes(16)   # AES requires 16 bytes IV
+# Plaintext copy sent next to the ciphertext: every frame (1), every Nth frame as a
+# thumbnail (N) or never (0). Viewers override it with ?original=0 or ?original_every=N.
+ORIGINAL_EVERY = 1
 
 PAGE = """
 <html>
@@ -79,9 +86,14 @@ PAGE = """
 
     <script src="https://cdnjs.cloudflare.com/ajax/libs/crypto-js/4.1.1/crypto-js.min.js"></script>
     <script>
-        // Convert base64 key and IV to WordArray for CryptoJS
-        const key = CryptoJS.enc.Base64.parse('{key}');
+        // The stream key arrives through /handshake unless the server embeds it
+        let keyBytes = Uint8Array.from(atob('{key}'), c => c.charCodeAt(0));
+        let key = CryptoJS.lib.WordArray.create(keyBytes);
         const iv = CryptoJS.enc.Base64.parse('{iv}');
+        const aesMode = '{mode}';
+        // crypto.subtle only exists in secure contexts (https or localhost)
+        const hasWebCrypto = Boolean(window.crypto && window.crypto.subtle);
+        let webCryptoKey = null;
         
         // Add performance metrics tracking
         const metrics = {{
@@ -105,36 +117,169 @@ PAGE = """
             metrics.lastUpdate = Date.now();
         }}
 
-        // Measure key exchange time
-        metrics.keyExchangeTime = performance.now();
+        function bytesToBase64(bytes) {{
+            return btoa(String.fromCharCode(...bytes));
+        }}
+
+        function concatBytes(...parts) {{
+            const result = new Uint8Array(parts.reduce((total, part) => total + part.length, 0));
+            let offset = 0;
+            for (const part of parts) {{
+                result.set(part, offset);
+                offset += part.length;
+            }}
+            return result;
+        }}
+
+        async function postHandshake(body) {{
+            return fetch('/handshake', {{
+                method: 'POST',
+                headers: {{ 'Content-Type': 'application/json' }},
+                body: JSON.stringify(body)
+            }});
+        }}
+
+        async function unwrapStreamKey(sessionKey, reply) {{
+            const wrappingKey = await crypto.subtle.importKey('raw', sessionKey, {{ name: 'AES-GCM' }}, false, ['decrypt']);
+            return new Uint8Array(await crypto.subtle.decrypt(
+                {{ name: 'AES-GCM', iv: base64ToBytes(reply.wrap_nonce) }},
+                wrappingKey,
+                base64ToBytes(reply.wrapped_key)));
+        }}
+
+        async function fullHandshake() {{
+            const pair = await crypto.subtle.generateKey({{ name: 'X25519' }}, true, ['deriveBits']);
+            const clientPublic = new Uint8Array(await crypto.subtle.exportKey('raw', pair.publicKey));
+            const response = await postHandshake({{ public_key: bytesToBase64(clientPublic) }});
+            if (!response.ok) throw new Error('Handshake rejected');
+            const reply = await response.json();
+
+            // The server's RSA identity signs both public keys and the wrapped stream key
+            const serverPublic = base64ToBytes(reply.server_public_key);
+            const identity = await crypto.subtle.importKey(
+                'spki', base64ToBytes(reply.identity),
+                {{ name: 'RSASSA-PKCS1-v1_5', hash: 'SHA-256' }}, false, ['verify']);
+            const transcript = concatBytes(clientPublic, serverPublic, base64ToBytes(reply.wrapped_key));
+            if (!await crypto.subtle.verify('RSASSA-PKCS1-v1_5', identity, base64ToBytes(reply.signature), transcript)) {{
+                throw new Error('Handshake signature does not verify');
+            }}
+            // Trust on first use: warn when the server identity changes
+            const pinned = localStorage.getItem('streamIdentity');
+            if (pinned && pinned !== reply.identity) {{
+                console.warn('Server identity changed since the last visit');
+            }}
+            localStorage.setItem('streamIdentity', reply.identity);
+
+            const peer = await crypto.subtle.importKey('raw', serverPublic, {{ name: 'X25519' }}, false, []);
+            const shared = await crypto.subtle.deriveBits({{ name: 'X25519', public: peer }}, pair.privateKey, 256);
+            const hkdfKey = await crypto.subtle.importKey('raw', shared, 'HKDF', false, ['deriveBits']);
+            const sessionKey = new Uint8Array(await crypto.subtle.deriveBits({{
+                name: 'HKDF',
+                hash: 'SHA-256',
+                salt: concatBytes(clientPublic, serverPublic),
+                info: new TextEncoder().encode('{handshake_info}')
+            }}, hkdfKey, 256));
+
+            sessionStorage.setItem('streamTicket', JSON.stringify({{
+                ticket: reply.ticket,
+                sessionKey: bytesToBase64(sessionKey)
+            }}));
+            return unwrapStreamKey(sessionKey, reply);
+        }}
+
+        async function resumeHandshake() {{
+            const saved = sessionStorage.getItem('streamTicket');
+            if (!saved) return null;
+            const {{ ticket, sessionKey }} = JSON.parse(saved);
+            const response = await postHandshake({{ ticket: ticket }});
+            if (!response.ok) {{
+                sessionStorage.removeItem('streamTicket');
+                return null;
+            }}
+            return unwrapStreamKey(base64ToBytes(sessionKey), await response.json());
+        }}
+
+        async function keyExchange() {{
+            const startTime = performance.now();
+            if (keyBytes.length === 0) {{
+                if (!hasWebCrypto) {{
+                    throw new Error('Key exchange needs WebCrypto, open the page over https or on localhost');
+                }}
+                keyBytes = (await resumeHandshake()) || (await fullHandshake());
+                key = CryptoJS.lib.WordArray.create(keyBytes);
+                webCryptoKey = null;
+            }}
+            metrics.keyExchangeTime = performance.now() - startTime;
+        }}
+
+        function base64ToBytes(data) {{
+            const binary = atob(data);
+            const bytes = new Uint8Array(binary.length);
+            for (let i = 0; i < binary.length; i++) {{
+                bytes[i] = binary.charCodeAt(i);
+            }}
+            return bytes;
+        }}
+
+        // Convert WordArray to Uint8Array
+        function wordArrayToBytes(wordArray) {{
+            const bytes = new Uint8Array(wordArray.sigBytes);
+            const words = wordArray.words;
+            let i = 0;
+            for (let w = 0; w < words.length && i < bytes.length; w++) {{
+                const word = words[w];
+                bytes[i++] = (word >> 24) & 0xff;
+                if (i < bytes.length) bytes[i++] = (word >> 16) & 0xff;
+                if (i < bytes.length) bytes[i++] = (word >> 8) & 0xff;
+                if (i < bytes.length) bytes[i++] = word & 0xff;
+            }}
+            return bytes;
+        }}
+
+        // AES-CTR counter block: 8-byte frame nonce followed by a 64-bit block counter from 0
+        function ctrCounterBlock(nonce) {{
+            const counter = new Uint8Array(16);
+            counter.set(nonce);
+            return counter;
+        }}
+
+        function decryptCryptoJS(encryptedData, nonce) {{
+            const ciphertext = CryptoJS.enc.Base64.parse(encryptedData);
+            let options;
+            if (aesMode === 'cbc') {{
+                options = {{ iv: iv, mode: CryptoJS.mode.CBC, padding: CryptoJS.pad.Pkcs7 }};
+            }} else if (aesMode === 'ctr') {{
+                options = {{
+                    iv: CryptoJS.lib.WordArray.create(ctrCounterBlock(nonce)),
+                    mode: CryptoJS.mode.CTR,
+                    padding: CryptoJS.pad.NoPadding
+                }};
+            }} else {{
+                throw new Error('AES-GCM needs WebCrypto, open the page over https or on localhost');
+            }}
+            return wordArrayToBytes(CryptoJS.AES.decrypt({{ ciphertext: ciphertext }}, key, options));
+        }}
+
+        async function decryptWebCrypto(encryptedData, nonce) {{
+            const algorithm = aesMode === 'gcm' ? 'AES-GCM' : 'AES-CTR';
+            if (!webCryptoKey) {{
+                webCryptoKey = crypto.subtle.importKey('raw', keyBytes, {{ name: algorithm }}, false, ['decrypt']);
+            }}
+            const params = aesMode === 'gcm'
+                ? {{ name: 'AES-GCM', iv: nonce }}
+                : {{ name: 'AES-CTR', counter: ctrCounterBlock(nonce), length: 64 }};
+            // GCM ciphertext carries its 16-byte tag at the end, as WebCrypto expects
+            return new Uint8Array(await crypto.subtle.decrypt(params, await webCryptoKey, base64ToBytes(encryptedData)));
+        }}
 
-        async function decryptFrame(encryptedData) {{
+        async function decryptFrame(encryptedData, nonceData) {{
             try {{
                 const startTime = performance.now();
                 
-                // Decrypt using AES
-                const ciphertext = CryptoJS.enc.Base64.parse(encryptedData);
-                const decryptedWA = CryptoJS.AES.decrypt(
-                    {{ ciphertext: ciphertext }},
-                    key,
-                    {{
-                        iv: iv,
-                        mode: CryptoJS.mode.CBC,
-                        padding: CryptoJS.pad.Pkcs7
-                    }}
-                );
-                
-                // Convert WordArray to Uint8Array
-                const decrypted = new Uint8Array(decryptedWA.sigBytes);
-                const words = decryptedWA.words;
-                let i = 0;
-                for (let w = 0; w < words.length && i < decrypted.length; w++) {{
-                    const word = words[w];
-                    decrypted[i++] = (word >> 24) & 0xff;
-                    if (i < decrypted.length) decrypted[i++] = (word >> 16) & 0xff;
-                    if (i < decrypted.length) decrypted[i++] = (word >> 8) & 0xff;
-                    if (i < decrypted.length) decrypted[i++] = word & 0xff;
-                }}
+                const nonce = nonceData ? base64ToBytes(nonceData) : null;
+                const decrypted = (aesMode !== 'cbc' && hasWebCrypto)
+                    ? await decryptWebCrypto(encryptedData, nonce)
+                    : decryptCryptoJS(encryptedData, nonce);
                 
                 const blob = new Blob([decrypted], {{type: 'image/jpeg'}});
                 const blobUrl = URL.createObjectURL(blob);
@@ -158,20 +303,28 @@ PAGE = """
 
         async function updateImages(originalImg, decryptedImg, data) {{
             const parts = data.split('|');
-            if (parts.length !== 3) {{
+            if (parts.length !== 3 && parts.length !== 4) {{
                 console.error('Invalid frame data format');
                 return;
             }}
             const encryptedData = parts[0];
             const originalData = parts[1];
             const encryptionTime = parseFloat(parts[2]);
+            // Per-frame nonce for CTR and GCM, empty for CBC
+            const nonceData = parts.length === 4 ? parts[3] : '';
 
             metrics.encryptionTime = encryptionTime;
             metrics.avgEncryptionTime = ((metrics.avgEncryptionTime * (metrics.totalFrames)) + metrics.encryptionTime) / (metrics.totalFrames + 1);
 
-            updateOriginalStream(originalImg, originalData);
+            // Encrypted-only frames leave the original field empty
+            if (originalData) {{
+                updateOriginalStream(originalImg, originalData);
+            }}
             try {{
-                const decryptedUrl = await decryptFrame(encryptedData);
+                const decryptedUrl = await decryptFrame(encryptedData, nonceData);
+                if (decryptedImg.src.startsWith('blob:')) {{
+                    URL.revokeObjectURL(decryptedImg.src);
+                }}
                 decryptedImg.src = decryptedUrl;
             }} catch (error) {{
                 console.error('Failed to update decrypted image:', error);
@@ -180,7 +333,7 @@ PAGE = """
     </script>
 </head>
 <body>
-    <h1>Raspberry Pi Camera Live Stream using RSA and AES</h1>
+    <h1>Raspberry Pi Camera Live Stream using RSA and AES-{mode_name}</h1>
     <div class="metrics">
         <h3>Performance Metrics</h3>
         <div class="metric-item">
@@ -224,60 +377,218 @@ PAGE = """
     </div>
     <div id="status">Connecting...</div>
     <script>
-        const eventSource = new EventSource('/stream');
+        // Pass ?original=0 / ?original_every=N on to the stream
+        const pageParams = new URLSearchParams(window.location.search);
+        const streamParams = new URLSearchParams();
+        ['original', 'original_every'].forEach(name => {{
+            if (pageParams.has(name)) streamParams.set(name, pageParams.get(name));
+        }});
+        const streamQuery = streamParams.toString() ? '?' + streamParams.toString() : '';
         const originalImg = document.getElementById('original-stream');
         const decryptedImg = document.getElementById('decrypted-stream');
         const status = document.getElementById('status');
-        
-        eventSource.onopen = function() {{
-            metrics.keyExchangeTime = performance.now() - metrics.keyExchangeTime;
-            updateMetrics();
-            status.textContent = 'Connected';
-        }};
-        
-        eventSource.onerror = function() {{
-            status.textContent = 'Connection error';
-        }};
-        
-        eventSource.onmessage = function(event) {{
-            status.textContent = 'Streaming...';
-            updateImages(originalImg, decryptedImg, event.data);
-        }};
+
+        function startStream() {{
+            const eventSource = new EventSource('/stream' + streamQuery);
+
+            eventSource.onopen = function() {{
+                updateMetrics();
+                status.textContent = 'Connected';
+            }};
+            
+            eventSource.onerror = function() {{
+                status.textContent = 'Connection error';
+            }};
+            
+            eventSource.onmessage = function(event) {{
+                status.textContent = 'Streaming...';
+                updateImages(originalImg, decryptedImg, event.data);
+            }};
+        }}
+
+        status.textContent = 'Exchanging keys...';
+        keyExchange().then(startStream).catch(error => {{
+            console.error('Key exchange failed:', error);
+            status.textContent = error.message;
+        }});
     </script>
 </body>
 </html>
 """
 
+_identity = None
+_identity_lock = Lock()
+
+def get_identity():
+    # Loaded from IDENTITY_FILE, or generated once and written there
+    global _identity
+    with _identity_lock:
+        if _identity is None:
+            if os.path.exists(IDENTITY_FILE):
+                with open(IDENTITY_FILE, 'rb') as f:
+                    _identity = RSA.import_key(f.read())
+            else:
+                _identity = RSA.generate(2048)
+                fd = os.open(IDENTITY_FILE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(_identity.export_key())
+        return _identity
+
+class TicketCache:
+    # Session keys by ticket, expiring after TICKET_LIFETIME, least recently used dropped first
+    def __init__(self, lifetime=TICKET_LIFETIME, size=TICKET_CACHE_SIZE):
+        self.lifetime = lifetime
+        self.size = size
+        self.tickets = OrderedDict()
+        self.lock = Lock()
+
+    def issue(self, session_key):
+        ticket = get_random_bytes(16)
+        with self.lock:
+            self.tickets[ticket] = (session_key, time.monotonic() + self.lifetime)
+            while len(self.tickets) > self.size:
+                self.tickets.popitem(last=False)
+        return ticket
+
+    def resume(self, ticket):
+        with self.lock:
+            entry = self.tickets.get(ticket)
+            if entry is None:
+                return None
+            session_key, expires = entry
+            if expires < time.monotonic():
+                del self.tickets[ticket]
+                return None
+            self.tickets.move_to_end(ticket)
+            return session_key
+
+tickets = TicketCache()
+
+def wrap_stream_key(session_key):
+    nonce = get_random_bytes(12)
+    cipher = AES.new(session_key, AES.MODE_GCM, nonce=nonce)
+    wrapped, tag = cipher.encrypt_and_digest(KEY)
+    return nonce, wrapped + tag
+
+def full_handshake(client_public):
+    # Ephemeral X25519 per client, HKDF over the shared secret bound to both public keys
+    if len(client_public) != 32:
+        raise ValueError('X25519 public keys are 32 bytes')
+    client_key = ECC.construct(curve='Curve25519',
+                               point_x=int.from_bytes(client_public, 'little') & ((1 << 255) - 1))
+    server_key = ECC.generate(curve='Curve25519')
+    server_public = int(server_key.pointQ.x).to_bytes(32, 'little')
+    session_key = key_agreement(
+        eph_priv=server_key,
+        eph_pub=client_key,
+        kdf=lambda z: HKDF(z, 32, client_public + server_public, SHA256, context=HANDSHAKE_INFO))
+
+    nonce, wrapped = wrap_stream_key(session_key)
+    identity = get_identity()
+    signature = pkcs1_15.new(identity).sign(SHA256.new(client_public + server_public + wrapped))
+    return {
+        'server_public_key': base64.b64encode(server_public).decode('utf-8'),
+        'identity': base64.b64encode(identity.publickey().export_key(format='DER')).decode('utf-8'),
+        'signature': base64.b64encode(signature).decode('utf-8'),
+        'wrap_nonce': base64.b64encode(nonce).decode('utf-8'),
+        'wrapped_key': base64.b64encode(wrapped).decode('utf-8'),
+        'ticket': base64.b64encode(tickets.issue(session_key)).decode('utf-8'),
+        'ticket_lifetime': TICKET_LIFETIME
+    }
+
+def resume_handshake(ticket):
+    session_key = tickets.resume(ticket)
+    if session_key is None:
+        return None
+    nonce, wrapped = wrap_stream_key(session_key)
+    return {
+        'wrap_nonce': base64.b64encode(nonce).decode('utf-8'),
+        'wrapped_key': base64.b64encode(wrapped).decode('utf-8')
+    }
+
+def original_every_from_query(query):
+    # ?original=0 turns the plaintext copy off, ?original_every=N sends it every Nth frame
+    params = parse_qs(query)
+    try:
+        if 'original_every' in params:
+            return max(0, int(params['original_every'][0]))
+        if 'original' in params:
+            return (ORIGINAL_EVERY or 1) if params['original'][0] not in ('0', 'false', 'no') else 0
+    except ValueError:
+        pass
+    return ORIGINAL_EVERY
+
+def includes_original(original_every, sequence):
+    return original_every > 0 and sequence % original_every == 0
+
 class StreamingOutput(io.BufferedIOBase):
     def __init__(self):
         self.frame = None
         self.original_frame = None
+        self.sequence = 0
+        self.nonce = b''
+        self.nonce_prefix = get_random_bytes(4)
+        # Ciphertext (+ GCM tag) buffer reused across frames, grown when a frame is larger
+        self.out = bytearray()
         self.condition = Condition()
         self.encryption_time = 0
+        # Viewer count per original_every setting, the original is only encoded when wanted
+        self.original_viewers = {}
         self._setup_cipher()
 
     def _setup_cipher(self):
         self.cipher = AES.new(KEY, AES.MODE_CBC, IV)
 
+    def _frame_cipher(self):
+        # Nonces are a random prefix plus the frame counter, so none repeats under KEY
+        if AES_MODE == 'ctr':
+            frame = self.sequence & 0xFFFFFFFF
+            if frame == 0:
+                self.nonce_prefix = get_random_bytes(4)
+            # 8-byte nonce, the remaining 64 bits of the counter block count AES blocks
+            self.nonce = self.nonce_prefix + struct.pack('>I', frame)
+            return AES.new(KEY, AES.MODE_CTR, nonce=self.nonce)
+        self.nonce = self.nonce_prefix + struct.pack('>Q', self.sequence)
+        return AES.new(KEY, AES.MODE_GCM, nonce=self.nonce)
+
+    def _encrypt_frame(self, buf):
+        # Encrypt straight from the encoder buffer into the preallocated output
+        cipher = self._frame_cipher()
+        length = len(buf)
+        needed = length + 16 if AES_MODE == 'gcm' else length
+        if len(self.out) < needed:
+            self.out = bytearray(needed + needed // 4)
+        out = memoryview(self.out)[:needed]
+        cipher.encrypt(buf, output=out[:length])
+        if AES_MODE == 'gcm':
+            out[length:] = cipher.digest()
+        return out
+
     def write(self, buf):
         with self.condition:
             try:
-                # Add PKCS7 padding
-                padding_length = 16 - (len(buf) % 16)
-                padded_data = buf + bytes([padding_length] * padding_length)
-                
+                self.sequence += 1
                 # Measure encryption time
                 start_time = time.perf_counter()
-                encrypted_frame = self.cipher.encrypt(padded_data)
+                if AES_MODE == 'cbc':
+                    encrypted_frame = self.cipher.encrypt(pad(buf, AES.block_size))
+                else:
+                    encrypted_frame = self._encrypt_frame(buf)
                 self.encryption_time = (time.perf_counter() - start_time) * 1000  # Convert to milliseconds
                 
+                # Encoded right away, the output buffer is reused by the next frame
                 self.frame = base64.b64encode(encrypted_frame)
-                self.original_frame = base64.b64encode(buf)
+                if any(includes_original(every, self.sequence)
+                       for every, viewers in self.original_viewers.items() if viewers):
+                    self.original_frame = base64.b64encode(buf)
+                else:
+                    self.original_frame = b''
                 self.condition.notify_all()
             except Exception as e:
                 logging.error(f"Encryption error: {str(e)}")
             finally:
-                self._setup_cipher()
+                if AES_MODE == 'cbc':
+                    self._setup_cipher()
         return len(buf)
 
 class StreamingHandler(server.BaseHTTPRequestHandler):
@@ -286,37 +597,52 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
         super().__init__(*args, **kwargs)
 
     def do_GET(self):
-        if self.path == '/':
+        url = urlsplit(self.path)
+        if url.path == '/':
             self.send_response(301)
             self.send_header('Location', '/index.html')
             self.end_headers()
-        elif self.path == '/index.html':
+        elif url.path == '/index.html':
             content = PAGE.format(
-                key=base64.b64encode(KEY).decode('utf-8'),
-                iv=base64.b64encode(IV).decode('utf-8')
+                key=base64.b64encode(KEY).decode('utf-8') if EMBED_KEY else '',
+                handshake_info=HANDSHAKE_INFO.decode('utf-8'),
+                iv=base64.b64encode(IV).decode('utf-8'),
+                mode=AES_MODE,
+                mode_name=AES_MODE.upper()
             ).encode('utf-8')
             self.send_response(200)
             self.send_header('Content-Type', 'text/html')
             self.send_header('Content-Length', len(content))
             self.end_headers()
             self.wfile.write(content)
-        elif self.path == '/stream':
+        elif url.path == '/stream':
+            original_every = original_every_from_query(url.query)
             self.send_response(200)
             self.send_header('Cache-Control', 'no-cache')
             self.send_header('Content-Type', 'text/event-stream')
             self.send_header('Connection', 'keep-alive')
             self.end_headers()
+            with self.output.condition:
+                viewers = self.output.original_viewers
+                viewers[original_every] = viewers.get(original_every, 0) + 1
             try:
                 while True:
                     with self.output.condition:
                         self.output.condition.wait()
                         if self.output.frame is not None and self.output.original_frame is not None:
+                            if includes_original(original_every, self.output.sequence):
+                                original_frame = self.output.original_frame
+                            else:
+                                original_frame = b''
+                            # Format: encrypted_frame|original_frame|encryption_time|nonce
                             combined_frame = (
                                 self.output.frame + 
                                 b'|' + 
-                                self.output.original_frame + 
+                                original_frame + 
                                 b'|' + 
-                                str(self.output.encryption_time).encode('utf-8')
+                                str(self.output.encryption_time).encode('utf-8') +
+                                b'|' +
+                                base64.b64encode(self.output.nonce)
                             )
                             self.wfile.write(b'data: ' + combined_frame + b'\n\n')
                             self.wfile.flush()
@@ -324,10 +650,43 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
                 logging.warning(
                     'Removed streaming client %s: %s',
                     self.client_address, str(e))
+            finally:
+                with self.output.condition:
+                    self.output.original_viewers[original_every] -= 1
         else:
             self.send_error(404)
             self.end_headers()
 
+    def do_POST(self):
+        if urlsplit(self.path).path != '/handshake':
+            self.send_error(404)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            if not 0 < length <= 4096:
+                raise ValueError('Bad handshake size')
+            request = json.loads(self.rfile.read(length))
+            if 'ticket' in request:
+                reply = resume_handshake(base64.b64decode(request['ticket']))
+                if reply is None:
+                    self.send_json(404, {'error': 'Unknown or expired ticket'})
+                    return
+            else:
+                reply = full_handshake(base64.b64decode(request['public_key']))
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        self.send_json(200, reply)
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Content-Length', len(content))
+        self.end_headers()
+        self.wfile.write(content)
+
 class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
     allow_reuse_address = True
     daemon_threads = True
@@ -335,6 +694,26 @@ class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
 output = None
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='AES encrypted Pi camera stream')
+    parser.add_argument('--no-original', action='store_true',
+                        help='send only the encrypted frames unless a viewer asks for the original')
+    parser.add_argument('--original-every', type=int, metavar='N',
+                        help='send the plaintext original only every Nth frame')
+    parser.add_argument('--aes-mode', choices=('cbc', 'ctr', 'gcm'), default=AES_MODE,
+                        help='AES mode used for the frames (default: %(default)s)')
+    parser.add_argument('--embed-key', action='store_true',
+                        help='embed the stream key in the page for viewers without WebCrypto')
+    args = parser.parse_args()
+    AES_MODE = args.aes_mode
+    EMBED_KEY = args.embed_key
+
+    # Load or create the identity in the background, start-up does not wait for it
+    Thread(target=get_identity, daemon=True).start()
+    if args.no_original:
+        ORIGINAL_EVERY = 0
+    if args.original_every is not None:
+        ORIGINAL_EVERY = max(0, args.original_every)
+
     # Initialize camera and server
     picam2 = Picamera2()
     picam2.configure(picam2.create_video_configuration(main={"size": (640, 480)}))
@@ -345,8 +724,9 @@ if __name__ == '__main__':
         address = ('', 8000)
         server = StreamingServer(address, StreamingHandler)
         print(f"Server started at http://localhost:8000")
-        print(f"Using AES-256 with key length: {len(KEY)} bytes")
-        print(f"Using IV length: {len(IV)} bytes")
+        print(f"Using AES-256-{AES_MODE.upper()} with key length: {len(KEY)} bytes")
+        if AES_MODE == 'cbc':
+            print(f"Using IV length: {len(IV)} bytes")
         server.serve_forever()
     finally:
         picam2.stop_recording()
@@ -2,6 +2,9 @@ import io
 import logging
 import os
 import socketserver
+import struct
+import sys
+import time
 from http import server
 from threading import Condition
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
@@ -10,6 +13,11 @@ from picamera2 import Picamera2
 from picamera2.encoders import JpegEncoder
 from picamera2.outputs import FileOutput
 
+# The rate controller and asyncio server are shared with the other group B streamers
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from rate_control import RateController
+from aiostream import Response, Stream, StreamServer
+
 PAGE = """\
 <html>
 <head>
@@ -27,12 +35,48 @@ PAGE = """\
 class StreamingOutput(io.BufferedIOBase):
     def __init__(self):
         self.frame = None
+        self.sequence = 0
+        self.encrypted_frame = None
+        self.nonce = None
+        self.encrypted_viewers = 0
         self.condition = Condition()
+        self.rate_control = None
+        # aiostream channels for /stream.mjpg and /stream2.mjpg when run with --asyncio
+        self.channel = None
+        self.encrypted_channel = None
 
     def write(self, buf):
+        # Encrypt once per frame for every /stream2.mjpg viewer. Each frame gets its own
+        # 12-byte nonce (random prefix + frame index), so any frame decrypts on its own.
+        sequence = self.sequence + 1
+        encrypted_frame = nonce = None
+        if self.encrypted_viewers:
+            nonce = nonce_prefix + struct.pack('<Q', sequence)
+            start_time = time.perf_counter()
+            # cryptography wants the 32-bit block counter in front of the nonce
+            encryptor = Cipher(algorithms.ChaCha20(key, bytes(4) + nonce), mode=None, backend=default_backend()).encryptor()
+            encrypted_frame = encryptor.update(buf)
+            if self.rate_control:
+                self.rate_control.record_encryption((time.perf_counter() - start_time) * 1000)
         with self.condition:
             self.frame = buf
+            self.sequence = sequence
+            self.encrypted_frame = encrypted_frame
+            self.nonce = nonce
             self.condition.notify_all()
+        if self.channel:
+            self.channel.publish(mjpeg_part(buf))
+        if self.encrypted_channel and encrypted_frame is not None:
+            self.encrypted_channel.publish(mjpeg_part(
+                encrypted_frame, [('X-Frame-Index', sequence), ('X-Nonce', nonce.hex())]))
+        if self.rate_control:
+            self.rate_control.record_frame(len(buf))
+
+def mjpeg_part(frame, headers=()):
+    # Multipart boundary and headers, then the frame itself without copying it
+    lines = ['--FRAME', 'Content-Type: image/jpeg', f'Content-Length: {len(frame)}']
+    lines.extend(f'{name}: {value}' for name, value in headers)
+    return [('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'), memoryview(frame), b'\r\n']
 
 class StreamingHandler(server.BaseHTTPRequestHandler):
     def do_GET(self):
@@ -54,11 +98,15 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
             self.send_header('Pragma', 'no-cache')
             self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
             self.end_headers()
+            output.rate_control.add_client(self.connection)
             try:
                 while True:
                     with output.condition:
                         output.condition.wait()
                         frame = output.frame
+                    # Skip frames while this client is over the latency budget
+                    if not output.rate_control.should_send(self.connection):
+                        continue
                     self.wfile.write(b'--FRAME\r\n')
                     self.send_header('Content-Type', 'image/jpeg')
                     self.send_header('Content-Length', len(frame))
@@ -67,6 +115,8 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
                     self.wfile.write(b'\r\n')
             except Exception as e:
                 logging.warning('Removed streaming client %s: %s', self.client_address, str(e))
+            finally:
+                output.rate_control.remove_client(self.connection)
         elif self.path == '/stream2.mjpg':
             self.send_response(200)
             self.send_header('Age', 0)
@@ -74,20 +124,33 @@ class StreamingHandler(server.BaseHTTPRequestHandler):
             self.send_header('Pragma', 'no-cache')
             self.send_header('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME')
             self.end_headers()
+            output.rate_control.add_client(self.connection)
+            with output.condition:
+                output.encrypted_viewers += 1
             try:
                 while True:
                     with output.condition:
                         output.condition.wait()
-                        frame = output.frame
-                        encrypted_frame = encryptor.update(frame)
+                        sequence = output.sequence
+                        encrypted_frame = output.encrypted_frame
+                        frame_nonce = output.nonce
+                    # Frames encoded before this viewer was counted are not encrypted yet
+                    if encrypted_frame is None or not output.rate_control.should_send(self.connection):
+                        continue
                     self.wfile.write(b'--FRAME\r\n')
                     self.send_header('Content-Type', 'image/jpeg')
                     self.send_header('Content-Length', len(encrypted_frame))
+                    self.send_header('X-Frame-Index', sequence)
+                    self.send_header('X-Nonce', frame_nonce.hex())
                     self.end_headers()
                     self.wfile.write(encrypted_frame)
                     self.wfile.write(b'\r\n')
             except Exception as e:
                 logging.warning('Removed streaming client %s: %s', self.client_address, str(e))
+            finally:
+                output.rate_control.remove_client(self.connection)
+                with output.condition:
+                    output.encrypted_viewers -= 1
         else:
             self.send_error(404)
             self.end_headers()
@@ -96,20 +159,63 @@ class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
     allow_reuse_address = True
     daemon_threads = True
 
+MJPEG_HEADERS = [
+    ('Age', 0),
+    ('Cache-Control', 'no-cache, private'),
+    ('Pragma', 'no-cache'),
+    ('Content-Type', 'multipart/x-mixed-replace; boundary=FRAME'),
+]
+
+def serve_asyncio(address):
+    # Every viewer on one event loop, frames fanned out by the encoder thread
+    app = StreamServer()
+    output.channel = app.channel()
+    output.encrypted_channel = app.channel()
+
+    def stream(request, channel, encrypted=False):
+        sock = request.transport.get_extra_info('socket')
+        output.rate_control.add_client(sock)
+        if encrypted:
+            with output.condition:
+                output.encrypted_viewers += 1
+
+        def close():
+            output.rate_control.remove_client(sock)
+            if encrypted:
+                with output.condition:
+                    output.encrypted_viewers -= 1
+
+        return Stream(channel, headers=MJPEG_HEADERS, on_close=close)
+
+    app.route('/', lambda request: Response(301, headers=[('Location', '/index.html')]))
+    app.route('/index.html', lambda request: Response(200, PAGE.encode('utf-8'), 'text/html'))
+    app.route('/stream.mjpg', lambda request: stream(request, output.channel))
+    app.route('/stream2.mjpg', lambda request: stream(request, output.encrypted_channel, encrypted=True))
+    app.serve_forever(*address)
+
 key = b'Thirtytwo very very secret bytes'
-nonce = b'These are sixtee'
-cipher = Cipher(algorithms.ChaCha20(key, nonce), mode=None, backend=default_backend())
-encryptor = cipher.encryptor()
-print(f'Nonce: {nonce.hex()}')
+# Per-frame nonce = this prefix + the little-endian frame index, sent as X-Nonce with every part
+nonce_prefix = os.urandom(4)
+print(f'Nonce prefix: {nonce_prefix.hex()}')
 
 picam2 = Picamera2()
-picam2.configure(picam2.create_video_configuration(main={"size": (640, 480)}))
+picam2.configure(picam2.create_video_configuration(
+    main={"size": (640, 480)},
+    lores={"size": (320, 240)},
+    controls={"FrameRate": 30}))
 output = StreamingOutput()
-picam2.start_recording(JpegEncoder(), FileOutput(output))
+encoder = JpegEncoder(q=90)
+picam2.start_recording(encoder, FileOutput(output))
+# Lower JPEG quality, then resolution, when viewers cannot keep up with 30 fps
+output.rate_control = RateController(picam2, encoder, target_fps=30, latency_budget=0.25)
+output.rate_control.start()
 
 try:
     address = ('', 8000)
-    server = StreamingServer(address, StreamingHandler)
-    server.serve_forever()
+    if '--asyncio' in sys.argv:
+        serve_asyncio(address)
+    else:
+        server = StreamingServer(address, StreamingHandler)
+        server.serve_forever()
 finally:
     picam2.stop_recording()
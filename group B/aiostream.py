@@ -0,0 +1,202 @@
+"""Single event loop HTTP server shared by the group B camera streamers.
+
+The threaded servers park one OS thread per viewer in a wfile.write()/flush()
+loop. Here every viewer is an asyncio.Protocol on one loop: the encoder thread
+publishes a frame to a Channel, and the loop hands the same buffers (memoryviews,
+never copies) to each connection with transport.writelines(). A connection whose
+transport buffer is over its high-water mark skips frames until it drains, so a
+slow viewer costs memory for one backlog, not a thread and an unbounded queue.
+
+    app = StreamServer()
+    channel = app.channel()
+    app.route('/index.html', lambda request: Response(200, PAGE, 'text/html'))
+    app.route('/stream.mjpg', lambda request: Stream(channel, headers=[...]))
+    output.channel = channel        # encoder thread: channel.publish(parts)
+    app.serve_forever('', 8000)
+"""
+
+import asyncio
+import logging
+from urllib.parse import urlsplit
+
+REASONS = {
+    101: 'Switching Protocols',
+    200: 'OK',
+    301: 'Moved Permanently',
+    400: 'Bad Request',
+    404: 'Not Found',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+}
+
+# Bytes a viewer may have waiting in its transport before frames are skipped
+HIGH_WATER = 512 * 1024
+MAX_REQUEST = 64 * 1024
+
+class Request:
+    __slots__ = ('method', 'path', 'query', 'headers', 'body', 'transport')
+
+    def __init__(self, method, path, query, headers, body, transport):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers  # lower-case names
+        self.body = body
+        self.transport = transport
+
+class Response:
+    def __init__(self, status=200, body=b'', content_type=None, headers=None):
+        self.status = status
+        self.body = body
+        self.headers = list(headers or [])
+        if content_type:
+            self.headers.append(('Content-Type', content_type))
+
+class Stream:
+    """Streaming response: the connection stays open and gets every frame
+    published on `channel`. `render(frame)` turns a frame into the list of
+    buffers for this viewer, or None to skip it. `on_close` runs once the
+    viewer disconnects."""
+
+    def __init__(self, channel, status=200, headers=None, render=None, on_close=None):
+        self.channel = channel
+        self.status = status
+        self.headers = list(headers or [])
+        self.render = render or (lambda frame: frame)
+        self.on_close = on_close
+
+class Channel:
+    def __init__(self, loop):
+        self.loop = loop
+        self.connections = set()
+        self.skipped = 0
+
+    def publish(self, frame):
+        # Safe from any thread, delivery happens on the event loop
+        self.loop.call_soon_threadsafe(self._deliver, frame)
+
+    def _deliver(self, frame):
+        for connection in self.connections:
+            if connection.paused:
+                self.skipped += 1
+                continue
+            buffers = connection.stream.render(frame)
+            if buffers:
+                connection.transport.writelines(buffers)
+
+class _Connection(asyncio.Protocol):
+    def __init__(self, app):
+        self.app = app
+        self.transport = None
+        self.buffer = bytearray()
+        self.stream = None
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.app.high_water)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+
+    def connection_lost(self, exc):
+        if self.stream is not None:
+            self.stream.channel.connections.discard(self)
+            if self.stream.on_close:
+                self.stream.on_close()
+            self.stream = None
+
+    def data_received(self, data):
+        if self.stream is not None:
+            # Streaming viewers only ever close, anything they send is ignored
+            return
+        self.buffer += data
+        while self.stream is None and not self.transport.is_closing():
+            request = self._parse_request()
+            if request is None:
+                return
+            self._dispatch(request)
+
+    def _parse_request(self):
+        end = self.buffer.find(b'\r\n\r\n')
+        if end < 0:
+            if len(self.buffer) > MAX_REQUEST:
+                self._respond(Response(413), close=True)
+            return None
+        lines = self.buffer[:end].decode('latin-1').split('\r\n')
+        try:
+            method, target, _ = lines[0].split(' ', 2)
+            headers = {}
+            for line in lines[1:]:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            self._respond(Response(400), close=True)
+            return None
+        if length > MAX_REQUEST:
+            self._respond(Response(413), close=True)
+            return None
+        if len(self.buffer) < end + 4 + length:
+            return None
+        body = bytes(self.buffer[end + 4:end + 4 + length])
+        del self.buffer[:end + 4 + length]
+        url = urlsplit(target)
+        return Request(method, url.path, url.query, headers, body, self.transport)
+
+    def _dispatch(self, request):
+        handler = self.app.routes.get(request.path)
+        if handler is None:
+            self._respond(Response(404, b'Not Found', 'text/plain'))
+            return
+        try:
+            response = handler(request)
+        except Exception as e:
+            logging.error('Error handling %s: %s', request.path, str(e))
+            self._respond(Response(500), close=True)
+            return
+        if isinstance(response, Stream):
+            self._write_head(response.status, response.headers)
+            self.stream = response
+            response.channel.connections.add(self)
+        else:
+            self._respond(response, close=request.headers.get('connection', '').lower() == 'close')
+
+    def _write_head(self, status, headers):
+        lines = [f'HTTP/1.1 {status} {REASONS.get(status, "")}']
+        lines.extend(f'{name}: {value}' for name, value in headers)
+        self.transport.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    def _respond(self, response, close=False):
+        headers = response.headers + [('Content-Length', len(response.body))]
+        if close:
+            headers.append(('Connection', 'close'))
+        self._write_head(response.status, headers)
+        self.transport.write(response.body)
+        if close:
+            self.transport.close()
+
+class StreamServer:
+    def __init__(self, high_water=HIGH_WATER):
+        self.loop = asyncio.new_event_loop()
+        self.high_water = high_water
+        self.routes = {}
+
+    def route(self, path, handler):
+        self.routes[path] = handler
+
+    def channel(self):
+        return Channel(self.loop)
+
+    def serve_forever(self, host, port):
+        asyncio.set_event_loop(self.loop)
+        server = self.loop.run_until_complete(self.loop.create_server(
+            lambda: _Connection(self), host, port, reuse_address=True, backlog=128))
+        try:
+            self.loop.run_forever()
+        finally:
+            server.close()
+            self.loop.run_until_complete(server.wait_closed())
@@ -1,20 +1,41 @@
+import argparse
 import io
 import logging
 import socketserver
 from http import server
-from threading import Condition
+from threading import Event, Lock
 from picamera2 import Picamera2
 from picamera2.encoders import JpegEncoder
 from picamera2.outputs import FileOutput
 from Cryptodome.Cipher import ChaCha20
 from Cryptodome.Random import get_random_bytes
 import base64
+import hashlib
+import struct
 import time
+from urllib.parse import parse_qs, urlsplit
+from rate_control import RateController
+from aiostream import Response, Stream, StreamServer
 
 # Generate encryption key and nonce
 KEY = get_random_bytes(32)
 NONCE = get_random_bytes(12)
 
+# Frame-keyed mode: one long-lived key and cipher, and a nonce per frame derived from
+# the 64-bit frame counter. No keystream is reused and the browser can decrypt any
+# frame on its own, in any order. False falls back to the fixed NONCE for every frame.
+FRAME_KEYED = True
+
+# Plaintext copy sent next to the ciphertext: every frame (1), every Nth frame as a
+# thumbnail (N) or never (0). Viewers override it with ?original=0 or ?original_every=N.
+ORIGINAL_EVERY = 1
+
+# Binary frame header sent over /ws, little-endian:
+# frame counter (u64) | nonce (12 bytes) | encryption time in ms (f32) | encrypted length (u32)
+# The encrypted JPEG follows the header and the original JPEG fills the rest of the message.
+FRAME_HEADER = struct.Struct('<Q12sfI')
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
 PAGE = """
 <html>
 <head>
@@ -53,110 +74,180 @@ PAGE = """
     </style>
 
     <script src="https://cdnjs.cloudflare.com/ajax/libs/crypto-js/4.1.1/crypto-js.min.js"></script>
-    <script>
-        // Convert base64 key and nonce to Uint8Array
-        const key = Uint8Array.from(atob('{key}'), c => c.charCodeAt(0));
-        const nonce = Uint8Array.from(atob('{nonce}'), c => c.charCodeAt(0));
-        
-        class ChaCha20 {{
-            constructor(key, nonce) {{
-                if (!(key instanceof Uint8Array) || key.length !== 32) {{
-                    throw new Error('Key must be 32 bytes');
-                }}
-                if (!(nonce instanceof Uint8Array) || nonce.length !== 12) {{
-                    throw new Error('Nonce must be 12 bytes');
-                }}
-                this.key = key;
-                this.nonce = nonce;
-                this.buffer = new Uint8Array(64);
-            }}
+    <script id="chacha20-worker" type="javascript/worker">
+        // ChaCha20 (RFC 8439) decryption worker. Frames arrive as transferred
+        // ArrayBuffers, are decrypted in place and transferred back.
+        const state = new Uint32Array(16);
+        const keystream = new Uint32Array(16);
+        const littleEndian = new Uint8Array(new Uint32Array([1]).buffer)[0] === 1;
+
+        function load32(bytes, i) {{
+            return (bytes[i] | (bytes[i + 1] << 8) | (bytes[i + 2] << 16) | (bytes[i + 3] << 24)) >>> 0;
+        }}
 
-            static rotl(a, b) {{
-                return (a << b) | (a >>> (32 - b));
+        function setKey(key) {{
+            state[0] = 0x61707865;
+            state[1] = 0x3320646e;
+            state[2] = 0x79622d32;
+            state[3] = 0x6b206574;
+            for (let i = 0; i < 8; i++) {{
+                state[4 + i] = load32(key, 4 * i);
             }}
+        }}
 
-            static quarterRound(state, a, b, c, d) {{
-                state[a] += state[b]; state[d] ^= state[a]; state[d] = ChaCha20.rotl(state[d], 16);
-                state[c] += state[d]; state[b] ^= state[c]; state[b] = ChaCha20.rotl(state[b], 12);
-                state[a] += state[b]; state[d] ^= state[a]; state[d] = ChaCha20.rotl(state[d], 8);
-                state[c] += state[d]; state[b] ^= state[c]; state[b] = ChaCha20.rotl(state[b], 7);
+        function setNonce(nonce) {{
+            state[13] = load32(nonce, 0);
+            state[14] = load32(nonce, 4);
+            state[15] = load32(nonce, 8);
+        }}
+
+        // Writes one keystream block into `keystream`. The rounds run on locals,
+        // so nothing is allocated per 64-byte block.
+        function chachaBlock(counter) {{
+            let x0 = state[0];
+            let x1 = state[1];
+            let x2 = state[2];
+            let x3 = state[3];
+            let x4 = state[4];
+            let x5 = state[5];
+            let x6 = state[6];
+            let x7 = state[7];
+            let x8 = state[8];
+            let x9 = state[9];
+            let x10 = state[10];
+            let x11 = state[11];
+            let x12 = counter | 0;
+            let x13 = state[13];
+            let x14 = state[14];
+            let x15 = state[15];
+
+            for (let i = 0; i < 10; i++) {{
+                // Column round
+                x0 = (x0 + x4) | 0; x12 ^= x0; x12 = (x12 << 16) | (x12 >>> 16);
+                x8 = (x8 + x12) | 0; x4 ^= x8; x4 = (x4 << 12) | (x4 >>> 20);
+                x0 = (x0 + x4) | 0; x12 ^= x0; x12 = (x12 << 8) | (x12 >>> 24);
+                x8 = (x8 + x12) | 0; x4 ^= x8; x4 = (x4 << 7) | (x4 >>> 25);
+                x1 = (x1 + x5) | 0; x13 ^= x1; x13 = (x13 << 16) | (x13 >>> 16);
+                x9 = (x9 + x13) | 0; x5 ^= x9; x5 = (x5 << 12) | (x5 >>> 20);
+                x1 = (x1 + x5) | 0; x13 ^= x1; x13 = (x13 << 8) | (x13 >>> 24);
+                x9 = (x9 + x13) | 0; x5 ^= x9; x5 = (x5 << 7) | (x5 >>> 25);
+                x2 = (x2 + x6) | 0; x14 ^= x2; x14 = (x14 << 16) | (x14 >>> 16);
+                x10 = (x10 + x14) | 0; x6 ^= x10; x6 = (x6 << 12) | (x6 >>> 20);
+                x2 = (x2 + x6) | 0; x14 ^= x2; x14 = (x14 << 8) | (x14 >>> 24);
+                x10 = (x10 + x14) | 0; x6 ^= x10; x6 = (x6 << 7) | (x6 >>> 25);
+                x3 = (x3 + x7) | 0; x15 ^= x3; x15 = (x15 << 16) | (x15 >>> 16);
+                x11 = (x11 + x15) | 0; x7 ^= x11; x7 = (x7 << 12) | (x7 >>> 20);
+                x3 = (x3 + x7) | 0; x15 ^= x3; x15 = (x15 << 8) | (x15 >>> 24);
+                x11 = (x11 + x15) | 0; x7 ^= x11; x7 = (x7 << 7) | (x7 >>> 25);
+                // Diagonal round
+                x0 = (x0 + x5) | 0; x15 ^= x0; x15 = (x15 << 16) | (x15 >>> 16);
+                x10 = (x10 + x15) | 0; x5 ^= x10; x5 = (x5 << 12) | (x5 >>> 20);
+                x0 = (x0 + x5) | 0; x15 ^= x0; x15 = (x15 << 8) | (x15 >>> 24);
+                x10 = (x10 + x15) | 0; x5 ^= x10; x5 = (x5 << 7) | (x5 >>> 25);
+                x1 = (x1 + x6) | 0; x12 ^= x1; x12 = (x12 << 16) | (x12 >>> 16);
+                x11 = (x11 + x12) | 0; x6 ^= x11; x6 = (x6 << 12) | (x6 >>> 20);
+                x1 = (x1 + x6) | 0; x12 ^= x1; x12 = (x12 << 8) | (x12 >>> 24);
+                x11 = (x11 + x12) | 0; x6 ^= x11; x6 = (x6 << 7) | (x6 >>> 25);
+                x2 = (x2 + x7) | 0; x13 ^= x2; x13 = (x13 << 16) | (x13 >>> 16);
+                x8 = (x8 + x13) | 0; x7 ^= x8; x7 = (x7 << 12) | (x7 >>> 20);
+                x2 = (x2 + x7) | 0; x13 ^= x2; x13 = (x13 << 8) | (x13 >>> 24);
+                x8 = (x8 + x13) | 0; x7 ^= x8; x7 = (x7 << 7) | (x7 >>> 25);
+                x3 = (x3 + x4) | 0; x14 ^= x3; x14 = (x14 << 16) | (x14 >>> 16);
+                x9 = (x9 + x14) | 0; x4 ^= x9; x4 = (x4 << 12) | (x4 >>> 20);
+                x3 = (x3 + x4) | 0; x14 ^= x3; x14 = (x14 << 8) | (x14 >>> 24);
+                x9 = (x9 + x14) | 0; x4 ^= x9; x4 = (x4 << 7) | (x4 >>> 25);
             }}
 
-            chacha20Block(counter) {{
-                const state = new Uint32Array(16);
-                
-                state[0] = 0x61707865;
-                state[1] = 0x3320646e;
-                state[2] = 0x79622d32;
-                state[3] = 0x6b206574;
-
-                for (let i = 0; i < 8; i++) {{
-                    state[4 + i] = (this.key[4*i + 3] << 24) | 
-                                 (this.key[4*i + 2] << 16) | 
-                                 (this.key[4*i + 1] << 8) | 
-                                 this.key[4*i];
-                }}
+            keystream[0] = x0 + state[0];
+            keystream[1] = x1 + state[1];
+            keystream[2] = x2 + state[2];
+            keystream[3] = x3 + state[3];
+            keystream[4] = x4 + state[4];
+            keystream[5] = x5 + state[5];
+            keystream[6] = x6 + state[6];
+            keystream[7] = x7 + state[7];
+            keystream[8] = x8 + state[8];
+            keystream[9] = x9 + state[9];
+            keystream[10] = x10 + state[10];
+            keystream[11] = x11 + state[11];
+            keystream[12] = x12 + counter;
+            keystream[13] = x13 + state[13];
+            keystream[14] = x14 + state[14];
+            keystream[15] = x15 + state[15];
+        }}
 
-                state[12] = counter;
-                state[13] = (this.nonce[3] << 24) | (this.nonce[2] << 16) | (this.nonce[1] << 8) | this.nonce[0];
-                state[14] = (this.nonce[7] << 24) | (this.nonce[6] << 16) | (this.nonce[5] << 8) | this.nonce[4];
-                state[15] = (this.nonce[11] << 24) | (this.nonce[10] << 16) | (this.nonce[9] << 8) | this.nonce[8];
-
-                const working = new Uint32Array(state);
-
-                for (let i = 0; i < 10; i++) {{
-                    ChaCha20.quarterRound(working, 0, 4, 8, 12);
-                    ChaCha20.quarterRound(working, 1, 5, 9, 13);
-                    ChaCha20.quarterRound(working, 2, 6, 10, 14);
-                    ChaCha20.quarterRound(working, 3, 7, 11, 15);
-                    ChaCha20.quarterRound(working, 0, 5, 10, 15);
-                    ChaCha20.quarterRound(working, 1, 6, 11, 12);
-                    ChaCha20.quarterRound(working, 2, 7, 8, 13);
-                    ChaCha20.quarterRound(working, 3, 4, 9, 14);
-                }}
+        function keystreamByte(i) {{
+            return (keystream[i >>> 2] >>> ((i & 3) << 3)) & 0xff;
+        }}
 
-                for (let i = 0; i < 16; i++) {{
-                    working[i] += state[i];
+        function xorInPlace(data) {{
+            const length = data.length;
+            const blocks = length >>> 6;
+            let counter = 0;
+
+            if (littleEndian && (data.byteOffset & 3) === 0) {{
+                // Whole blocks are XORed a word at a time
+                const words = new Uint32Array(data.buffer, data.byteOffset, blocks << 4);
+                for (let b = 0; b < blocks; b++) {{
+                    chachaBlock(counter++);
+                    const base = b << 4;
+                    for (let i = 0; i < 16; i++) {{
+                        words[base + i] ^= keystream[i];
+                    }}
                 }}
-
-                for (let i = 0; i < 16; i++) {{
-                    this.buffer[4*i] = working[i] & 0xff;
-                    this.buffer[4*i + 1] = (working[i] >>> 8) & 0xff;
-                    this.buffer[4*i + 2] = (working[i] >>> 16) & 0xff;
-                    this.buffer[4*i + 3] = (working[i] >>> 24) & 0xff;
+            }} else {{
+                for (let b = 0; b < blocks; b++) {{
+                    chachaBlock(counter++);
+                    const base = b << 6;
+                    for (let i = 0; i < 64; i++) {{
+                        data[base + i] ^= keystreamByte(i);
+                    }}
                 }}
-                
-                return this.buffer;
             }}
 
-            decrypt(data) {{
-                const result = new Uint8Array(data.length);
-                let counter = 0;
-                
-                const chunkSize = 64 * 1024;
-                for (let offset = 0; offset < data.length; offset += chunkSize) {{
-                    const chunk = data.slice(offset, offset + chunkSize);
-                    let pos = 0;
-                    
-                    while (pos < chunk.length) {{
-                        const keyStream = this.chacha20Block(counter++);
-                        const blockSize = Math.min(64, chunk.length - pos);
-                        for (let i = 0; i < blockSize; i++) {{
-                            result[offset + pos + i] = chunk[pos + i] ^ keyStream[i];
-                        }}
-                        pos += 64;
-                    }}
+            const tail = length & 63;
+            if (tail) {{
+                chachaBlock(counter);
+                const base = blocks << 6;
+                for (let i = 0; i < tail; i++) {{
+                    data[base + i] ^= keystreamByte(i);
                 }}
-                
-                return result;
             }}
         }}
+
+        self.onmessage = function(event) {{
+            const message = event.data;
+            if (message.type === 'init') {{
+                setKey(message.key);
+                return;
+            }}
+
+            const startTime = performance.now();
+            const data = new Uint8Array(message.buffer, message.offset, message.length);
+            setNonce(message.nonce);
+            xorInPlace(data);
+            self.postMessage({{
+                type: 'done',
+                id: message.id,
+                buffer: message.buffer,
+                offset: message.offset,
+                length: message.length,
+                elapsed: performance.now() - startTime
+            }}, [message.buffer]);
+        }};
+    </script>
+    <script>
+        // Convert base64 key and nonce to Uint8Array
+        const key = Uint8Array.from(atob('{key}'), c => c.charCodeAt(0));
+        const nonce = Uint8Array.from(atob('{nonce}'), c => c.charCodeAt(0));
         
         // Add performance metrics tracking
         const metrics = {{
             encryptionTime: 0,
             decryptionTime: 0,
             totalFrames: 0,
+            decryptedFrames: 0,
+            droppedFrames: 0,
             avgDecryptionTime: 0,
             avgEncryptionTime: 0,
             lastUpdate: Date.now()
@@ -172,144 +263,206 @@ PAGE = """
             metrics.lastUpdate = Date.now();
         }}
 
+        function updateWorkerMetrics() {{
+            document.getElementById('worker-throughput').textContent = `${{decryptPool.throughput().toFixed(1)}} MB/s`;
+            document.getElementById('decrypt-workers').textContent =
+                `${{decryptPool.workers.length}} (${{metrics.droppedFrames}} dropped)`;
+        }}
 
-        // Pre-split structure for better performance
-        let frameData = {{
-            encrypted: null,
-            original: null
-        }};
+        function recordEncryptionTime(encryptionTime) {{
+            metrics.encryptionTime = encryptionTime;
+            metrics.totalFrames++;
+            metrics.avgEncryptionTime = ((metrics.avgEncryptionTime * (metrics.totalFrames - 1)) + metrics.encryptionTime) / metrics.totalFrames;
+        }}
 
-        // Maintain separate workers for encrypted and original streams
-        let decryptionWorker = null;
-        let displayWorker = null;
-
-        class FrameQueue {{
-            constructor(maxSize = 2) {{
-                this.queue = new Array(maxSize);
-                this.head = 0;
-                this.tail = 0;
-                this.size = 0;
-                this.maxSize = maxSize;
+        // Decryption runs in a pool of workers. Buffers are transferred, never copied,
+        // and when every worker is busy only the newest frame is kept waiting.
+        class DecryptPool {{
+            constructor(size) {{
+                const source = document.getElementById('chacha20-worker').textContent;
+                const url = URL.createObjectURL(new Blob([source], {{type: 'text/javascript'}}));
+                this.workers = [];
+                this.idle = [];
+                this.jobs = new Map();
+                this.pending = null;
+                this.nextId = 0;
+                this.bytes = 0;
+                this.busyTime = 0;
+                for (let i = 0; i < size; i++) {{
+                    const worker = new Worker(url);
+                    worker.onmessage = (event) => this.onMessage(worker, event.data);
+                    worker.postMessage({{type: 'init', key: key}});
+                    this.workers.push(worker);
+                    this.idle.push(worker);
+                }}
             }}
 
-            push(frame) {{
-                if (this.size === this.maxSize) {{
-                    this.head = (this.head + 1) % this.maxSize;
-                    this.size--;
+            submit(job) {{
+                const worker = this.idle.pop();
+                if (!worker) {{
+                    if (this.pending) metrics.droppedFrames++;
+                    this.pending = job;
+                    return;
                 }}
-                this.queue[this.tail] = frame;
-                this.tail = (this.tail + 1) % this.maxSize;
-                this.size++;
+                this.dispatch(worker, job);
             }}
 
-            pop() {{
-                if (this.size === 0) return null;
-                const frame = this.queue[this.head];
-                this.head = (this.head + 1) % this.maxSize;
-                this.size--;
-                return frame;
+            dispatch(worker, job) {{
+                const id = this.nextId++;
+                this.jobs.set(id, job);
+                worker.postMessage({{
+                    type: 'decrypt',
+                    id: id,
+                    buffer: job.buffer,
+                    offset: job.offset,
+                    length: job.length,
+                    nonce: job.nonce
+                }}, [job.buffer]);
             }}
 
-            clear() {{
-                this.head = 0;
-                this.tail = 0;
-                this.size = 0;
+            onMessage(worker, message) {{
+                const job = this.jobs.get(message.id);
+                this.jobs.delete(message.id);
+                this.bytes += message.length;
+                this.busyTime += message.elapsed;
+                job.onDone(new Uint8Array(message.buffer, message.offset, message.length), message.elapsed);
+
+                if (this.pending) {{
+                    const next = this.pending;
+                    this.pending = null;
+                    this.dispatch(worker, next);
+                }} else {{
+                    this.idle.push(worker);
+                }}
             }}
-        }}
 
-        const frameQueue = new FrameQueue(2);
-        const chacha = new ChaCha20(key, nonce);
-        let currentBlobUrl = null;
+            // Per-worker throughput since the previous call
+            throughput() {{
+                const rate = this.busyTime ? this.bytes / (this.busyTime * 1000) : 0;
+                this.bytes = 0;
+                this.busyTime = 0;
+                return rate;
+            }}
 
-        function splitFrameData(data) {{
-            const parts = data.split('|');
-            if (parts.length !== 3) return false;
-            
-            frameData.encrypted = parts[0];
-            frameData.original = parts[1];
-            // Update encryption time metrics
-            metrics.encryptionTime = parseFloat(parts[2]);
-            metrics.totalFrames++;
-            metrics.avgEncryptionTime = ((metrics.avgEncryptionTime * (metrics.totalFrames - 1)) + metrics.encryptionTime) / metrics.totalFrames;
-            
-            return true;
+            terminate() {{
+                this.workers.forEach(worker => worker.terminate());
+            }}
         }}
 
-        async function decryptFrame(encryptedData) {{
-            try {{
-                const startTime = performance.now();
-                
-                const binary = atob(encryptedData);
-                const length = binary.length;
-                const encrypted = new Uint8Array(length);
-                for (let i = 0; i < length; i++) {{
-                    encrypted[i] = binary.charCodeAt(i);
-                }}
-                
-                const decrypted = chacha.decrypt(encrypted);
-                
-                if (currentBlobUrl) {{
-                    URL.revokeObjectURL(currentBlobUrl);
-                }}
-                
-                const blob = new Blob([decrypted], {{type: 'image/jpeg'}});
-                currentBlobUrl = URL.createObjectURL(blob);
-                
-                // Update decryption metrics
-                metrics.decryptionTime = performance.now() - startTime;
-                metrics.totalFrames++;
-                metrics.avgDecryptionTime = ((metrics.avgDecryptionTime * (metrics.totalFrames - 1)) + metrics.decryptionTime) / metrics.totalFrames;
-                
-                updateMetrics();
-                
-                return currentBlobUrl;
-            }} catch (error) {{
-                console.error('Decryption error:', error);
-                throw error;
+        const poolSize = Math.min(4, Math.max(1, (navigator.hardwareConcurrency || 2) - 1));
+        const decryptPool = new DecryptPool(poolSize);
+        setInterval(updateWorkerMetrics, 1000);
+
+        let currentBlobUrl = null;
+        let originalBlobUrl = null;
+        let lastShownSequence = -1;
+        let sseSequence = 0;
+
+        function showDecrypted(img, sequence, decrypted, elapsed) {{
+            // Workers can finish out of order, never step back to an older frame
+            if (sequence <= lastShownSequence) {{
+                metrics.droppedFrames++;
+                return;
             }}
+            lastShownSequence = sequence;
+
+            if (currentBlobUrl) {{
+                URL.revokeObjectURL(currentBlobUrl);
+            }}
+            currentBlobUrl = URL.createObjectURL(new Blob([decrypted], {{type: 'image/jpeg'}}));
+            img.src = currentBlobUrl;
+
+            // Update decryption metrics
+            metrics.decryptionTime = elapsed;
+            metrics.decryptedFrames++;
+            metrics.avgDecryptionTime = ((metrics.avgDecryptionTime * (metrics.decryptedFrames - 1)) + metrics.decryptionTime) / metrics.decryptedFrames;
+
+            updateMetrics();
         }}
 
-        function updateOriginalStream(img, data) {{
-            img.src = `data:image/jpeg;base64,${{data}}`;
+        function decryptFrame(img, sequence, encrypted, frameNonce) {{
+            decryptPool.submit({{
+                buffer: encrypted.buffer,
+                offset: encrypted.byteOffset,
+                length: encrypted.length,
+                nonce: frameNonce,
+                onDone: (decrypted, elapsed) => showDecrypted(img, sequence, decrypted, elapsed)
+            }});
         }}
 
-        async function processDecryptedStream(img, encryptedData) {{
-            frameQueue.push(encryptedData);
-            
-            if (!decryptionWorker) {{
-                decryptionWorker = requestAnimationFrame(async () => {{
-                    const frame = frameQueue.pop();
-                    frameQueue.clear();
-                    
-                    if (frame) {{
-                        const decryptedUrl = await decryptFrame(frame);
-                        img.src = decryptedUrl;
-                    }}
-                    decryptionWorker = null;
-                }});
+        function base64ToBytes(data) {{
+            const binary = atob(data);
+            const length = binary.length;
+            const bytes = new Uint8Array(length);
+            for (let i = 0; i < length; i++) {{
+                bytes[i] = binary.charCodeAt(i);
             }}
+            return bytes;
         }}
 
-        async function updateImages(originalImg, decryptedImg, data) {{
-            if (!splitFrameData(data)) {{
+        function updateImages(originalImg, decryptedImg, data) {{
+            const parts = data.split('|');
+            if (parts.length !== 3 && parts.length !== 4) {{
                 console.error('Invalid frame data format');
                 return;
             }}
 
-            updateOriginalStream(originalImg, frameData.original);
-            await processDecryptedStream(decryptedImg, frameData.encrypted);
+            recordEncryptionTime(parseFloat(parts[2]));
+            // Encrypted-only frames leave the original field empty
+            if (parts[1]) {{
+                originalImg.src = `data:image/jpeg;base64,${{parts[1]}}`;
+            }}
+            // Frame-keyed servers send the frame nonce as a fourth field
+            const frameNonce = parts.length === 4 ? base64ToBytes(parts[3]) : nonce;
+            decryptFrame(decryptedImg, sseSequence++, base64ToBytes(parts[0]), frameNonce);
+        }}
+
+        // Binary frames from /ws: FRAME_HEADER (28 bytes) | encrypted | original
+        const FRAME_HEADER_SIZE = 28;
+
+        function parseBinaryFrame(buffer) {{
+            if (buffer.byteLength < FRAME_HEADER_SIZE) return null;
+            const view = new DataView(buffer);
+            const encryptedLength = view.getUint32(24, true);
+            if (FRAME_HEADER_SIZE + encryptedLength > buffer.byteLength) return null;
+            return {{
+                sequence: Number(view.getBigUint64(0, true)),
+                // Copied, the buffer itself is transferred to a worker
+                nonce: new Uint8Array(buffer, 8, 12).slice(),
+                encryptionTime: view.getFloat32(20, true),
+                encrypted: new Uint8Array(buffer, FRAME_HEADER_SIZE, encryptedLength),
+                original: new Uint8Array(buffer, FRAME_HEADER_SIZE + encryptedLength)
+            }};
+        }}
+
+        function updateImagesBinary(originalImg, decryptedImg, buffer) {{
+            const frame = parseBinaryFrame(buffer);
+            if (!frame) {{
+                console.error('Invalid binary frame');
+                return;
+            }}
+
+            recordEncryptionTime(frame.encryptionTime);
+
+            if (frame.original.length) {{
+                // The Blob snapshots the bytes before the buffer moves to a worker
+                if (originalBlobUrl) {{
+                    URL.revokeObjectURL(originalBlobUrl);
+                }}
+                originalBlobUrl = URL.createObjectURL(new Blob([frame.original], {{type: 'image/jpeg'}}));
+                originalImg.src = originalBlobUrl;
+            }}
+            decryptFrame(decryptedImg, frame.sequence, frame.encrypted, frame.nonce);
         }}
 
         window.addEventListener('unload', () => {{
             if (currentBlobUrl) {{
                 URL.revokeObjectURL(currentBlobUrl);
             }}
-            if (decryptionWorker) {{
-                cancelAnimationFrame(decryptionWorker);
-            }}
-            if (displayWorker) {{
-                cancelAnimationFrame(displayWorker);
+            if (originalBlobUrl) {{
+                URL.revokeObjectURL(originalBlobUrl);
             }}
+            decryptPool.terminate();
         }});
     </script>
 </head>
@@ -341,6 +494,14 @@ PAGE = """
             <span class="metric-label">Frames Per Second:</span>
             <span class="metric-value" id="fps">0</span>
         </div>
+        <div class="metric-item">
+            <span class="metric-label">Worker Throughput:</span>
+            <span class="metric-value" id="worker-throughput">0 MB/s</span>
+        </div>
+        <div class="metric-item">
+            <span class="metric-label">Decrypt Workers:</span>
+            <span class="metric-value" id="decrypt-workers">0</span>
+        </div>
     </div>
     <div class="stream-container">
         <div class="stream-box">
@@ -354,23 +515,58 @@ PAGE = """
     </div>
     <div id="status">Connecting...</div>
     <script>
-        const eventSource = new EventSource('/stream');
         const originalImg = document.getElementById('original-stream');
         const decryptedImg = document.getElementById('decrypted-stream');
         const status = document.getElementById('status');
-        
-        eventSource.onopen = function() {{
-            status.textContent = 'Connected';
-        }};
-        
-        eventSource.onerror = function() {{
-            status.textContent = 'Connection error';
-        }};
-        
-        eventSource.onmessage = function(event) {{
-            status.textContent = 'Streaming...';
-            updateImages(originalImg, decryptedImg, event.data);
-        }};
+
+        // Prefer the binary WebSocket transport; ?transport=sse forces the base64 event stream
+        const pageParams = new URLSearchParams(window.location.search);
+        const useWebSocket = 'WebSocket' in window && pageParams.get('transport') !== 'sse';
+
+        // Pass ?original=0 / ?original_every=N on to the stream
+        const streamParams = new URLSearchParams();
+        ['original', 'original_every'].forEach(name => {{
+            if (pageParams.has(name)) streamParams.set(name, pageParams.get(name));
+        }});
+        const streamQuery = streamParams.toString() ? '?' + streamParams.toString() : '';
+
+        if (useWebSocket) {{
+            const scheme = window.location.protocol === 'https:' ? 'wss://' : 'ws://';
+            const socket = new WebSocket(scheme + window.location.host + '/ws' + streamQuery);
+            socket.binaryType = 'arraybuffer';
+
+            socket.onopen = function() {{
+                status.textContent = 'Connected (WebSocket)';
+            }};
+
+            socket.onerror = function() {{
+                status.textContent = 'Connection error';
+            }};
+
+            socket.onclose = function() {{
+                status.textContent = 'Disconnected';
+            }};
+
+            socket.onmessage = function(event) {{
+                status.textContent = 'Streaming (WebSocket)...';
+                updateImagesBinary(originalImg, decryptedImg, event.data);
+            }};
+        }} else {{
+            const eventSource = new EventSource('/stream' + streamQuery);
+
+            eventSource.onopen = function() {{
+                status.textContent = 'Connected';
+            }};
+            
+            eventSource.onerror = function() {{
+                status.textContent = 'Connection error';
+            }};
+            
+            eventSource.onmessage = function(event) {{
+                status.textContent = 'Streaming...';
+                updateImages(originalImg, decryptedImg, event.data);
+            }};
+        }}
     </script>
 </body>
 </html>
@@ -378,103 +574,364 @@ PAGE = """
 
 import time
 
+def websocket_header(length, opcode=0x2):
+    # Unmasked server-to-client frame with FIN set (RFC 6455 section 5.2)
+    if length < 126:
+        return struct.pack('!BB', 0x80 | opcode, length)
+    if length < 65536:
+        return struct.pack('!BBH', 0x80 | opcode, 126, length)
+    return struct.pack('!BBQ', 0x80 | opcode, 127, length)
+
+def websocket_frame(payload, opcode=0x2):
+    return websocket_header(len(payload), opcode) + payload
+
+def websocket_accept(key):
+    return base64.b64encode(hashlib.sha1(key.encode('ascii') + WS_GUID).digest()).decode('ascii')
+
+def send_buffers(sock, buffers):
+    # One sendmsg per frame straight from the shared buffers, no joined copy per viewer
+    views = [memoryview(buf) for buf in buffers if len(buf)]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if views:
+            views[0] = views[0][sent:]
+
+def original_every_from_query(query):
+    # ?original=0 turns the plaintext copy off, ?original_every=N sends it every Nth frame
+    params = parse_qs(query)
+    try:
+        if 'original_every' in params:
+            return max(0, int(params['original_every'][0]))
+        if 'original' in params:
+            return (ORIGINAL_EVERY or 1) if params['original'][0] not in ('0', 'false', 'no') else 0
+    except ValueError:
+        pass
+    return ORIGINAL_EVERY
+
+def includes_original(original_every, sequence):
+    return original_every > 0 and sequence % original_every == 0
+
+class Frame:
+    # One encrypted camera frame with its payloads already serialized per
+    # (encoding, includes original) variant, each as a tuple of buffers
+    __slots__ = ('sequence', 'payloads')
+
+    def __init__(self, sequence, payloads):
+        self.sequence = sequence
+        self.payloads = payloads
+
+class FrameRing:
+    """Sequence-numbered ring of published frames.
+
+    The camera thread is the only writer: it fills a slot, then bumps
+    `sequence`, then wakes waiting readers. Readers never take a lock, each one
+    keeps its own cursor and jumps to the newest frame once its next frame has
+    been overwritten.
+    """
+
+    def __init__(self, size=4):
+        self.slots = [None] * size
+        self.sequence = 0
+        self._published = Event()
+
+    def publish(self, frame):
+        self.slots[frame.sequence % len(self.slots)] = frame
+        self.sequence = frame.sequence
+        published, self._published = self._published, Event()
+        published.set()
+
+    def next_frame(self, cursor, timeout=None):
+        while True:
+            published = self._published
+            newest = self.sequence
+            if newest > cursor:
+                wanted = cursor + 1 if newest - cursor < len(self.slots) else newest
+                frame = self.slots[wanted % len(self.slots)]
+                # A newer frame may have replaced the slot meanwhile, that is just a skip
+                if frame is not None and frame.sequence >= wanted:
+                    return frame
+            elif not published.wait(timeout):
+                return None
+
 class StreamingOutput(io.BufferedIOBase):
     def __init__(self):
-        self.frame = None
-        self.original_frame = None
-        self.condition = Condition()
+        self.ring = FrameRing()
+        self.sequence = 0
+        self.nonce = NONCE
+        self.nonce_prefix = get_random_bytes(8)
         self.encryption_time = 0
+        self.rate_control = None
+        self.channel = None  # aiostream channel when serving with --asyncio
+        # Viewer count per (encoding, original_every), so write() only serializes what is being watched
+        self.subscribers = {}
+        self.subscriptions = frozenset()
+        self._subscribers_lock = Lock()
         self._setup_cipher()
 
     def _setup_cipher(self):
-        self.cipher = ChaCha20.new(key=KEY, nonce=NONCE)
+        if FRAME_KEYED:
+            # Original ChaCha20 with a 64-bit block counter: the high counter word
+            # selects the frame, so seeking replaces building a cipher per frame
+            self.cipher = ChaCha20.new(key=KEY, nonce=self.nonce_prefix)
+        else:
+            self.cipher = ChaCha20.new(key=KEY, nonce=NONCE)
+
+    def _start_frame(self):
+        self.sequence += 1
+        if not FRAME_KEYED:
+            self.cipher.seek(0)
+            self.nonce = NONCE
+            return
+        frame = self.sequence & 0xFFFFFFFF
+        if frame == 0:
+            # 2**32 frames on one prefix, take a fresh one rather than repeat a nonce
+            self.nonce_prefix = get_random_bytes(8)
+            self._setup_cipher()
+        self.cipher.seek(frame << 38)
+        # The same keystream in the IETF layout the browser uses: counter word, then nonce
+        self.nonce = struct.pack('<I', frame) + self.nonce_prefix
+
+    def subscribe(self, subscription):
+        with self._subscribers_lock:
+            self.subscribers[subscription] = self.subscribers.get(subscription, 0) + 1
+            self.subscriptions = frozenset(k for k, n in self.subscribers.items() if n)
+
+    def unsubscribe(self, subscription):
+        with self._subscribers_lock:
+            self.subscribers[subscription] -= 1
+            self.subscriptions = frozenset(k for k, n in self.subscribers.items() if n)
+
+    def serialize(self, encoding, with_original, encrypted_frame, buf):
+        if not with_original:
+            buf = b''
+        if encoding == 'sse':
+            # Format: data: encrypted_frame|original_frame|encryption_time|nonce
+            # The original field is empty on encrypted-only frames
+            return (b''.join((
+                b'data: ',
+                base64.b64encode(encrypted_frame),
+                b'|',
+                base64.b64encode(buf),
+                b'|',
+                str(self.encryption_time).encode('utf-8'),
+                b'|',
+                base64.b64encode(self.nonce),
+                b'\n\n'
+            )),)
+        if encoding == 'ws':
+            header = FRAME_HEADER.pack(
+                self.sequence, self.nonce, self.encryption_time, len(encrypted_frame))
+            length = len(header) + len(encrypted_frame) + len(buf)
+            return (websocket_header(length), header, encrypted_frame, buf)
+        raise ValueError(f"Unknown encoding: {encoding}")
 
     def write(self, buf):
-        with self.condition:
-            try:
-                # Measure encryption time
-                start_time = time.perf_counter()
-                encrypted_frame = self.cipher.encrypt(buf)
-                self.encryption_time = (time.perf_counter() - start_time) * 1000  # Convert to milliseconds
-                
-                self.frame = base64.b64encode(encrypted_frame)
-                self.original_frame = base64.b64encode(buf)
-                self.condition.notify_all()
-            except Exception as e:
-                logging.error(f"Encryption error: {str(e)}")
-            finally:
-                self._setup_cipher()
+        # Called from the encoder thread only, so the cipher needs no locking
+        try:
+            self._start_frame()
+            # Measure encryption time
+            start_time = time.perf_counter()
+            encrypted_frame = self.cipher.encrypt(buf)
+            self.encryption_time = (time.perf_counter() - start_time) * 1000  # Convert to milliseconds
+            if self.rate_control:
+                self.rate_control.record_frame(len(buf))
+                self.rate_control.record_encryption(self.encryption_time)
+
+            # Serialize once per frame and variant, however many viewers share it
+            variants = {
+                (encoding, includes_original(original_every, self.sequence))
+                for encoding, original_every in self.subscriptions
+            }
+            payloads = {
+                variant: self.serialize(*variant, encrypted_frame, buf)
+                for variant in variants
+            }
+            frame = Frame(self.sequence, payloads)
+            self.ring.publish(frame)
+            if self.channel:
+                self.channel.publish(frame)
+        except Exception as e:
+            logging.error(f"Encryption error: {str(e)}")
         return len(buf)
 
 class StreamingHandler(server.BaseHTTPRequestHandler):
+    # RFC 6455 needs an HTTP/1.1 handshake, so every response either has a length
+    # or closes the connection when it ends
+    protocol_version = 'HTTP/1.1'
+
     def __init__(self, *args, **kwargs):
         self.output = output
         super().__init__(*args, **kwargs)
 
     def do_GET(self):
-        if self.path == '/':
+        url = urlsplit(self.path)
+        if url.path == '/':
             self.send_response(301)
             self.send_header('Location', '/index.html')
+            self.send_header('Content-Length', 0)
             self.end_headers()
-        elif self.path == '/index.html':
-            content = PAGE.format(
-                key=base64.b64encode(KEY).decode('utf-8'),
-                nonce=base64.b64encode(NONCE).decode('utf-8')
-            ).encode('utf-8')
+        elif url.path == '/index.html':
+            content = index_page()
             self.send_response(200)
             self.send_header('Content-Type', 'text/html')
             self.send_header('Content-Length', len(content))
             self.end_headers()
             self.wfile.write(content)
-        elif self.path == '/stream':
+        elif url.path == '/ws':
+            self.stream_websocket(original_every_from_query(url.query))
+        elif url.path == '/stream':
             self.send_response(200)
             self.send_header('Cache-Control', 'no-cache')
             self.send_header('Content-Type', 'text/event-stream')
-            self.send_header('Connection', 'keep-alive')
+            self.send_header('Connection', 'close')
             self.end_headers()
-            try:
-                while True:
-                    with self.output.condition:
-                        self.output.condition.wait()
-                        if self.output.frame is not None and self.output.original_frame is not None:
-                            # Include encryption time in the data stream
-                            # Format: encrypted_frame|original_frame|encryption_time
-                            combined_frame = (
-                                self.output.frame + 
-                                b'|' + 
-                                self.output.original_frame + 
-                                b'|' + 
-                                str(self.output.encryption_time).encode('utf-8')
-                            )
-                            self.wfile.write(b'data: ' + combined_frame + b'\n\n')
-                            self.wfile.flush()
-            except Exception as e:
-                logging.warning(
-                    'Removed streaming client %s: %s',
-                    self.client_address, str(e))
+            self.close_connection = True
+            self.stream_frames('sse', original_every_from_query(url.query))
         else:
             self.send_error(404)
-            self.end_headers()
+
+    def stream_websocket(self, original_every):
+        key = self.headers.get('Sec-WebSocket-Key')
+        if self.headers.get('Upgrade', '').lower() != 'websocket' or not key:
+            self.send_error(400, 'Expected a WebSocket upgrade')
+            return
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', websocket_accept(key))
+        self.end_headers()
+        self.close_connection = True
+        self.stream_frames('ws', original_every)
+
+    def stream_frames(self, encoding, original_every):
+        ring = self.output.ring
+        rate_control = self.output.rate_control
+        subscription = (encoding, original_every)
+        self.output.subscribe(subscription)
+        if rate_control:
+            rate_control.add_client(self.connection)
+        cursor = ring.sequence
+        try:
+            while True:
+                frame = ring.next_frame(cursor, timeout=1.0)
+                if frame is None:
+                    continue
+                cursor = frame.sequence
+                # Frames published before we subscribed carry no payload for us
+                payload = frame.payloads.get(
+                    (encoding, includes_original(original_every, frame.sequence)))
+                # A client that is already over the latency budget skips this frame
+                if payload is not None and (not rate_control or rate_control.should_send(self.connection)):
+                    send_buffers(self.connection, payload)
+        except Exception as e:
+            logging.warning(
+                'Removed streaming client %s: %s',
+                self.client_address, str(e))
+        finally:
+            self.output.unsubscribe(subscription)
+            if rate_control:
+                rate_control.remove_client(self.connection)
 
 class StreamingServer(socketserver.ThreadingMixIn, server.HTTPServer):
     allow_reuse_address = True
     daemon_threads = True
 
+def index_page():
+    return PAGE.format(
+        key=base64.b64encode(KEY).decode('utf-8'),
+        nonce=base64.b64encode(NONCE).decode('utf-8')
+    ).encode('utf-8')
+
+def serve_asyncio(output, address):
+    # Same routes as StreamingHandler, every viewer on one event loop
+    app = StreamServer()
+    channel = output.channel = app.channel()
+
+    def stream(request, encoding, status=200, headers=()):
+        original_every = original_every_from_query(request.query)
+        subscription = (encoding, original_every)
+        output.subscribe(subscription)
+        sock = request.transport.get_extra_info('socket')
+        if output.rate_control:
+            output.rate_control.add_client(sock)
+
+        def close():
+            output.unsubscribe(subscription)
+            if output.rate_control:
+                output.rate_control.remove_client(sock)
+
+        return Stream(
+            channel, status, headers,
+            render=lambda frame: frame.payloads.get(
+                (encoding, includes_original(original_every, frame.sequence))),
+            on_close=close)
+
+    def websocket(request):
+        key = request.headers.get('sec-websocket-key')
+        if request.headers.get('upgrade', '').lower() != 'websocket' or not key:
+            return Response(400, b'Expected a WebSocket upgrade', 'text/plain')
+        return stream(request, 'ws', 101, [
+            ('Upgrade', 'websocket'),
+            ('Connection', 'Upgrade'),
+            ('Sec-WebSocket-Accept', websocket_accept(key))])
+
+    app.route('/', lambda request: Response(301, headers=[('Location', '/index.html')]))
+    app.route('/index.html', lambda request: Response(200, index_page(), 'text/html'))
+    app.route('/ws', websocket)
+    app.route('/stream', lambda request: stream(request, 'sse', headers=[
+        ('Cache-Control', 'no-cache'),
+        ('Content-Type', 'text/event-stream')]))
+    app.serve_forever(*address)
+
 output = None
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ChaCha20 encrypted Pi camera stream')
+    parser.add_argument('--no-original', action='store_true',
+                        help='send only the encrypted frames unless a viewer asks for the original')
+    parser.add_argument('--original-every', type=int, metavar='N',
+                        help='send the plaintext original only every Nth frame')
+    parser.add_argument('--target-fps', type=int, default=30,
+                        help='frame rate the rate controller tries to hold')
+    parser.add_argument('--latency-budget', type=float, default=0.25, metavar='SECONDS',
+                        help='most video a client may have queued before quality drops')
+    parser.add_argument('--no-adapt', action='store_true',
+                        help='keep JPEG quality and resolution fixed')
+    parser.add_argument('--asyncio', action='store_true',
+                        help='serve every viewer from one event loop instead of a thread each')
+    args = parser.parse_args()
+    if args.no_original:
+        ORIGINAL_EVERY = 0
+    if args.original_every is not None:
+        ORIGINAL_EVERY = max(0, args.original_every)
+
     # Initialize camera and server
     picam2 = Picamera2()
-    picam2.configure(picam2.create_video_configuration(main={"size": (640, 480)}))
+    picam2.configure(picam2.create_video_configuration(
+        main={"size": (640, 480)},
+        lores={"size": (320, 240)},
+        controls={"FrameRate": args.target_fps}))
     output = StreamingOutput()
-    picam2.start_recording(JpegEncoder(), FileOutput(output))
+    encoder = JpegEncoder(q=90)
+    picam2.start_recording(encoder, FileOutput(output))
+    if not args.no_adapt:
+        output.rate_control = RateController(
+            picam2, encoder, target_fps=args.target_fps, latency_budget=args.latency_budget)
+        output.rate_control.start()
 
     try:
         address = ('', 8000)
-        server = StreamingServer(address, StreamingHandler)
         print(f"Server started at http://localhost:8000")
         print(f"Using key length: {len(KEY)} bytes")
         print(f"Using nonce length: {len(NONCE)} bytes")
-        server.serve_forever()
+        print(f"Frame-keyed nonces: {'on' if FRAME_KEYED else 'off'}")
+        if args.asyncio:
+            serve_asyncio(output, address)
+        else:
+            server = StreamingServer(address, StreamingHandler)
+            server.serve_forever()
     finally:
         picam2.stop_recording()
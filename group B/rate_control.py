@@ -0,0 +1,126 @@
+import fcntl
+import logging
+import struct
+import termios
+import time
+from threading import Lock, Thread
+
+# Unsent bytes in a socket's send queue (Linux TIOCOUTQ, same value as SIOCOUTQ)
+_OUTQ = struct.Struct('i')
+
+def send_queue_bytes(sock):
+    try:
+        return _OUTQ.unpack(fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, bytes(_OUTQ.size)))[0]
+    except OSError:
+        return 0
+
+class RateController:
+    """Adapts JPEG quality and stream resolution to what the viewers can take.
+
+    Every interval it looks at the deepest client send queue (converted to
+    seconds of video) and the encryption time per frame. When either is over
+    budget the JPEG quality is cut, and once quality is at its floor the encoder
+    moves to the lores stream. When everything drains it climbs back up again.
+    Clients whose own queue is over the latency budget skip frames instead of
+    piling up more latency.
+    """
+
+    def __init__(self, picam2, encoder, target_fps=30, latency_budget=0.25,
+                 min_quality=30, max_quality=90, lores=True, interval=1.0):
+        self.picam2 = picam2
+        self.encoder = encoder
+        self.target_fps = target_fps
+        self.latency_budget = latency_budget
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.lores = lores
+        self.interval = interval
+        self.quality = max_quality
+        self.stream = 'main'
+        self.encoder.q = self.quality
+        self.clients = set()
+        self.frame_bytes = 0
+        self._encryption_ms = []
+        self._congested = 0
+        self._clear = 0
+        self._lock = Lock()
+
+    def start(self):
+        Thread(target=self._run, daemon=True).start()
+
+    def add_client(self, sock):
+        with self._lock:
+            self.clients.add(sock)
+
+    def remove_client(self, sock):
+        with self._lock:
+            self.clients.discard(sock)
+
+    def record_frame(self, size):
+        # Called once per encoded frame
+        self.frame_bytes = size if not self.frame_bytes else 0.9 * self.frame_bytes + 0.1 * size
+
+    def record_encryption(self, milliseconds):
+        self._encryption_ms.append(milliseconds)
+
+    def queue_latency(self, sock):
+        # Seconds of video waiting in this client's socket buffer
+        if not self.frame_bytes:
+            return 0.0
+        return send_queue_bytes(sock) / self.frame_bytes / self.target_fps
+
+    def should_send(self, sock):
+        return self.queue_latency(sock) <= self.latency_budget
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.adjust()
+            except Exception as e:
+                logging.warning('Rate control error: %s', str(e))
+
+    def adjust(self):
+        with self._lock:
+            clients = list(self.clients)
+        samples, self._encryption_ms = self._encryption_ms, []
+        if not clients:
+            return
+        latency = max(self.queue_latency(sock) for sock in clients)
+        encryption_ms = sum(samples) / len(samples) if samples else 0.0
+        frame_ms = 1000 / self.target_fps
+
+        if latency > self.latency_budget or encryption_ms > frame_ms / 2:
+            self._clear = 0
+            self._congested += 1
+            if self.quality > self.min_quality:
+                self.set_quality(int(self.quality * 0.75))
+            elif self.lores and self.stream == 'main' and self._congested >= 3:
+                # Quality is already at its floor, drop to a quarter of the pixels
+                self.set_stream('lores')
+                self.set_quality(self.max_quality)
+        elif latency < self.latency_budget / 4 and encryption_ms < frame_ms / 4:
+            self._congested = 0
+            self._clear += 1
+            if self.quality < self.max_quality:
+                self.set_quality(self.quality + 5)
+            elif self.stream == 'lores' and self._clear >= 5:
+                self.set_stream('main')
+                self.set_quality((self.min_quality + self.max_quality) // 2)
+        else:
+            self._congested = self._clear = 0
+
+    def set_quality(self, quality):
+        quality = max(self.min_quality, min(self.max_quality, quality))
+        if quality != self.quality:
+            logging.info('JPEG quality %d -> %d', self.quality, quality)
+            self.quality = quality
+            # JpegEncoder reads q on every frame, so this takes effect immediately
+            self.encoder.q = quality
+
+    def set_stream(self, stream):
+        logging.info('Switching encoder from %s to %s stream', self.stream, stream)
+        self.picam2.stop_encoder(self.encoder)
+        self.picam2.start_encoder(self.encoder, name=stream)
+        self.stream = stream
+        self._congested = self._clear = 0
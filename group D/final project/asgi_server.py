@@ -0,0 +1,458 @@
+"""ASGI deployment of the crypto server, same routes as server_code.py:
+
+    uvicorn asgi_server:app --host 0.0.0.0 --port 5000
+
+The keys, prekey pool, sessions and file store are the ones server_code builds,
+so run either this or the Flask app, not both. Request handling stays on the event
+loop and the CPU-bound crypto goes to bounded thread pools: key exchange always,
+AES-GCM once the payload is past INLINE_CRYPTO_LIMIT (below that a thread hop
+costs more than the cipher). File uploads are raw application/octet-stream bodies
+(what the client proxy sends), fed to the segment encryptor as they arrive.
+"""
+
+import asyncio
+import base64
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from urllib.parse import parse_qs, unquote
+
+from Crypto.Random import get_random_bytes
+from cryptography.exceptions import InvalidTag
+from werkzeug.utils import secure_filename
+
+import server_code as core
+
+# Crypto workers for key exchange, large GCM payloads and batches. Jobs waiting for
+# a worker are capped too, past that requests wait on the loop instead of queueing
+# unbounded work in the executor.
+CRYPTO_WORKERS = int(os.environ.get("CRYPTO_WORKERS", min(32, (os.cpu_count() or 1) + 4)))
+CRYPTO_QUEUE_LIMIT = CRYPTO_WORKERS * 4
+# File uploads hold a worker for as long as the client takes to send the body, so
+# they get their own pool and cannot starve key exchanges
+FILE_WORKERS = int(os.environ.get("FILE_WORKERS", 8))
+INLINE_CRYPTO_LIMIT = 16 * 1024
+MAX_BODY = 16 * 1024 * 1024
+DOWNLOAD_CHUNK = 64 * 1024
+
+crypto_pool = ThreadPoolExecutor(max_workers=CRYPTO_WORKERS, thread_name_prefix="crypto")
+file_pool = ThreadPoolExecutor(max_workers=FILE_WORKERS, thread_name_prefix="file")
+crypto_slots = asyncio.Semaphore(CRYPTO_QUEUE_LIMIT)
+
+async def offload(function, *args):
+    async with crypto_slots:
+        return await asyncio.get_running_loop().run_in_executor(crypto_pool, function, *args)
+
+async def gcm(size, function, *args):
+    """Runs an AES-GCM call inline for small payloads, in the crypto pool for large ones."""
+    if size < INLINE_CRYPTO_LIMIT:
+        return function(*args)
+    return await offload(function, *args)
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class Request:
+    def __init__(self, scope, receive):
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        self.headers = {name.decode("latin-1").lower(): value.decode("latin-1")
+                        for name, value in scope["headers"]}
+        self.mimetype = self.headers.get("content-type", "").split(";")[0].strip().lower()
+        self.receive = receive
+        self.loop = asyncio.get_running_loop()
+        scheme = scope.get("scheme", "http")
+        host = self.headers.get("host") or "%s:%d" % tuple(scope.get("server") or ("localhost", 80))
+        self.host_url = f"{scheme}://{host}/"
+        self.start_time = time.perf_counter()
+
+    async def body(self, limit=MAX_BODY):
+        chunks = []
+        size = 0
+        more = True
+        while more:
+            message = await self.receive()
+            if message["type"] == "http.disconnect":
+                raise ConnectionError("Client disconnected")
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > limit:
+                raise HTTPError(413, "Request body too large")
+            chunks.append(chunk)
+            more = message.get("more_body", False)
+        return b"".join(chunks)
+
+    async def json(self):
+        try:
+            return json.loads(await self.body() or b"null") or {}
+        except ValueError:
+            raise HTTPError(400, "Invalid JSON body")
+
+    def stream(self):
+        return BodyReader(self.receive, self.loop)
+
+class BodyReader:
+    """Blocking file-like view of the request body for a worker thread.
+
+    Each read pulls the next ASGI body message through the event loop, so the
+    upload is consumed only as fast as the worker encrypts it and never buffered
+    whole.
+    """
+
+    def __init__(self, receive, loop):
+        self.receive = receive
+        self.loop = loop
+        self.buffer = bytearray()
+        self.more = True
+
+    def _next_chunk(self):
+        message = asyncio.run_coroutine_threadsafe(self.receive(), self.loop).result()
+        if message["type"] == "http.disconnect":
+            raise ConnectionError("Client disconnected during upload")
+        self.more = message.get("more_body", False)
+        return message.get("body", b"")
+
+    def read(self, size=-1):
+        while self.more and (size < 0 or len(self.buffer) < size):
+            self.buffer += self._next_chunk()
+        if size < 0 or size > len(self.buffer):
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+class Response:
+    def __init__(self, status=200, body=b"", content_type="application/json", headers=None):
+        self.status = status
+        self.body = body
+        self.headers = list(headers or [])
+        if content_type:
+            self.headers.append(("content-type", content_type))
+
+    async def send(self, send):
+        await send({"type": "http.response.start", "status": self.status,
+                    "headers": self.encoded_headers() + [(b"content-length", str(len(self.body)).encode())]})
+        await send({"type": "http.response.body", "body": self.body})
+
+    def encoded_headers(self):
+        return [(name.encode("latin-1"), str(value).encode("latin-1")) for name, value in self.headers]
+
+class FileResponse(Response):
+    """Streams a stored file in DOWNLOAD_CHUNK reads, optionally one byte range of it."""
+
+    def __init__(self, path, start, end, status, headers):
+        super().__init__(status, b"", "application/octet-stream", headers)
+        self.path = path
+        self.start = start
+        self.end = end  # exclusive
+
+    async def send(self, send):
+        loop = asyncio.get_running_loop()
+        await send({"type": "http.response.start", "status": self.status,
+                    "headers": self.encoded_headers() + [(b"content-length", str(self.end - self.start).encode())]})
+        with open(self.path, "rb") as file:
+            file.seek(self.start)
+            remaining = self.end - self.start
+            while remaining:
+                chunk = await loop.run_in_executor(file_pool, file.read, min(DOWNLOAD_CHUNK, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+def json_response(data, status=200):
+    return Response(status, json.dumps(data).encode())
+
+def error_response(message, status):
+    return json_response({"error": message}, status)
+
+def decode_session_key(session_key):
+    """Decodes a base64 session key, returns (key, None) or (None, error response)."""
+    try:
+        key = base64.b64decode(session_key)
+    except ValueError:
+        return None, error_response("Invalid session key encoding", 400)
+    if len(key) != 32:
+        return None, error_response(f"Incorrect AES key length ({len(key)} bytes).", 400)
+    return key, None
+
+def elapsed_ms(request):
+    return round((time.perf_counter() - request.start_time) * 1000, 2)
+
+async def welcome(request):
+    return json_response("Welcome")
+
+async def prekey_bundle(request):
+    binary = core.wants_binary_bundle(request.query.get("format", [None])[0],
+                                      request.headers.get("accept", ""))
+    body, etag = core.bundle_cache.get(binary)
+    headers = [("etag", f'"{etag}"'), ("cache-control", "no-cache"), ("vary", "Accept")]
+    if f'"{etag}"' in request.headers.get("if-none-match", ""):
+        return Response(304, b"", None, headers)
+    return Response(200, body, "application/octet-stream" if binary else "application/json", headers)
+
+async def prekey_pool(request):
+    return json_response(core.prekeys.stats())
+
+async def key_exchange(request):
+    data = await request.json()
+    try:
+        return json_response(await offload(core.exchange_keys, data["client_long_term_key"],
+                                           data["client_ephemeral_key"]))
+    except Exception as e:
+        return error_response(str(e), 500)
+
+async def session_key_registry(request):
+    return json_response({
+        "active_sessions": len(core.sessions),
+        "max_sessions": core.sessions.max_sessions,
+        "ttl_seconds": core.sessions.ttl
+    })
+
+async def encrypt(request):
+    data = await request.json()
+    plaintext = data.get("plaintext")
+    session_key = data.get("session_key")
+    if not plaintext:
+        return error_response("No plaintext provided", 400)
+    if not session_key:
+        return error_response("No session key provided", 400)
+    key, error = decode_session_key(session_key)
+    if error:
+        return error
+
+    aesgcm = core.session_cipher(data.get("session_id"), key)
+    nonce = get_random_bytes(12)
+    payload = plaintext.encode()
+    sealed = await gcm(len(payload), aesgcm.encrypt, nonce, payload, None)
+    return json_response({
+        "ciphertext": base64.b64encode(sealed[:-16]).decode(),
+        "nonce": base64.b64encode(nonce).decode(),
+        "tag": base64.b64encode(sealed[-16:]).decode(),
+        "encryption_time_ms": elapsed_ms(request),
+        # tracemalloc cannot tell concurrent tasks apart, memory is Flask-only
+        "current_memory_kb": "N/A",
+        "peak_memory_kb": "N/A"
+    })
+
+async def decrypt(request):
+    data = await request.json()
+    try:
+        ciphertext = base64.b64decode(data.get("ciphertext") or "")
+        nonce = base64.b64decode(data.get("nonce") or "")
+        tag = base64.b64decode(data.get("tag") or "")
+    except ValueError as e:
+        return error_response(str(e), 400)
+    session_key = data.get("session_key")
+    if not ciphertext or not nonce or not tag or not session_key:
+        return error_response("Missing required fields", 400)
+    key, error = decode_session_key(session_key)
+    if error:
+        return error
+
+    session = core.lookup_session(data.get("session_id"), session_key)
+    if session is None or session.key != key:
+        return error_response("Invalid session key provided.", 400)
+    try:
+        plaintext = await gcm(len(ciphertext), session.aesgcm.decrypt, nonce, ciphertext + tag, None)
+    except InvalidTag:
+        return error_response("Decryption failed: MAC check failed", 400)
+    return json_response({
+        "plaintext": plaintext.decode(),
+        "decryption_time_ms": elapsed_ms(request),
+        "current_memory_kb": "N/A",
+        "peak_memory_kb": "N/A"
+    })
+
+async def batch(request, seal):
+    if request.mimetype == "application/octet-stream":
+        binary = True
+        session_id = request.headers.get("x-session-id")
+        session_key = request.headers.get("x-session-key")
+        items = core.read_records(await request.body())
+    else:
+        binary = False
+        session_id, session_key, items = core.json_batch(await request.json())
+    aesgcm = core.batch_cipher(session_id, session_key, require_session=not seal)
+    # A batch is one job, the items share the worker and the cipher context
+    results = await offload(core.seal_batch if seal else core.open_batch, aesgcm, binary, items)
+    if binary:
+        return Response(200, core.pack_results(results), "application/octet-stream")
+    timing = "encryption_time_ms" if seal else "decryption_time_ms"
+    return json_response({"items": results, timing: elapsed_ms(request)})
+
+async def encrypt_batch(request):
+    try:
+        return await batch(request, seal=True)
+    except ValueError as e:
+        return error_response(str(e), 400)
+
+async def decrypt_batch(request):
+    try:
+        return await batch(request, seal=False)
+    except ValueError as e:
+        return error_response(str(e), 400)
+
+def file_upload(request):
+    """(session key, filename) for a raw upload, or an error response."""
+    if request.mimetype != "application/octet-stream":
+        return None, None, error_response("Send the file as application/octet-stream", 415)
+    key, error = decode_session_key(request.headers.get("x-session-key") or "")
+    if error:
+        return None, None, error
+    filename = secure_filename(unquote(request.headers.get("x-filename", ""))) or "upload"
+    return key, filename, None
+
+async def run_file_job(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(file_pool, function, *args)
+
+async def encrypt_file(request):
+    key, filename, error = file_upload(request)
+    if error:
+        return error
+    encrypted_file_name, digest, container = await run_file_job(
+        core.store_encrypted, key, filename, request.stream())
+    return json_response({
+        "message": "File encrypted successfully",
+        "encrypted_file_name": encrypted_file_name,
+        "encrypted_file_url": core.download_url(digest, encrypted_file_name, request.host_url),
+        "nonce": container["nonce"],
+        "tag": container["tag"],
+        "segments": container["segments"],
+        "segment_size": core.SEGMENT_SIZE,
+        "encryption_time_ms": elapsed_ms(request),
+        "current_memory_kb": "N/A",
+        "peak_memory_kb": "N/A"
+    })
+
+async def decrypt_file(request):
+    key, filename, error = file_upload(request)
+    if error:
+        return error
+    try:
+        decrypted_filename, digest = await run_file_job(
+            core.store_decrypted, key, filename, request.stream(),
+            request.headers.get("x-nonce"), request.headers.get("x-tag"))
+    except ValueError as decryption_error:
+        return error_response(f"Decryption failed: {str(decryption_error)}", 400)
+    return json_response({
+        "message": "File decrypted successfully",
+        "decrypted_file": decrypted_filename,
+        "download_url": core.download_url(digest, decrypted_filename, request.host_url),
+        "encryption_time_ms": elapsed_ms(request),
+        "current_memory_kb": "N/A",
+        "peak_memory_kb": "N/A"
+    })
+
+def byte_range(header, size):
+    """(start, end) for a single "bytes=" range, None when absent or not satisfiable."""
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            start, end = max(0, size - int(last)), size
+        else:
+            start = int(first)
+            end = min(size, int(last) + 1) if last else size
+    except ValueError:
+        return None
+    return (start, end) if start < end else None
+
+async def download(request, digest):
+    stored = core.file_store.get(digest) if core.DIGEST_PATTERN.match(digest) else None
+    if stored is None or not os.path.exists(stored[0]):
+        return error_response("File not found", 404)
+    file_path, stored_name = stored
+    name = secure_filename(request.query.get("name", [""])[0]) or stored_name
+    stat = os.stat(file_path)
+    etag = f'"{digest}"'
+    headers = [
+        ("content-disposition", f'attachment; filename="{name}"'),
+        ("etag", etag),
+        ("last-modified", formatdate(stat.st_mtime, usegmt=True)),
+        ("accept-ranges", "bytes"),
+    ]
+    # Stored files never change under a digest, so the ETag alone decides
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(304, b"", None, headers)
+    start, end, status = 0, stat.st_size, 200
+    if "range" in request.headers and request.headers.get("if-range", etag) == etag:
+        span = byte_range(request.headers["range"], stat.st_size)
+        if span is None:
+            return Response(416, b"", None, [("content-range", f"bytes */{stat.st_size}")])
+        start, end = span
+        status = 206
+        headers.append(("content-range", f"bytes {start}-{end - 1}/{stat.st_size}"))
+    return FileResponse(file_path, start, end, status, headers)
+
+async def metrics(request):
+    return Response(200, core.render_metrics().encode(), "text/plain; version=0.0.4")
+
+# (method, path) -> handler, the path doubles as the metrics endpoint label
+ROUTES = {
+    ("GET", "/"): welcome,
+    ("GET", "/prekey_bundle"): prekey_bundle,
+    ("GET", "/prekey_pool"): prekey_pool,
+    ("POST", "/key_exchange"): key_exchange,
+    ("GET", "/session_key_registry"): session_key_registry,
+    ("POST", "/encrypt"): encrypt,
+    ("POST", "/decrypt"): decrypt,
+    ("POST", "/encrypt_batch"): encrypt_batch,
+    ("POST", "/decrypt_batch"): decrypt_batch,
+    ("POST", "/encrypt_file"): encrypt_file,
+    ("POST", "/decrypt_file"): decrypt_file,
+    ("GET", "/metrics"): metrics,
+}
+
+async def dispatch(request):
+    """Returns (response, metrics endpoint label)."""
+    if request.path.startswith("/download/") and request.method == "GET":
+        return await download(request, request.path[len("/download/"):]), "/download/<filename>"
+    handler = ROUTES.get((request.method, request.path))
+    if handler is None:
+        if any(path == request.path for _, path in ROUTES):
+            return error_response("Method not allowed", 405), request.path
+        return error_response("Not found", 404), "unmatched"
+    return await handler(request), request.path
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                crypto_pool.shutdown(wait=False)
+                file_pool.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    request = Request(scope, receive)
+    endpoint = "unmatched"
+    try:
+        response, endpoint = await dispatch(request)
+    except HTTPError as e:
+        response = error_response(str(e), e.status)
+    except ConnectionError:
+        return
+    except Exception as e:
+        print(f"Error handling {request.path}: {str(e)}")
+        response = error_response(str(e), 500)
+    await response.send(send)
+    with core.metrics_lock:
+        core.request_latency.observe(
+            (endpoint, request.method, str(response.status)), time.perf_counter() - request.start_time)
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=5000)
@@ -1,10 +1,18 @@
 from flask import Flask, render_template, request, jsonify, session
 from flask_session import Session
 from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric.ec import EllipticCurvePublicKey
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+from cryptography.exceptions import InvalidSignature
 from hashlib import sha256
+from threading import Lock
+from urllib.parse import quote, unquote
+import struct
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 app = Flask(__name__)
 
@@ -19,6 +27,126 @@ Session(app)
 # Store client long-term private key
 CLIENT_LONG_TERM_PRIVATE_KEY = ec.generate_private_key(ec.SECP256R1())
 
+# One pooled keep-alive session for every call to the server. Idempotent requests
+# are retried on connection errors and 502/503/504, POSTs only when the connection
+# could not be made at all (nothing was sent).
+http = requests.Session()
+http.mount(SERVER_URL, HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, connect=3, read=2, status=2, backoff_factor=0.2,
+                      status_forcelist=(502, 503, 504), allowed_methods=frozenset(["GET"]))
+))
+REQUEST_TIMEOUT = (3.05, 60)  # connect, read
+
+# The pre-key bundle changes rarely, keep a verified copy for this long before
+# revalidating it with a conditional GET
+PREKEY_BUNDLE_TTL = 300
+
+# Binary bundle layout, as served by /prekey_bundle?format=binary: magic, long-term
+# key point, signed pre-key point, signature r and s, one-time key count, then the
+# one-time key points. Points are 65-byte uncompressed P-256 points.
+BINARY_BUNDLE_HEADER = struct.Struct(">4s65s65s32s32sH")
+BINARY_BUNDLE_MAGIC = b"PKB1"
+POINT_SIZE = 65
+
+_bundle_cache = {"bundle": None, "etag": None, "expires": 0}
+_bundle_lock = Lock()
+
+def parse_prekey_bundle(body):
+    """Parses and verifies a binary bundle: the long-term key's ECDSA-SHA256 signature
+    over the signed pre-key point. Returns (bundle, long-term key, signed pre-key), the
+    bundle with hex-encoded points."""
+    if len(body) < BINARY_BUNDLE_HEADER.size:
+        raise ValueError("Truncated pre-key bundle")
+    magic, long_term_point, signed_pre_key_point, r, s, count = BINARY_BUNDLE_HEADER.unpack_from(body)
+    if magic != BINARY_BUNDLE_MAGIC or len(body) != BINARY_BUNDLE_HEADER.size + count * POINT_SIZE:
+        raise ValueError("Malformed pre-key bundle")
+    long_term_key = EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(), long_term_point)
+    signed_pre_key = EllipticCurvePublicKey.from_encoded_point(ec.SECP256R1(), signed_pre_key_point)
+    signature = encode_dss_signature(int.from_bytes(r, "big"), int.from_bytes(s, "big"))
+    long_term_key.verify(signature, signed_pre_key_point, ec.ECDSA(hashes.SHA256()))
+    one_time_keys = body[BINARY_BUNDLE_HEADER.size:]
+    bundle = {
+        "long_term_public_key": long_term_point.hex(),
+        "signed_pre_key": signed_pre_key_point.hex(),
+        "signature": signature.hex(),
+        "one_time_keys": [one_time_keys[i:i + POINT_SIZE].hex()
+                          for i in range(0, len(one_time_keys), POINT_SIZE)]
+    }
+    return bundle, long_term_key, signed_pre_key
+
+def get_prekey_bundle(refresh=False):
+    """Returns (bundle, long-term key, signed pre-key). The cached copy is used until it
+    expires, then revalidated by ETag, so an unchanged bundle costs a 304 and no parsing."""
+    with _bundle_lock:
+        cached = _bundle_cache["bundle"]
+        if refresh or cached is None or _bundle_cache["expires"] <= time.monotonic():
+            headers = {"Accept": "application/octet-stream"}
+            if cached is not None and not refresh and _bundle_cache["etag"]:
+                headers["If-None-Match"] = _bundle_cache["etag"]
+            response = http.get(f"{SERVER_URL}/prekey_bundle", params={"format": "binary"},
+                                headers=headers, timeout=REQUEST_TIMEOUT)
+            if response.status_code != 304:
+                response.raise_for_status()
+                cached = parse_prekey_bundle(response.content)
+                _bundle_cache["bundle"] = cached
+                _bundle_cache["etag"] = response.headers.get("ETag")
+            _bundle_cache["expires"] = time.monotonic() + PREKEY_BUNDLE_TTL
+        return cached
+
+def invalidate_prekey_bundle():
+    # The next call refetches in full, a restarted server keeps no ETags to match
+    with _bundle_lock:
+        _bundle_cache["expires"] = 0
+        _bundle_cache["etag"] = None
+
+# Uploads are forwarded to the server as a raw application/octet-stream body, read
+# from the browser and written upstream UPLOAD_CHUNK_SIZE bytes at a time
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+class UploadStream:
+    """File-like body of known length, so requests sends it with a Content-Length
+    and reads it block by block instead of building the body in memory."""
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+def upload_body():
+    """Returns (filename, body) for the current upload, or (None, None).
+
+    Raw uploads (the file pages send the file itself with an X-Filename header)
+    start going upstream before the browser has finished sending. Multipart
+    uploads have already been spooled to disk by Werkzeug and are sent from there."""
+    if request.mimetype == "application/octet-stream":
+        filename = unquote(request.headers.get("X-Filename", ""))
+        if request.content_length is not None:
+            return filename, UploadStream(request.stream, request.content_length)
+        # No length from the browser: chunked transfer encoding upstream
+        return filename, iter(lambda: request.stream.read(UPLOAD_CHUNK_SIZE), b"")
+    uploaded_file = request.files.get("file")
+    if not uploaded_file:
+        return None, None
+    stream = uploaded_file.stream
+    stream.seek(0, 2)
+    length = stream.tell()
+    stream.seek(0)
+    return uploaded_file.filename, UploadStream(stream, length)
+
+def forward_upload(path, filename, body, headers):
+    headers = dict(headers, **{
+        "Content-Type": "application/octet-stream",
+        "X-Filename": quote(filename or "")
+    })
+    return http.post(f"{SERVER_URL}{path}", data=body, headers=headers, timeout=REQUEST_TIMEOUT)
+
 # Helper function to serialize public keys
 def serialize_key(public_key):
     return public_key.public_bytes(
@@ -29,11 +157,13 @@ def serialize_key(public_key):
 # Route: Fetch and display the server pre-key bundle
 @app.route("/prekey_bundle", methods=["GET"])
 def fetch_prekey_bundle():
-    response = requests.get(f"{SERVER_URL}/prekey_bundle")
-    if response.status_code == 200:
-        return jsonify(response.json())
-    else:
-        return jsonify({"error": "Failed to fetch pre-key bundle"}), response.status_code
+    try:
+        bundle, _, _ = get_prekey_bundle()
+    except requests.HTTPError as e:
+        return jsonify({"error": "Failed to fetch pre-key bundle"}), e.response.status_code
+    except (requests.RequestException, InvalidSignature, KeyError, ValueError):
+        return jsonify({"error": "Failed to fetch pre-key bundle"}), 502
+    return jsonify(bundle)
 
 # Route: Perform X3DH and derive session key
 import base64
@@ -41,19 +171,15 @@ from hashlib import sha256
 
 @app.route("/key_exchange", methods=["POST"])
 def key_exchange():
-    # Fetch the pre-key bundle from the server
-    response = requests.get(f"{SERVER_URL}/prekey_bundle")
-    if response.status_code != 200:
-        return jsonify({"error": "Failed to fetch pre-key bundle"}), response.status_code
-
-    pre_key_bundle = response.json()
-
-    # Load server keys from pre-key bundle
-    server_long_term_key = serialization.load_pem_public_key(pre_key_bundle["long_term_public_key"].encode())
-    server_signed_pre_key = serialization.load_pem_public_key(pre_key_bundle["signed_pre_key"].encode())
-
-    # Debugging: Log the one-time key received from the server
-    print("Client - One-Time Key Public (PEM):", pre_key_bundle["one_time_keys"][0])
+    # Cached, signature-checked pre-key bundle with the server keys already loaded
+    try:
+        pre_key_bundle, server_long_term_key, server_signed_pre_key = get_prekey_bundle()
+    except requests.HTTPError as e:
+        return jsonify({"error": "Failed to fetch pre-key bundle"}), e.response.status_code
+    except InvalidSignature:
+        return jsonify({"error": "Pre-key bundle signature does not verify"}), 502
+    except (requests.RequestException, KeyError, ValueError):
+        return jsonify({"error": "Failed to fetch pre-key bundle"}), 502
 
     # Generate client ephemeral key pair
     client_ephemeral_private = ec.generate_private_key(ec.SECP256R1())
@@ -71,9 +197,11 @@ def key_exchange():
         "client_long_term_key": serialize_key(CLIENT_LONG_TERM_PRIVATE_KEY.public_key()),
         "client_ephemeral_key": serialize_key(client_ephemeral_public),
     }
-    response = requests.post(f"{SERVER_URL}/key_exchange", json=payload)
+    response = http.post(f"{SERVER_URL}/key_exchange", json=payload, timeout=REQUEST_TIMEOUT)
 
     if response.status_code != 200:
+        # The server may have restarted with new keys, fetch a fresh bundle next time
+        invalidate_prekey_bundle()
         return jsonify({"error": "Key exchange failed"}), response.status_code
 
     # Extract the one-time key and session key from the server's response
@@ -106,6 +234,8 @@ def key_exchange():
 
     if computed_session_key_base64 != session_key_base64:
         print("Warning: Computed session key does not match the server-provided session key!")
+        # Most likely a cached bundle from before a server restart
+        invalidate_prekey_bundle()
 
     # Store the session key in the Flask session
     session["session_key"] = session_key_base64
@@ -147,7 +277,7 @@ def encrypt():
     print("Payload Sent to Server:", payload)  # Debug print
 
     # Forward the payload to the server for encryption
-    response = requests.post(f"{SERVER_URL}/encrypt", json=payload)
+    response = http.post(f"{SERVER_URL}/encrypt", json=payload, timeout=REQUEST_TIMEOUT)
 
     # Extract the server response
     server_response = response.json()
@@ -203,7 +333,7 @@ def decrypt():
     print("Payload Sent to Server for Decryption:", payload)
 
     # Forward the payload to the backend decryption server
-    response = requests.post(f"{SERVER_URL}/decrypt", json=payload)
+    response = http.post(f"{SERVER_URL}/decrypt", json=payload, timeout=REQUEST_TIMEOUT)
 
     # Extract the server response
     server_response = response.json()
@@ -244,7 +374,7 @@ def client_upload():
 
     # Forward the file to the server
     files = {'file': (file.filename, file.stream, file.mimetype)}
-    response = requests.post(f"{SERVER_URL}/upload", files=files)
+    response = http.post(f"{SERVER_URL}/upload", files=files, timeout=REQUEST_TIMEOUT)
 
     # Return the server's response to the client
     return jsonify(response.json()), response.status_code  
@@ -260,20 +390,12 @@ def encrypt_file():
             return jsonify({"error": "Session key not established. Perform key exchange first."}), 400
 
         # Check if a file was uploaded in the request
-        uploaded_file = request.files.get("file")
-        if not uploaded_file:
+        filename, body = upload_body()
+        if body is None:
             return jsonify({"error": "No file uploaded"}), 400
 
-        # Send the file and session key to the server for encryption
-        files = {
-            "file": (uploaded_file.filename, uploaded_file.stream, uploaded_file.mimetype)
-        }
-        data = {
-            "session_key": session_key_base64  # Include the session key in the payload
-        }
-
-        # Make a POST request to the server-side encryption route
-        response = requests.post(f"{SERVER_URL}/encrypt_file", files=files, data=data)
+        # Stream the file to the server-side encryption route, session key in a header
+        response = forward_upload("/encrypt_file", filename, body, {"X-Session-Key": session_key_base64})
         server_response = response.json()
 
         # If the server returned an error, pass it back to the client
@@ -308,32 +430,27 @@ def file_decrypt_page():
 @app.route("/decrypt_file", methods=["POST"])
 def decrypt_file():
     try:
-        # Retrieve the session key from the form
-        session_key = request.form.get("session_key")
-        nonce = request.form.get("nonce")
-        tag = request.form.get("tag")
-        encrypted_file = request.files.get("file")
-
-        print("session key retrieved:", session_key)
-        print("nonce retrieved:", nonce)
-        print("tag retrieved:", tag)
-        print("encrypted file retrieved", encrypted_file)
-
-        if not session_key or not nonce or not tag or not encrypted_file:
+        # Retrieve the session key, nonce and tag from the headers of a raw upload or the form
+        if request.mimetype == "application/octet-stream":
+            fields = request.headers
+            session_key = fields.get("X-Session-Key")
+            nonce = fields.get("X-Nonce")
+            tag = fields.get("X-Tag")
+        else:
+            session_key = request.form.get("session_key")
+            nonce = request.form.get("nonce")
+            tag = request.form.get("tag")
+        filename, body = upload_body()
+
+        if not session_key or not nonce or not tag or body is None:
             return jsonify({"error": "Missing required decryption parameters."}), 400
 
-        # Prepare the file and data payload for the server
-        files = {
-            "file": (encrypted_file.filename, encrypted_file.stream, encrypted_file.mimetype)
-        }
-        data = {
-            "session_key": session_key,
-            "nonce": nonce,
-            "tag": tag
-        }
-
-        # Send the decryption request to the server
-        response = requests.post(f"{SERVER_URL}/decrypt_file", files=files, data=data)
+        # Stream the file to the server, the parameters travel as headers
+        response = forward_upload("/decrypt_file", filename, body, {
+            "X-Session-Key": session_key,
+            "X-Nonce": nonce,
+            "X-Tag": tag
+        })
         server_response = response.json()
 
         # If the server returned an error, propagate it back to the client
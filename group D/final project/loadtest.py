@@ -0,0 +1,162 @@
+"""Latency under concurrency for the crypto server, Flask or ASGI.
+
+    python server_code.py                                   # Flask dev server
+    uvicorn asgi_server:app --port 5000                     # or the ASGI app
+    python loadtest.py --endpoint encrypt --payload 65536
+
+Each client is a thread with its own keep-alive connection that sends requests
+back to back. For every concurrency level the run prints throughput and the
+p50/p99 latency over all requests.
+"""
+
+import argparse
+import base64
+import http.client
+import json
+import math
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+def pem(private_key):
+    return private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode()
+
+def percentile(sorted_values, fraction):
+    # Nearest rank
+    if not sorted_values:
+        return float("nan")
+    index = math.ceil(fraction * len(sorted_values)) - 1
+    return sorted_values[max(0, min(len(sorted_values) - 1, index))]
+
+class Client:
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=60)
+
+    def post(self, path, payload):
+        self.connection.request("POST", path, json.dumps(payload),
+                                {"Content-Type": "application/json"})
+        response = self.connection.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise RuntimeError(f"{path} returned {response.status}: {body[:200]!r}")
+        return json.loads(body)
+
+    def close(self):
+        self.connection.close()
+
+def make_request(endpoint, payload_size, session):
+    """Returns (path, body) for one request of the chosen kind."""
+    if endpoint == "key_exchange":
+        # A fresh ephemeral key each time costs the client too, one per run is enough
+        return "/key_exchange", {
+            "client_long_term_key": session["long_term_key"],
+            "client_ephemeral_key": session["ephemeral_key"]
+        }
+    if endpoint == "encrypt":
+        return "/encrypt", {
+            "plaintext": "x" * payload_size,
+            "session_id": session["session_id"],
+            "session_key": session["session_key"]
+        }
+    return "/decrypt", dict(session["sealed"], session_id=session["session_id"],
+                            session_key=session["session_key"])
+
+def setup(url, payload_size):
+    long_term_key = pem(ec.generate_private_key(ec.SECP256R1()))
+    ephemeral_key = pem(ec.generate_private_key(ec.SECP256R1()))
+    client = Client(url)
+    try:
+        session = client.post("/key_exchange", {
+            "client_long_term_key": long_term_key,
+            "client_ephemeral_key": ephemeral_key
+        })
+        session.update(long_term_key=long_term_key, ephemeral_key=ephemeral_key)
+        sealed = client.post("/encrypt", {
+            "plaintext": base64.b64encode(os.urandom(payload_size)).decode()[:payload_size],
+            "session_id": session["session_id"],
+            "session_key": session["session_key"]
+        })
+        session["sealed"] = {name: sealed[name] for name in ("ciphertext", "nonce", "tag")}
+    finally:
+        client.close()
+    return session
+
+def run_level(url, endpoint, payload_size, session, concurrency, requests_per_client):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    start = threading.Barrier(concurrency + 1)
+    path, payload = make_request(endpoint, payload_size, session)
+
+    def worker():
+        client = Client(url)
+        own = []
+        start.wait()
+        for _ in range(requests_per_client):
+            began = time.perf_counter()
+            try:
+                client.post(path, payload)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                client.close()
+                client = Client(url)
+                continue
+            own.append(time.perf_counter() - began)
+        client.close()
+        with lock:
+            latencies.extend(own)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    began = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - began
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "throughput": len(latencies) / wall if wall else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "first_error": errors[0] if errors else ""
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the crypto server")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--endpoint", choices=("encrypt", "decrypt", "key_exchange"), default="encrypt")
+    parser.add_argument("--payload", type=int, default=1024, help="plaintext bytes for encrypt/decrypt")
+    parser.add_argument("--concurrency", default="1,10,100", help="comma-separated client counts")
+    parser.add_argument("--requests", type=int, default=200, help="requests per client")
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines")
+    args = parser.parse_args()
+
+    session = setup(args.url, args.payload)
+    if not args.json:
+        print(f"{args.endpoint} at {args.url}, {args.payload} byte payload, {args.requests} requests per client")
+        print(f"{'clients':>8} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for concurrency in (int(level) for level in args.concurrency.split(",")):
+        result = run_level(args.url, args.endpoint, args.payload, session, concurrency, args.requests)
+        if args.json:
+            print(json.dumps(dict(result, endpoint=args.endpoint, payload=args.payload)))
+            continue
+        print(f"{result['concurrency']:>8} {result['requests']:>9} {result['errors']:>7} "
+              f"{result['throughput']:>9.1f} {result['p50_ms']:>9.2f} {result['p99_ms']:>9.2f}")
+        if result["first_error"]:
+            print(f"         first error: {result['first_error']}")
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,124 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_file, g
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
 import base64
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed, decode_dss_signature
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.exceptions import InvalidTag
+from collections import OrderedDict, deque
+from hashlib import sha256
+from urllib.parse import quote, unquote
+import heapq
+import json
 import os
+import re
+import random
+import struct
 import time 
-from threading import Timer
+from threading import Condition, Event, Lock, Thread
 import tracemalloc
+from werkzeug.utils import secure_filename
 
 app = Flask(__name__)
 
+# Request metrics: a latency histogram for every request, memory tracing
+# (tracemalloc) only for a sampled fraction of requests, one at a time.
+# METRICS_MEMORY_SAMPLE_RATE=0 turns memory sampling off entirely.
+METRICS_MEMORY_SAMPLE_RATE = float(os.environ.get("METRICS_MEMORY_SAMPLE_RATE", "0.01"))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+MEMORY_BUCKETS = tuple(1024 * kb for kb in (16, 64, 256, 1024, 4096, 16384, 65536, 262144))
+
+class Histogram:
+    """Cumulative Prometheus-style histogram, one series per label tuple."""
+
+    def __init__(self, name, help_text, labels, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, label_values, value):
+        counts = self.series.get(label_values)
+        if counts is None:
+            # One slot per bucket, then +Inf, sum
+            counts = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-2] += 1
+        counts[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, counts in self.series.items():
+            labels = ",".join(f'{name}="{value}"' for name, value in zip(self.labels, label_values))
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {counts[-2]}')
+            lines.append(f"{self.name}_sum{{{labels}}} {counts[-1]}")
+            lines.append(f"{self.name}_count{{{labels}}} {counts[-2]}")
+        return lines
+
+metrics_lock = Lock()
+request_latency = Histogram(
+    "crypto_request_duration_seconds", "Request handling time.",
+    ("endpoint", "method", "status"), LATENCY_BUCKETS)
+request_memory = Histogram(
+    "crypto_request_peak_memory_bytes", "Peak traced memory of sampled requests.",
+    ("endpoint",), MEMORY_BUCKETS)
+# tracemalloc is process-wide, so only one request is traced at any time
+tracing_lock = Lock()
+
+def metrics_endpoint():
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+@app.before_request
+def start_request_metrics():
+    g.start_time = time.perf_counter()
+    g.traced = False
+    if METRICS_MEMORY_SAMPLE_RATE > 0 and random.random() < METRICS_MEMORY_SAMPLE_RATE \
+            and tracing_lock.acquire(blocking=False):
+        tracemalloc.start()
+        g.traced = True
+
+@app.after_request
+def record_request_metrics(response):
+    elapsed = time.perf_counter() - g.start_time
+    peak = stop_tracing()
+    endpoint = metrics_endpoint()
+    with metrics_lock:
+        request_latency.observe((endpoint, request.method, str(response.status_code)), elapsed)
+        if peak is not None:
+            request_memory.observe((endpoint,), peak)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(error=None):
+    # after_request is skipped on unhandled errors, tracing must still stop
+    stop_tracing()
+
+def stop_tracing():
+    if not g.get("traced"):
+        return None
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    g.traced = False
+    tracing_lock.release()
+    return peak
+
+def memory_kb():
+    """(current, peak) traced memory in KB so far if this request is sampled, else N/A."""
+    if not g.get("traced"):
+        return "N/A", "N/A"
+    current, peak = tracemalloc.get_traced_memory()
+    return round(current / 1024, 2), round(peak / 1024, 2)
+
+def elapsed_ms():
+    return round((time.perf_counter() - g.start_time) * 1000, 2)
+
 # Generate long-term key
 long_term_private_key = ec.generate_private_key(ec.SECP256R1())
 long_term_public_key = long_term_private_key.public_key()
@@ -37,8 +144,85 @@ signature = long_term_private_key.sign(
     ec.ECDSA(hashes.SHA256()))
 
 
-# Generate a batch of one-time keys
-one_time_keys = [ec.generate_private_key(ec.SECP256R1()) for _ in range(10)]
+# One-time prekeys are topped back up to the high watermark whenever the pool
+# falls under the low one, by a worker thread instead of the handshake itself
+PREKEY_LOW_WATERMARK = 20
+PREKEY_HIGH_WATERMARK = 100
+# How many one-time public keys the pre-key bundle advertises
+PREKEY_BUNDLE_SIZE = 10
+
+def raw_point(public_key):
+    """65-byte uncompressed SEC1 point, what the binary bundle carries instead of PEM."""
+    return public_key.public_bytes(
+        encoding=serialization.Encoding.X962,
+        format=serialization.PublicFormat.UncompressedPoint)
+
+def generate_prekey():
+    """(private key, public PEM, public raw point), serialized once when generated."""
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    public_pem = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode()
+    return private_key, public_pem, raw_point(private_key.public_key())
+
+class PrekeyPool:
+    """One-time prekeys in a deque, refilled between watermarks by a worker thread.
+
+    take() is a popleft, so it never waits on key generation unless the pool has
+    been drained faster than the worker can refill it. Then it generates one
+    inline and counts a miss rather than failing the handshake.
+    """
+
+    def __init__(self, low=PREKEY_LOW_WATERMARK, high=PREKEY_HIGH_WATERMARK):
+        self.low = low
+        self.high = high
+        self.keys = deque(generate_prekey() for _ in range(low))
+        self.generated = low
+        self.served = 0
+        self.misses = 0
+        # Bumped whenever the front of the pool, the keys a bundle advertises, may have changed
+        self.version = 0
+        self.refill_needed = Event()
+        self.refill_needed.set()
+        Thread(target=self._refill, daemon=True).start()
+
+    def take(self):
+        try:
+            prekey = self.keys.popleft()
+        except IndexError:
+            self.misses += 1
+            prekey = generate_prekey()
+        self.served += 1
+        self.version += 1
+        if len(self.keys) < self.low:
+            self.refill_needed.set()
+        return prekey
+
+    def public_keys(self, count):
+        """(PEM, raw point) of the next count keys to be handed out."""
+        return [(public_pem, point) for _, public_pem, point in list(self.keys)[:count]]
+
+    def _refill(self):
+        while True:
+            self.refill_needed.wait()
+            self.refill_needed.clear()
+            while len(self.keys) < self.high:
+                self.keys.append(generate_prekey())
+                self.generated += 1
+            self.version += 1
+
+    def stats(self):
+        return {
+            "depth": len(self.keys),
+            "low_watermark": self.low,
+            "high_watermark": self.high,
+            "generated": self.generated,
+            "served": self.served,
+            "misses": self.misses
+        }
+
+prekeys = PrekeyPool()
 
 pre_key_bundle = {
     "long_term_public_key": long_term_public_key.public_bytes(
@@ -49,148 +233,247 @@ pre_key_bundle = {
         encoding=serialization.Encoding.PEM,
         format=serialization.PublicFormat.SubjectPublicKeyInfo
     ).decode(),
-    "signature": signature.hex(),
-    "one_time_keys": [
-        key.public_key().public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        ).decode() for key in one_time_keys
-    ]
+    "signature": signature.hex()
 }
 
+# Binary bundle for clients that skip PEM parsing, all integers big-endian:
+#   magic "PKB1" | long-term key point | signed pre-key point | signature r | s
+#   | one-time key count (u16) | that many one-time key points
+# Points are 65-byte uncompressed P-256 points. The signature is the long-term key's
+# ECDSA-SHA256 over the signed pre-key point itself, r and s 32 bytes each.
+BINARY_BUNDLE_HEADER = struct.Struct(">4s65s65s32s32sH")
+BINARY_BUNDLE_MAGIC = b"PKB1"
+
+signed_pre_key_point = raw_point(signed_pre_key_public)
+point_signature_r, point_signature_s = decode_dss_signature(
+    long_term_private_key.sign(signed_pre_key_point, ec.ECDSA(hashes.SHA256())))
+
+class BundleCache:
+    """/prekey_bundle bodies in JSON and binary with their ETags.
+
+    Both are serialized once per change of the advertised one-time keys (the pool
+    version), not once per request, so a GET is a dict lookup and conditional GETs
+    from clients holding the current ETag end in a 304.
+    """
+
+    def __init__(self, pool, size=PREKEY_BUNDLE_SIZE):
+        self.pool = pool
+        self.size = size
+        self.version = None
+        self.bodies = None
+        self.lock = Lock()
+
+    def get(self, binary):
+        """(body, etag) for the current bundle."""
+        with self.lock:
+            # Version first: a take racing the rebuild then only forces another rebuild
+            version = self.pool.version
+            if version != self.version:
+                self.bodies = self._serialize(self.pool.public_keys(self.size))
+                self.version = version
+            return self.bodies[binary]
+
+    def _serialize(self, one_time_keys):
+        json_body = json.dumps(
+            dict(pre_key_bundle, one_time_keys=[public_pem for public_pem, _ in one_time_keys]),
+            separators=(",", ":")).encode()
+        binary_body = BINARY_BUNDLE_HEADER.pack(
+            BINARY_BUNDLE_MAGIC, raw_point(long_term_public_key), signed_pre_key_point,
+            point_signature_r.to_bytes(32, "big"), point_signature_s.to_bytes(32, "big"),
+            len(one_time_keys)) + b"".join(point for _, point in one_time_keys)
+        return {
+            False: (json_body, sha256(json_body).hexdigest()[:32]),
+            True: (binary_body, sha256(binary_body).hexdigest()[:32])
+        }
+
+bundle_cache = BundleCache(prekeys)
+
+def wants_binary_bundle(format_arg, accept):
+    return format_arg == "binary" or accept.split(",")[0].strip().startswith("application/octet-stream")
+
 @app.route("/", methods = ["GET"])
 def welcome():
     return jsonify("Welcome")
 
 @app.route("/prekey_bundle", methods=["GET"])
 def get_prekey_bundle():
-    return jsonify(pre_key_bundle)
-
-#Global session_key array
-session_key_registry = []
+    # ?format=binary or Accept: application/octet-stream for raw points, PEM JSON otherwise
+    binary = wants_binary_bundle(request.args.get("format"), request.headers.get("Accept", ""))
+    body, etag = bundle_cache.get(binary)
+    response = app.response_class(body, mimetype="application/octet-stream" if binary else "application/json")
+    response.set_etag(etag)
+    # One-time keys get used up, so caches have to revalidate every time
+    response.cache_control.no_cache = True
+    response.vary.add("Accept")
+    return response.make_conditional(request)
+
+@app.route("/prekey_pool", methods=["GET"])
+def get_prekey_pool():
+    return jsonify(prekeys.stats())
+
+# Sessions expire after SESSION_TTL seconds without use, and past MAX_SESSIONS the
+# least recently used one is dropped
+SESSION_TTL = 3600
+MAX_SESSIONS = 10000
+
+def session_id_for(session_key):
+    """Session ID derived from the key, so clients holding only the key still get O(1) lookups."""
+    return sha256(b"session-id" + session_key).hexdigest()[:32]
+
+class Session:
+    __slots__ = ("key", "aesgcm", "expires")
+
+    def __init__(self, key, expires):
+        self.key = key
+        self.aesgcm = AESGCM(key)  # built once per session, not once per request
+        self.expires = expires
+
+class SessionStore:
+    """Session keys by session ID in an OrderedDict kept in least-recently-used order.
+
+    Every lookup renews the TTL and moves the session to the end, so the oldest
+    entries are always at the front: expiry and the size cap both evict from there.
+    """
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.lock = Lock()
+
+    def add(self, session_key):
+        session_id = session_id_for(session_key)
+        with self.lock:
+            now = time.monotonic()
+            self.sessions[session_id] = Session(session_key, now + self.ttl)
+            self.sessions.move_to_end(session_id)
+            self._evict(now)
+        return session_id
+
+    def get(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return None
+            now = time.monotonic()
+            if session.expires <= now:
+                del self.sessions[session_id]
+                return None
+            session.expires = now + self.ttl
+            self.sessions.move_to_end(session_id)
+            return session
+
+    def _evict(self, now):
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if session.expires > now and len(self.sessions) <= self.max_sessions:
+                break
+            del self.sessions[session_id]
+
+    def __len__(self):
+        return len(self.sessions)
+
+sessions = SessionStore()
+
+def lookup_session(session_id=None, session_key_base64=None):
+    """Finds a session by its ID, or by the base64 key for clients that only keep the key."""
+    if not session_id and session_key_base64:
+        session_id = session_id_for(base64.b64decode(session_key_base64))
+    return sessions.get(session_id) if session_id else None
+
+def session_cipher(session_id, session_key):
+    """The AES-GCM cipher for a raw session key: the session's cached one when the ID
+    (or the key) names a session holding that same key, a fresh one otherwise."""
+    session = lookup_session(session_id, base64.b64encode(session_key).decode())
+    if session is not None and session.key == session_key:
+        return session.aesgcm
+    return AESGCM(session_key)
+
+def exchange_keys(client_long_term_key_pem, client_ephemeral_key_pem):
+    """Runs the handshake and registers the session. Returns the key_exchange response."""
+    serialization.load_pem_public_key(client_long_term_key_pem.encode())
+    # Deserialize client ephemeral public key received from the client
+    client_ephemeral_key = serialization.load_pem_public_key(client_ephemeral_key_pem.encode())
+
+    # Select a one-time key (use and remove it)
+    one_time_key, one_time_key_pem, _ = prekeys.take()
+
+    # Compute shared secrets
+    shared_secret_1 = signed_pre_key_private.exchange(ec.ECDH(), client_ephemeral_key)
+    shared_secret_2 = long_term_private_key.exchange(ec.ECDH(), client_ephemeral_key)
+    shared_secret_3 = one_time_key.exchange(ec.ECDH(), client_ephemeral_key)
+
+    # Derive the session key (concatenate secrets and hash)
+    session_key = sha256(shared_secret_1 + shared_secret_2 + shared_secret_3).digest()
+    session_id = sessions.add(session_key)
+
+    return {
+        "session_id": session_id,
+        "session_key": base64.b64encode(session_key).decode(),
+        "one_time_key": one_time_key_pem
+    }
 
 @app.route("/key_exchange", methods=["POST"])
 def key_exchange():
     try:
-        client_long_term_key = serialization.load_pem_public_key(
-            request.json["client_long_term_key"].encode()
-        )
-        # Deserialize client ephemeral public key received from the client
-        client_ephemeral_key = serialization.load_pem_public_key(
-        request.json["client_ephemeral_key"].encode())
-
-        # Serialize the key again for comparison
-        client_ephemeral_key_pem = client_ephemeral_key.public_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PublicFormat.SubjectPublicKeyInfo).decode()
-
-        print("Server - Client Ephemeral Public Key Received (PEM):", client_ephemeral_key_pem)
-
-
-        # Select a one-time key (use and remove it)
-        one_time_key = one_time_keys.pop(0)
-        one_time_public = one_time_key.public_key()
-
-        # Debugging
-        one_time_key_pem = one_time_public.public_bytes(encoding=serialization.Encoding.PEM, format=serialization.PublicFormat.SubjectPublicKeyInfo).decode()
-        print("Server - One-Time Key Public (PEM):", one_time_key_pem)
-
-        # Compute shared secrets
-        
-        shared_secret_1 = signed_pre_key_private.exchange(ec.ECDH(), client_ephemeral_key)
-        print("Server - Shared Secret 1:", shared_secret_1.hex())
-
-        shared_secret_2 = long_term_private_key.exchange(ec.ECDH(), client_ephemeral_key)
-        print("Server - Shared Secret 2:", shared_secret_2.hex())
-
-        shared_secret_3 = one_time_key.exchange(ec.ECDH(), client_ephemeral_key)
-        print("Server - Shared Secret 3:", shared_secret_3.hex())
-
-
-        # Derive the session key (concatenate secrets and hash)
-        from hashlib import sha256
-        session_key = sha256(shared_secret_1 + shared_secret_2 + shared_secret_3).digest()
-        session_key_registry.append(base64.b64encode(session_key).decode())
-        print("Server - Raw Session Key (Bytes):", session_key)
-        print("Server - Session Key (Base64):", base64.b64encode(session_key).decode())
-        
-
-        return jsonify({
-            "session_key": base64.b64encode(session_key).decode(),
-            "one_time_key": one_time_public.public_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PublicFormat.SubjectPublicKeyInfo
-            ).decode()
-        })
+        return jsonify(exchange_keys(request.json["client_long_term_key"],
+                                     request.json["client_ephemeral_key"]))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route("/session_key_registry", methods=["GET"])
 def get_session_key_registry():
-    return jsonify(session_key_registry)
+    # Only the size of the table, keys never leave the server through here
+    return jsonify({
+        "active_sessions": len(sessions),
+        "max_sessions": sessions.max_sessions,
+        "ttl_seconds": sessions.ttl
+    })
 
 @app.route("/encrypt", methods=["POST"])
 def encrypt():
     try:
     
-        # Start performance metrics
-        tracemalloc.start()
-        start_time = time.time()
-
-        # Debugging: Log raw request data
-        print("Raw Request Data:", request.data)  # Logs raw payload
-        print("Request Content-Type:", request.content_type)  # Logs content type
-
         # Parse JSON data from the request
         request_data = request.json
-        print("Parsed Request JSON:", request_data)  # Logs parsed JSON
 
         # Retrieve plaintext and session key
         plaintext = request_data.get("plaintext")
         session_key = request_data.get("session_key")
 
-        # Debugging prints to verify data
-        print("Received Plaintext on Server:", plaintext)
-        print("Received Session Key on Server (Base64):", session_key)
-
         if not plaintext:
             return jsonify({"error": "No plaintext provided"}), 400
         if not session_key:
             return jsonify({"error": "No session key provided"}), 400
 
         # Decode the session key (if it was sent as a base64-encoded string)
-        session_key = base64.b64decode(session_key)
+        session_key_bytes = base64.b64decode(session_key)
 
         # Ensure the session key is exactly 32 bytes long for AES-256
-        if len(session_key) != 32:
-            return jsonify({"error": f"Incorrect AES key length ({len(session_key)} bytes)."}), 400
+        if len(session_key_bytes) != 32:
+            return jsonify({"error": f"Incorrect AES key length ({len(session_key_bytes)} bytes)."}), 400
+
+        # Reuse the session's cipher only if it holds this key, anything else gets a fresh one
+        aesgcm = session_cipher(request_data.get("session_id"), session_key_bytes)
 
         # Generate a random nonce
         nonce = get_random_bytes(12)
-        print("Generated Nonce:", base64.b64encode(nonce).decode())
         
-        # Encrypt using AES-GCM
-        cipher = AES.new(session_key, AES.MODE_GCM, nonce=nonce)
-        ciphertext, tag = cipher.encrypt_and_digest(plaintext.encode())
+        # Encrypt using AES-GCM, the tag comes back appended to the ciphertext
+        sealed = aesgcm.encrypt(nonce, plaintext.encode(), None)
+        ciphertext, tag = sealed[:-16], sealed[-16:]
 
-        # Stop performance metrics
-        end_time = time.time()
-        current_memory, peak_memory = tracemalloc.get_traced_memory()
-        tracemalloc.stop()
-
-        # Log performance metrics
-        print(f"Encryption Time (ms): {round((end_time - start_time) * 1000, 2)}")
-        print(f"Current Memory Usage (KB): {round(current_memory / 1024, 2)}")
-        print(f"Peak Memory Usage (KB): {round(peak_memory / 1024, 2)}")
+        # Performance metrics, memory only when this request is sampled
+        current_memory, peak_memory = memory_kb()
 
         # Return the ciphertext, nonce, tag, and performance metrics (all base64-encoded)
         return jsonify({
             "ciphertext": base64.b64encode(ciphertext).decode(),
             "nonce": base64.b64encode(nonce).decode(),
             "tag": base64.b64encode(tag).decode(),
-            "encryption_time_ms": round((end_time - start_time) * 1000, 2),
-            "current_memory_kb": round(current_memory / 1024, 2),
-            "peak_memory_kb": round(peak_memory / 1024, 2)
+            "encryption_time_ms": elapsed_ms(),
+            "current_memory_kb": current_memory,
+            "peak_memory_kb": peak_memory
         }), 200
     except Exception as e:
         print("Error during encryption:", str(e))
@@ -199,13 +482,6 @@ def encrypt():
 @app.route("/decrypt", methods=["POST"])
 def decrypt():
     try:
-        import time
-        import tracemalloc
-
-        # Start performance metrics
-        tracemalloc.start()
-        start_time = time.time()
-
         # Parse JSON data from the request
         request_data = request.json
         ciphertext = base64.b64decode(request_data.get("ciphertext"))
@@ -213,51 +489,34 @@ def decrypt():
         tag = base64.b64decode(request_data.get("tag"))
         session_key = request_data.get("session_key")
 
-        # Debugging prints to verify received data
-        print("Received Ciphertext (Base64):", request_data.get("ciphertext"))
-        print("Received Nonce (Base64):", request_data.get("nonce"))
-        print("Received Tag (Base64):", request_data.get("tag"))
-        print("Received Session Key (Base64):", session_key)
-
         if not ciphertext or not nonce or not tag or not session_key:
             return jsonify({"error": "Missing required fields"}), 400
 
         # Ensure the session key is exactly 32 bytes long for AES-256
         if len(base64.b64decode(session_key)) != 32:
-            print (base64.b64decode(session_key))
             return jsonify({"error": f"Incorrect AES key length ({len(session_key)} bytes)."}), 400
         
 
-        # Check if the session key exists in the registry
-        if session_key not in session_key_registry:
-            print("Session Key is invalid")
+        # Check if the session exists, a dict lookup by session ID
+        session = lookup_session(request_data.get("session_id"), session_key)
+        if session is None or session.key != base64.b64decode(session_key):
             return jsonify({"error": "Invalid session key provided."}), 400
-        else:
-            print("Session Key is valid, proceeding with decryption")
-
-        # Decode the session key
-        session_key_bytes = base64.b64decode(session_key)
 
-        # Decrypt using AES-GCM
-        cipher = AES.new(session_key_bytes, AES.MODE_GCM, nonce=nonce)
-        plaintext = cipher.decrypt_and_verify(ciphertext, tag)
-
-        # Stop performance metrics
-        end_time = time.time()
-        current_memory, peak_memory = tracemalloc.get_traced_memory()
-        tracemalloc.stop()
+        # Decrypt using the session's AES-GCM cipher
+        try:
+            plaintext = session.aesgcm.decrypt(nonce, ciphertext + tag, None)
+        except InvalidTag:
+            return jsonify({"error": "Decryption failed: MAC check failed"}), 400
 
-        # Log performance metrics
-        print(f"Decryption Time (ms): {round((end_time - start_time) * 1000, 2)}")
-        print(f"Current Memory Usage (KB): {round(current_memory / 1024, 2)}")
-        print(f"Peak Memory Usage (KB): {round(peak_memory / 1024, 2)}")
+        # Performance metrics, memory only when this request is sampled
+        current_memory, peak_memory = memory_kb()
 
         # Return the plaintext along with performance metrics
         return jsonify({
             "plaintext": plaintext.decode(),
-            "decryption_time_ms": round((end_time - start_time) * 1000, 2),
-            "current_memory_kb": round(current_memory / 1024, 2),
-            "peak_memory_kb": round(peak_memory / 1024, 2)
+            "decryption_time_ms": elapsed_ms(),
+            "current_memory_kb": current_memory,
+            "peak_memory_kb": peak_memory
         }), 200
 
     except Exception as e:
@@ -265,33 +524,457 @@ def decrypt():
         print("Error during decryption:", str(e))
         return jsonify({"error": str(e)}), 500
     
+# Batch endpoints: many messages per request under one cipher context.
+# JSON bodies carry {"session_key", optionally "session_id", "items": [...]}. Binary
+# bodies (application/octet-stream, X-Session-Key and optionally X-Session-Id) are a run of
+# records, each a big-endian u32 length followed by that many bytes.
+MAX_BATCH_ITEMS = 10000
+NONCE_SIZE = 12
+RECORD_LENGTH = struct.Struct(">I")
+RESULT_HEADER = struct.Struct(">BI")  # status (0 ok, 1 failed), length
+
+def batch_cipher(session_id, session_key_base64, require_session):
+    """Returns the AESGCM for the batch's session, raises ValueError if there is none.
+    The key is always required, a session ID alone is not a credential."""
+    if not session_key_base64:
+        raise ValueError("No session key provided")
+    try:
+        session_key = base64.b64decode(session_key_base64)
+    except ValueError:
+        raise ValueError("Invalid session key encoding")
+    if len(session_key) != 32:
+        raise ValueError(f"Incorrect AES key length ({len(session_key)} bytes).")
+    session = lookup_session(session_id, session_key_base64)
+    if session is not None and session.key == session_key:
+        return session.aesgcm
+    if require_session:
+        raise ValueError("Invalid session key provided.")
+    return AESGCM(session_key)
+
+def read_records(body):
+    view = memoryview(body)
+    records = []
+    offset = 0
+    while offset < len(view):
+        if offset + RECORD_LENGTH.size > len(view):
+            raise ValueError("Truncated record length")
+        (length,) = RECORD_LENGTH.unpack_from(view, offset)
+        offset += RECORD_LENGTH.size
+        if offset + length > len(view):
+            raise ValueError("Truncated record")
+        records.append(view[offset:offset + length])
+        offset += length
+        if len(records) > MAX_BATCH_ITEMS:
+            raise ValueError(f"More than {MAX_BATCH_ITEMS} items in one batch")
+    return records
+
+def json_batch(request_data):
+    """(session_id, session_key, items) from a JSON batch body."""
+    items = request_data.get("items")
+    if not isinstance(items, list):
+        raise ValueError("items must be a list")
+    if len(items) > MAX_BATCH_ITEMS:
+        raise ValueError(f"More than {MAX_BATCH_ITEMS} items in one batch")
+    return request_data.get("session_id"), request_data.get("session_key"), items
+
+def batch_request():
+    """Parses either body format into (binary, session_id, session_key, items)."""
+    if request.mimetype == "application/octet-stream":
+        return (True, request.headers.get("X-Session-Id"), request.headers.get("X-Session-Key"),
+                read_records(request.get_data()))
+    return (False,) + json_batch(request.get_json(silent=True) or {})
+
+def seal_batch(aesgcm, binary, items):
+    if not binary:
+        for i, plaintext in enumerate(items):
+            if not isinstance(plaintext, str):
+                raise ValueError(f"Item {i} is not a string")
+    # One call to the RNG for every nonce in the batch
+    nonces = get_random_bytes(NONCE_SIZE * len(items))
+    results = []
+    if binary:
+        # Each result is nonce | ciphertext | tag
+        for i, plaintext in enumerate(items):
+            nonce = nonces[i * NONCE_SIZE:(i + 1) * NONCE_SIZE]
+            results.append((0, nonce + aesgcm.encrypt(nonce, plaintext, None)))
+        return results
+
+    for i, plaintext in enumerate(items):
+        nonce = nonces[i * NONCE_SIZE:(i + 1) * NONCE_SIZE]
+        sealed = aesgcm.encrypt(nonce, plaintext.encode(), None)
+        results.append({
+            "ciphertext": base64.b64encode(sealed[:-16]).decode(),
+            "nonce": base64.b64encode(nonce).decode(),
+            "tag": base64.b64encode(sealed[-16:]).decode()
+        })
+    return results
+
+def open_batch(aesgcm, binary, items):
+    results = []
+    if binary:
+        # Each record is nonce | ciphertext | tag, a failed item does not fail the batch
+        for record in items:
+            try:
+                results.append((0, aesgcm.decrypt(record[:NONCE_SIZE], record[NONCE_SIZE:], None)))
+            except (InvalidTag, ValueError):
+                results.append((1, b""))
+        return results
+
+    for item in items:
+        try:
+            ciphertext = base64.b64decode(item["ciphertext"])
+            tag = base64.b64decode(item["tag"])
+            nonce = base64.b64decode(item["nonce"])
+            plaintext = aesgcm.decrypt(nonce, ciphertext + tag, None)
+            results.append({"plaintext": plaintext.decode()})
+        except InvalidTag:
+            results.append({"error": "Decryption failed: MAC check failed"})
+        except (KeyError, TypeError, ValueError) as e:
+            results.append({"error": f"Invalid item: {str(e)}"})
+    return results
+
+def pack_results(results):
+    body = bytearray()
+    for status, data in results:
+        body += RESULT_HEADER.pack(status, len(data))
+        body += data
+    return bytes(body)
+
+def binary_response(results):
+    return app.response_class(pack_results(results), mimetype="application/octet-stream")
+
+@app.route("/encrypt_batch", methods=["POST"])
+def encrypt_batch():
+    try:
+        binary, session_id, session_key, items = batch_request()
+        aesgcm = batch_cipher(session_id, session_key, require_session=False)
+        results = seal_batch(aesgcm, binary, items)
+        if binary:
+            return binary_response(results)
+        return jsonify({
+            "items": results,
+            "encryption_time_ms": elapsed_ms()
+        }), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print("Error during batch encryption:", str(e))
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/decrypt_batch", methods=["POST"])
+def decrypt_batch():
+    try:
+        binary, session_id, session_key, items = batch_request()
+        aesgcm = batch_cipher(session_id, session_key, require_session=True)
+        results = open_batch(aesgcm, binary, items)
+        if binary:
+            return binary_response(results)
+        return jsonify({
+            "items": results,
+            "decryption_time_ms": elapsed_ms()
+        }), 200
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        print("Error during batch decryption:", str(e))
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return app.response_class(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+def render_metrics():
+    """Prometheus text exposition of the request histograms and pool gauges."""
+    with metrics_lock:
+        lines = request_latency.render() + request_memory.render()
+    pool = prekeys.stats()
+    lines += [
+        "# HELP crypto_prekey_pool_depth One-time prekeys ready to hand out.",
+        "# TYPE crypto_prekey_pool_depth gauge",
+        f"crypto_prekey_pool_depth {pool['depth']}",
+        "# HELP crypto_prekey_pool_misses_total Handshakes that found the prekey pool empty.",
+        "# TYPE crypto_prekey_pool_misses_total counter",
+        f"crypto_prekey_pool_misses_total {pool['misses']}",
+        "# HELP crypto_sessions Active sessions in the session store.",
+        "# TYPE crypto_sessions gauge",
+        f"crypto_sessions {len(sessions)}",
+        "# HELP crypto_memory_sample_rate Fraction of requests traced for memory.",
+        "# TYPE crypto_memory_sample_rate gauge",
+        f"crypto_memory_sample_rate {METRICS_MEMORY_SAMPLE_RATE}",
+    ]
+    return "\n".join(lines) + "\n"
+
 # Configure the upload folder and maximum file size
 UPLOAD_FOLDER = "uploads/"
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-# Ensure the upload folder exists
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
 # File retention duration in seconds
 FILE_RETENTION_DURATION = 600  # 10 minutes
 
-def delete_file(filepath):
-    """Deletes a file after the specified retention duration."""
+DIGEST_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+class FileStore:
+    """Content-addressed store for the encrypted and decrypted files.
+
+    Files are written to a temporary name while their digest is computed, then
+    committed under that digest, never under a user-supplied name. Identical
+    content is kept once and a repeat upload only pushes its expiry back. A single
+    reaper thread sleeps until the earliest expiry on a min-heap, so the thread
+    count does not grow with the number of files.
+    """
+
+    def __init__(self, root, retention):
+        self.root = root
+        self.retention = retention
+        self.tmp_dir = os.path.join(root, "tmp")
+        self.objects = {}  # digest -> [expires, download name, metadata]
+        self.heap = []     # (expires, digest), stale entries skipped by the reaper
+        self.condition = Condition()
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        for name in os.listdir(self.tmp_dir):
+            os.remove(os.path.join(self.tmp_dir, name))
+        # Files left from a previous run get a fresh retention period
+        with self.condition:
+            for name in os.listdir(root):
+                if DIGEST_PATTERN.match(name):
+                    self._schedule(name, name, {})
+        Thread(target=self._reap, daemon=True).start()
+
+    def temp_path(self):
+        return os.path.join(self.tmp_dir, get_random_bytes(16).hex())
+
+    def path(self, digest):
+        return os.path.join(self.root, digest)
+
+    def commit(self, temp_path, digest, name, metadata):
+        """Moves temp_path into the store, or drops it if the digest is already
+        stored. Returns the metadata of the stored copy."""
+        with self.condition:
+            entry = self.objects.get(digest)
+            if entry is not None and os.path.exists(self.path(digest)):
+                os.remove(temp_path)
+                metadata = entry[2] or metadata
+            else:
+                os.replace(temp_path, self.path(digest))
+            self._schedule(digest, name, metadata)
+            return metadata
+
+    def get(self, digest):
+        """Returns (path, download name) for a stored digest, or None."""
+        with self.condition:
+            entry = self.objects.get(digest)
+            return (self.path(digest), entry[1]) if entry else None
+
+    def _schedule(self, digest, name, metadata):
+        expires = time.time() + self.retention
+        self.objects[digest] = [expires, name, metadata]
+        heapq.heappush(self.heap, (expires, digest))
+        if self.heap[0][1] == digest:
+            self.condition.notify()
+
+    def _reap(self):
+        with self.condition:
+            while True:
+                now = time.time()
+                while self.heap and self.heap[0][0] <= now:
+                    expires, digest = heapq.heappop(self.heap)
+                    entry = self.objects.get(digest)
+                    # Re-uploaded since this heap entry was pushed: a later one covers it
+                    if entry is None or entry[0] != expires:
+                        continue
+                    del self.objects[digest]
+                    try:
+                        os.remove(self.path(digest))
+                    except OSError as e:
+                        print(f"Error deleting file {digest}: {str(e)}")
+                self.condition.wait(self.heap[0][0] - now if self.heap else None)
+
+file_store = FileStore(UPLOAD_FOLDER, FILE_RETENTION_DURATION)
+
+class HashingReader:
+    """Hashes everything read through it."""
+
+    def __init__(self, stream, hasher):
+        self.stream = stream
+        self.hasher = hasher
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.hasher.update(data)
+        return data
+
+class HashingWriter:
+    """Hashes everything written through it."""
+
+    def __init__(self, file, hasher):
+        self.file = file
+        self.hasher = hasher
+
+    def write(self, data):
+        self.hasher.update(data)
+        return self.file.write(data)
+
+def download_url(digest, name, host_url=None):
+    host_url = host_url or request.host_url
+    return f"{host_url.rstrip('/')}/download/{digest}?name={quote(name)}"
+
+
+# Chunked AES-GCM container, so files stream through fixed-size buffers:
+#   header  = magic "GCMS" | version | segment size (u32) | nonce prefix (7 bytes)
+#   segment = ciphertext (segment size bytes, the last one shorter) | tag (16 bytes)
+# Segment i is sealed under nonce = prefix | i (u32) | last-segment flag, with the
+# header as associated data, so segments cannot be reordered, dropped or cut off.
+CONTAINER_MAGIC = b"GCMS"
+CONTAINER_VERSION = 1
+CONTAINER_HEADER = struct.Struct(">4sBI7s")
+SEGMENT_SIZE = 64 * 1024
+MAX_SEGMENT_SIZE = 16 * 1024 * 1024
+TAG_SIZE = 16
+
+def read_full(stream, size):
+    """Reads exactly size bytes unless the stream ends first."""
+    chunks = []
+    remaining = size
+    while remaining:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(chunks)
+
+def segment_cipher(key, prefix, index, last, header):
+    if index > 0xFFFFFFFF:
+        raise ValueError("File has too many segments for one container")
+    cipher = AES.new(key, AES.MODE_GCM, nonce=prefix + struct.pack(">IB", index, last))
+    cipher.update(header)
+    return cipher
+
+def encrypt_stream(key, src, dst, segment_size=SEGMENT_SIZE):
+    """Encrypts src into a container on dst one segment at a time."""
+    prefix = get_random_bytes(7)
+    header = CONTAINER_HEADER.pack(CONTAINER_MAGIC, CONTAINER_VERSION, segment_size, prefix)
+    dst.write(header)
+    index = 0
+    chunk = read_full(src, segment_size)
+    while True:
+        # Read one segment ahead to know whether this one is the last
+        next_chunk = read_full(src, segment_size) if len(chunk) == segment_size else b""
+        last = not next_chunk
+        ciphertext, tag = segment_cipher(key, prefix, index, last, header).encrypt_and_digest(chunk)
+        dst.write(ciphertext)
+        dst.write(tag)
+        if last:
+            return prefix, tag, index + 1
+        chunk = next_chunk
+        index += 1
+
+def decrypt_stream(key, src, dst, header):
+    """Decrypts a container from src, writing each segment once its tag verifies."""
+    magic, version, segment_size, prefix = CONTAINER_HEADER.unpack(header)
+    if magic != CONTAINER_MAGIC or version != CONTAINER_VERSION:
+        raise ValueError("Not an encrypted file container")
+    if not 0 < segment_size <= MAX_SEGMENT_SIZE:
+        raise ValueError(f"Invalid segment size: {segment_size}")
+    record_size = segment_size + TAG_SIZE
+    index = 0
+    record = read_full(src, record_size)
+    while True:
+        if len(record) < TAG_SIZE:
+            raise ValueError("Encrypted file is truncated")
+        next_record = read_full(src, record_size) if len(record) == record_size else b""
+        last = not next_record
+        cipher = segment_cipher(key, prefix, index, last, header)
+        dst.write(cipher.decrypt_and_verify(record[:-TAG_SIZE], record[-TAG_SIZE:]))
+        if last:
+            return index + 1
+        record = next_record
+        index += 1
+
+def is_container(header):
+    return len(header) == CONTAINER_HEADER.size and header.startswith(CONTAINER_MAGIC)
+
+def store_encrypted(session_key, filename, stream):
+    """Encrypts stream segment by segment straight into the file store.
+    Returns (encrypted file name, digest, container metadata)."""
+    # The store key hashes the plaintext under this session's ID, so the same file
+    # under the same key is kept once
+    encrypted_file_name = f"{filename}.enc"
+    hasher = sha256(b"encrypt:" + session_id_for(session_key).encode())
+    temp_path = file_store.temp_path()
     try:
-        os.remove(filepath)
-        print(f"Deleted file: {filepath}")
-    except Exception as e:
-        print(f"Error deleting file {filepath}: {str(e)}")
-
+        with open(temp_path, "wb") as enc_file:
+            nonce_prefix, final_tag, segments = encrypt_stream(
+                session_key, HashingReader(stream, hasher), enc_file)
+        digest = hasher.hexdigest()
+        container = file_store.commit(temp_path, digest, encrypted_file_name, {
+            "nonce": base64.b64encode(nonce_prefix).decode(),
+            "tag": base64.b64encode(final_tag).decode(),
+            "segments": segments
+        })
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return encrypted_file_name, digest, container
+
+def store_decrypted(session_key, filename, stream, nonce_base64=None, tag_base64=None):
+    """Decrypts a container (or a legacy single-shot file) into the file store, under
+    the digest of the plaintext keyed by this session. Returns (decrypted file name,
+    digest), raises ValueError when the file does not decrypt."""
+    if filename.endswith('.enc'):
+        decrypted_filename = f"decrypted_{filename[:-4]}"
+    else:
+        decrypted_filename = f"decrypted_{filename}"
+    # Keyed like store_encrypted: a bare plaintext hash would let anyone who can guess
+    # the content confirm and download it, and would share it across sessions
+    hasher = sha256(b"decrypt:" + session_id_for(session_key).encode())
+    temp_path = file_store.temp_path()
+
+    header = read_full(stream, CONTAINER_HEADER.size)
+    try:
+        with open(temp_path, "wb") as temp_file:
+            dec_file = HashingWriter(temp_file, hasher)
+            if is_container(header):
+                # Segments are verified and written while the rest is still arriving
+                decrypt_stream(session_key, stream, dec_file, header)
+            else:
+                # Files from before the container format: one nonce and tag for everything
+                if not nonce_base64 or not tag_base64:
+                    raise ValueError("Missing required decryption parameters.")
+                nonce = base64.b64decode(nonce_base64)
+                tag = base64.b64decode(tag_base64)
+                cipher = AES.new(session_key, AES.MODE_GCM, nonce=nonce)
+                dec_file.write(cipher.decrypt_and_verify(header + stream.read(), tag))
+        digest = hasher.hexdigest()
+        file_store.commit(temp_path, digest, decrypted_filename, {})
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return decrypted_filename, digest
+
+def file_upload():
+    """Returns (session key base64, filename, stream) for either a multipart form
+    upload or a raw application/octet-stream body with X-Session-Key and
+    X-Filename (percent-encoded) headers. The raw body is read as it arrives,
+    never buffered."""
+    if request.mimetype == "application/octet-stream":
+        return (request.headers.get("X-Session-Key"),
+                secure_filename(unquote(request.headers.get("X-Filename", ""))) or "upload",
+                request.stream)
+    uploaded_file = request.files.get("file")
+    if not uploaded_file:
+        return request.form.get("session_key"), None, None
+    return (request.form.get("session_key"),
+            secure_filename(uploaded_file.filename) or "upload",
+            uploaded_file.stream)
 
 @app.route("/encrypt_file", methods=["POST"])
 def encrypt_file():
     try:
-        # Start performance metrics
-        tracemalloc.start()
-        start_time = time.time()
+        session_key_base64, filename, stream = file_upload()
 
         # Check if session key is provided
-        session_key_base64 = request.form.get("session_key")
         if not session_key_base64:
             return jsonify({"error": "Session key not provided"}), 400
 
@@ -301,54 +984,28 @@ def encrypt_file():
             return jsonify({"error": f"Invalid session key length: {len(session_key)} bytes"}), 400
 
         # Check if a file is provided
-        uploaded_file = request.files.get("file")
-        if not uploaded_file:
+        if stream is None:
             return jsonify({"error": "No file uploaded"}), 400
 
-        # Read the file content into memory
-        plaintext = uploaded_file.read()
-
-        # Generate a random nonce for AES-GCM
-        nonce = get_random_bytes(12)
+        encrypted_file_name, digest, container = store_encrypted(session_key, filename, stream)
 
-        # Encrypt the file content
-        cipher = AES.new(session_key, AES.MODE_GCM, nonce=nonce)
-        ciphertext, tag = cipher.encrypt_and_digest(plaintext)
+        # Performance metrics, memory only when this request is sampled
+        current_memory, peak_memory = memory_kb()
 
-        # Stop performance metrics
-        end_time = time.time()
-        current_memory, peak_memory = tracemalloc.get_traced_memory()
-        tracemalloc.stop()
-
-        # Log performance metrics
-        print(f"Encryption Time (ms): {round((end_time - start_time) * 1000, 2)}")
-        print(f"Current Memory Usage (KB): {round(current_memory / 1024, 2)}")
-        print(f"Peak Memory Usage (KB): {round(peak_memory / 1024, 2)}")
-
-        # Save the encrypted file
-        encrypted_file_name = f"{uploaded_file.filename}.enc"
-        encrypted_filepath = os.path.join(app.config['UPLOAD_FOLDER'], encrypted_file_name)
-        with open(encrypted_filepath, "wb") as enc_file:
-            enc_file.write(ciphertext)
-
-        # Schedule the encrypted file for deletion after the retention duration
-        Timer(FILE_RETENTION_DURATION, delete_file, args=[encrypted_filepath]).start()
-
-        print(f"Encrypted file saved: {encrypted_filepath}")
-
-        # Generate the download URL
-        server_host = request.host_url.rstrip('/')  # Dynamically determine the server host
-        encrypted_file_url = f"{server_host}/download/{encrypted_file_name}"
-
-        # Return the encryption details to the client
+        # Return the encryption details to the client. The container carries its own
+        # nonces and tags, nonce and tag here are the prefix and the final segment's tag
+        # of the stored copy.
         return jsonify({
             "message": "File encrypted successfully",
-            "encrypted_file_url": encrypted_file_url,
-            "nonce": base64.b64encode(nonce).decode(),
-            "tag": base64.b64encode(tag).decode(),
-            "encryption_time_ms": round((end_time - start_time) * 1000, 2),
-            "current_memory_kb": round(current_memory / 1024, 2),
-            "peak_memory_kb": round(peak_memory / 1024, 2)
+            "encrypted_file_name": encrypted_file_name,
+            "encrypted_file_url": download_url(digest, encrypted_file_name),
+            "nonce": container["nonce"],
+            "tag": container["tag"],
+            "segments": container["segments"],
+            "segment_size": SEGMENT_SIZE,
+            "encryption_time_ms": elapsed_ms(),
+            "current_memory_kb": current_memory,
+            "peak_memory_kb": peak_memory
         }), 200
 
     except Exception as e:
@@ -358,15 +1015,19 @@ def encrypt_file():
 @app.route("/download/<filename>", methods=["GET"])
 def download_file(filename):
     try:
-        # Construct the full file path in the uploads directory
-        file_path = os.path.join("uploads", filename)
-
-        # Check if the file exists
-        if not os.path.exists(file_path):
+        # Files are addressed by their digest, ?name= only sets the download name
+        stored = file_store.get(filename) if DIGEST_PATTERN.match(filename) else None
+        if stored is None:
             return jsonify({"error": "File not found"}), 404
-
-        # Serve the file as a downloadable attachment
-        return send_from_directory("uploads", filename, as_attachment=True)
+        file_path, stored_name = stored
+
+        # Streamed from disk, with Range and If-None-Match/If-Range handled by send_file
+        return send_file(
+            file_path,
+            as_attachment=True,
+            download_name=secure_filename(request.args.get("name", "")) or stored_name,
+            conditional=True,
+            etag=filename)
     except Exception as e:
         print(f"Error during file download: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -374,96 +1035,46 @@ def download_file(filename):
 @app.route("/decrypt_file", methods=["POST"])
 def decrypt_file():
     try:
-        # Start performance metrics
-        tracemalloc.start()
-        start_time = time.time()
-
         # Retrieve and validate inputs
-        session_key_base64 = request.form.get("session_key")
-        nonce_base64 = request.form.get("nonce")
-        tag_base64 = request.form.get("tag")
-        uploaded_file = request.files.get("file")
-
-        # Debug: Print received inputs
-        print("Debug: Received session_key (Base64):", session_key_base64)
-        print("Debug: Received nonce (Base64):", nonce_base64)
-        print("Debug: Received tag (Base64):", tag_base64)
-        print("Debug: Received file:", uploaded_file.filename if uploaded_file else "No file uploaded")
+        session_key_base64, filename, stream = file_upload()
+        if request.mimetype == "application/octet-stream":
+            nonce_base64 = request.headers.get("X-Nonce")
+            tag_base64 = request.headers.get("X-Tag")
+        else:
+            nonce_base64 = request.form.get("nonce")
+            tag_base64 = request.form.get("tag")
 
         # Validate inputs
-        if not session_key_base64 or not nonce_base64 or not tag_base64 or not uploaded_file:
+        if not session_key_base64 or stream is None:
             return jsonify({"error": "Missing required decryption parameters."}), 400
 
-        # Decode session key, nonce, and tag
+        # Decode session key
         try:
             session_key = base64.b64decode(session_key_base64)
-            nonce = base64.b64decode(nonce_base64)
-            tag = base64.b64decode(tag_base64)
-        except Exception as decode_error:
-            print(f"Debug: Base64 decoding error: {str(decode_error)}")
+        except Exception:
             return jsonify({"error": "Failed to decode Base64 values."}), 400
 
         # Validate session key length
         if len(session_key) != 32:  # AES-256 requires a 32-byte key
-            print(f"Debug: Invalid session key length: {len(session_key)} bytes")
             return jsonify({"error": f"Invalid session key length: {len(session_key)} bytes"}), 400
 
-        # Read the uploaded encrypted file
-        try:
-            encrypted_data = uploaded_file.read()
-        except Exception as file_read_error:
-            print(f"Debug: Error reading uploaded file: {str(file_read_error)}")
-            return jsonify({"error": "Failed to read the uploaded file."}), 400
-
-        # Decrypt the file content
         try:
-            cipher = AES.new(session_key, AES.MODE_GCM, nonce=nonce)
-            plaintext = cipher.decrypt_and_verify(encrypted_data, tag)
+            decrypted_filename, digest = store_decrypted(
+                session_key, filename, stream, nonce_base64, tag_base64)
         except ValueError as decryption_error:
-            print(f"Debug: Decryption error: {str(decryption_error)}")
             return jsonify({"error": f"Decryption failed: {str(decryption_error)}"}), 400
-        
-        # Stop performance metrics
-        end_time = time.time()
-        current_memory, peak_memory = tracemalloc.get_traced_memory()
-        tracemalloc.stop()
-
-        # Log performance metrics
-        print(f"Encryption Time (ms): {round((end_time - start_time) * 1000, 2)}")
-        print(f"Current Memory Usage (KB): {round(current_memory / 1024, 2)}")
-        print(f"Peak Memory Usage (KB): {round(peak_memory / 1024, 2)}")
-
-        # Save the decrypted file
-        original_name = uploaded_file.filename
-        if original_name.endswith('.enc'):
-            decrypted_filename = f"decrypted_{original_name[:-4]}"
-        else:
-            decrypted_filename = f"decrypted_{original_name}"
-        
-        decrypted_filepath = os.path.join(app.config['UPLOAD_FOLDER'], decrypted_filename)
-        try:
-            with open(decrypted_filepath, "wb") as dec_file:
-                dec_file.write(plaintext)
-            print(f"Debug: Decrypted file saved at: {decrypted_filepath}")
-        except Exception as file_save_error:
-            print(f"Debug: Error saving decrypted file: {str(file_save_error)}")
-            return jsonify({"error": "Failed to save decrypted file."}), 500
-
-        # Generate a download URL for the decrypted file
-        server_host = request.host_url.rstrip('/')
-        download_url = f"{server_host}/download/{decrypted_filename}"
 
-        # Schedule the decrypted file for deletion after retention period
-        Timer(FILE_RETENTION_DURATION, delete_file, args=[decrypted_filepath]).start()
+        # Performance metrics, memory only when this request is sampled
+        current_memory, peak_memory = memory_kb()
 
         # Return success response with download link
         return jsonify({
             "message": "File decrypted successfully",
             "decrypted_file": decrypted_filename,
-            "download_url": download_url,
-            "encryption_time_ms": round((end_time - start_time) * 1000, 2),
-            "current_memory_kb": round(current_memory / 1024, 2),
-            "peak_memory_kb": round(peak_memory / 1024, 2)
+            "download_url": download_url(digest, decrypted_filename),
+            "encryption_time_ms": elapsed_ms(),
+            "current_memory_kb": current_memory,
+            "peak_memory_kb": peak_memory
         }), 200
 
     except Exception as e:
@@ -0,0 +1,199 @@
+import os
+import struct
+import time
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.exceptions import InvalidSignature, InvalidTag
+
+# Packet format shared by transmitter.py and receiver.py
+#   header = packet type | epoch | sender id | sequence number   (17 bytes)
+#   packet = header | ChaCha20-Poly1305 ciphertext | 16-byte tag
+# The nonce is sender id | sequence number, so it never repeats under a key, and the
+# header is the associated data, so it cannot be changed without failing the tag.
+AUDIO = 0
+EPOCH = 1
+HEADER = struct.Struct("!BI4sQ")
+SEQUENCE = struct.Struct("!Q")
+NONCE_SIZE = 12
+TAG_SIZE = 16
+KEY_SIZE = 32
+
+# Epoch mode: a fresh packet key every EPOCH_SECONDS, announced sealed under the
+# handshake key and RSA-PSS signed once, instead of one signature per packet. The
+# announcement is repeated every EPOCH_REPEAT packets in case one is lost.
+EPOCH_SECONDS = 1.0
+EPOCH_REPEAT = 64
+# Epoch keys kept per sender, so late packets from the previous epoch still open
+EPOCHS_KEPT = 2
+# Sequence numbers tracked behind the highest one seen, for replay detection
+REPLAY_WINDOW = 64
+
+PSS = padding.PSS(mgf=padding.MGF1(hashes.SHA256()), salt_length=padding.PSS.MAX_LENGTH)
+
+class PacketCipher:
+    """One ChaCha20-Poly1305 context for the life of a key.
+
+    Nothing is set up per packet: the nonce is written into a reused buffer from the
+    packet counter, and seal() assembles header | ciphertext | tag in one reused output
+    buffer, encrypting straight into it when the installed cryptography has
+    encrypt_into. Every packet carries its own counter, so packets open independently
+    and in any order.
+    """
+
+    def __init__(self, key, sender=None):
+        self.aead = ChaCha20Poly1305(key)
+        self.sender = sender
+        self.nonce = bytearray(NONCE_SIZE)
+        self.buffer = bytearray(HEADER.size + 1024 + TAG_SIZE)
+        self.view = memoryview(self.buffer)
+        self.seal_into = getattr(self.aead, "encrypt_into", None)
+
+    def _set_nonce(self, sender, seq):
+        self.nonce[:4] = sender
+        SEQUENCE.pack_into(self.nonce, 4, seq)
+
+    def seal(self, kind, epoch, seq, data):
+        """The packet as a memoryview of the output buffer, valid until the next seal()."""
+        end = HEADER.size + len(data) + TAG_SIZE
+        if end > len(self.buffer):
+            self.buffer = bytearray(end)
+            self.view = memoryview(self.buffer)
+        HEADER.pack_into(self.buffer, 0, kind, epoch, self.sender, seq)
+        self._set_nonce(self.sender, seq)
+        header = self.view[:HEADER.size]
+        if self.seal_into is not None:
+            self.seal_into(self.nonce, data, header, self.view[HEADER.size:end])
+        else:
+            self.view[HEADER.size:end] = self.aead.encrypt(self.nonce, data, header)
+        return self.view[:end]
+
+    def open(self, sender, seq, header, sealed):
+        self._set_nonce(sender, seq)
+        return self.aead.decrypt(self.nonce, sealed, header)
+
+class Sealer:
+    def __init__(self, key, mode="aead", private_key=None, metrics=None):
+        if mode not in ("aead", "epoch"):
+            raise ValueError(f"Unknown mode: {mode}")
+        if mode == "epoch" and private_key is None:
+            raise ValueError("Epoch mode needs the RSA private key")
+        self.mode = mode
+        self.private_key = private_key
+        self.metrics = metrics
+        # Random per run, the sequence number starts over every time the transmitter does
+        self.sender = os.urandom(4)
+        self.link = PacketCipher(key, self.sender)
+        self.seq = 0
+        self.epoch = 0
+        self.cipher = self.link
+        self.announcement = None
+        self.epoch_started = 0
+        self.epoch_packets = 0
+
+    def seal(self, data):
+        """Returns the datagrams to send for one chunk of audio: its packet, preceded
+        by the epoch announcement whenever that is due. The audio packet is a view of
+        the cipher's buffer, send it before sealing the next chunk."""
+        datagrams = []
+        if self.mode == "epoch":
+            now = time.monotonic()
+            if self.announcement is None or now - self.epoch_started >= EPOCH_SECONDS:
+                self._next_epoch(now)
+            if self.epoch_packets % EPOCH_REPEAT == 0:
+                datagrams.append(self.announcement)
+            self.epoch_packets += 1
+        datagrams.append(self.cipher.seal(AUDIO, self.epoch, self.seq, data))
+        self.seq += 1
+        return datagrams
+
+    def _next_epoch(self, now):
+        start_time = time.perf_counter()
+        self.epoch += 1
+        epoch_key = ChaCha20Poly1305.generate_key()
+        # Sealed under the link key, which no audio packet uses in this mode, so sharing
+        # the sequence number of the next audio packet keeps the audio sequence contiguous
+        sealed = bytes(self.link.seal(EPOCH, self.epoch, self.seq, epoch_key))
+        self.announcement = sealed + self.private_key.sign(sealed, PSS, hashes.SHA256())
+        self.cipher = PacketCipher(epoch_key, self.sender)
+        self.epoch_started = now
+        self.epoch_packets = 0
+        if self.metrics:
+            self.metrics.record("signing", time.perf_counter() - start_time)
+
+class Opener:
+    def __init__(self, key, public_key=None, require_signature=False, metrics=None):
+        self.link = PacketCipher(key)
+        self.public_key = public_key
+        self.require_signature = require_signature
+        self.metrics = metrics
+        self.epochs = {}   # (sender, epoch) -> cipher, oldest first
+        self.windows = {}  # (sender, epoch) -> [highest seq, bitmask of the ones before it]
+        self.latest_epoch = {}  # sender -> highest epoch accepted
+
+    def open(self, datagram):
+        """Returns (sender, seq, audio) for an authentic audio packet, None for epoch
+        announcements and for anything that fails to authenticate or is a replay."""
+        if len(datagram) < HEADER.size + TAG_SIZE:
+            return None
+        kind, epoch, sender, seq = HEADER.unpack_from(datagram)
+        view = memoryview(datagram)
+        if kind == EPOCH:
+            self._accept_epoch(datagram, epoch, sender, seq)
+            return None
+        if kind != AUDIO:
+            return None
+        if epoch == 0:
+            cipher = None if self.require_signature else self.link
+        else:
+            cipher = self.epochs.get((sender, epoch))
+        if cipher is None:
+            return None
+        try:
+            data = cipher.open(sender, seq, view[:HEADER.size], view[HEADER.size:])
+        except InvalidTag:
+            return None
+        if not self._check_replay(sender, epoch, seq):
+            return None
+        return sender, seq, data
+
+    def _accept_epoch(self, datagram, epoch, sender, seq):
+        if self.public_key is None or epoch <= self.latest_epoch.get(sender, 0):
+            # A repeat of an announcement already accepted, or a replayed older one that
+            # would bring back a pruned epoch with a fresh replay window
+            return
+        start_time = time.perf_counter()
+        sealed_size = HEADER.size + KEY_SIZE + TAG_SIZE
+        sealed, signature = datagram[:sealed_size], datagram[sealed_size:]
+        try:
+            # The tag is checked first, it costs far less than the RSA verification
+            epoch_key = self.link.open(sender, seq, sealed[:HEADER.size], sealed[HEADER.size:])
+            self.public_key.verify(signature, sealed, PSS, hashes.SHA256())
+        except (InvalidTag, InvalidSignature):
+            print("Invalid epoch announcement. Discarded.")
+            return
+        self.epochs[(sender, epoch)] = PacketCipher(epoch_key)
+        self.latest_epoch[sender] = epoch
+        stale = [entry for entry in self.epochs if entry[0] == sender][:-EPOCHS_KEPT]
+        for entry in stale:
+            del self.epochs[entry]
+            self.windows.pop(entry, None)
+        if self.metrics:
+            self.metrics.record("verification", time.perf_counter() - start_time)
+
+    def _check_replay(self, sender, epoch, seq):
+        window = self.windows.get((sender, epoch))
+        if window is None:
+            self.windows[(sender, epoch)] = [seq, 0]
+            return True
+        highest, seen = window
+        if seq > highest:
+            shift = seq - highest
+            window[0] = seq
+            window[1] = ((seen << shift) | (1 << (shift - 1))) & ((1 << REPLAY_WINDOW) - 1)
+            return True
+        behind = highest - seq
+        if behind == 0 or behind > REPLAY_WINDOW or seen & (1 << (behind - 1)):
+            return False
+        window[1] = seen | (1 << (behind - 1))
+        return True
@@ -12,12 +12,19 @@ from sympy import randprime
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
-from datetime import datetime
+from metrics_writer import MetricsWriter
 
 # Constants
 HOST = '0.0.0.0'  # Listen on all available interfaces
 TCP_PORT = 5000  # TCP port for initial connection
-NONCE = b'1234567890123456'  # Nonce for encryption
+# "aead": every packet authenticated by its ChaCha20-Poly1305 tag under the shared key.
+# "epoch": additionally an RSA-PSS signature on one epoch key per second.
+AUDIO_MODE = "aead"
+# Packetization: chunks are grouped into datagrams that fit AUDIO_MTU and carry at
+# most AUDIO_LATENCY_MS of audio. "adpcm" compresses 4:1 before encryption.
+AUDIO_CODEC = "pcm"
+AUDIO_MTU = 1500
+AUDIO_LATENCY_MS = 20
 
 # Global Variables
 current_process = None  # Current subprocess
@@ -38,18 +45,9 @@ def stop_current_process():
         except Exception as e:
             print(f"Error stopping process: {e}")
 
-def ensure_metrics_file():
-    if not os.path.exists("metrics.log"):
-        with open("metrics.log", "w") as f:
-            f.write("Timestamp,Message\n")
-
-def log_metric(message):
-    with open("metrics.log", "a") as f:
-        f.write(f"{datetime.now()}: {message}\n")
-
 def generate_rsa_keys():
     if not os.path.exists("private_key.pem") or not os.path.exists("public_key.pem"):
-        start_time = time.time()
+        start_time = time.perf_counter()
         try:
             private_key = rsa.generate_private_key(
                 public_exponent=65537,
@@ -69,7 +67,7 @@ def generate_rsa_keys():
                     format=serialization.PublicFormat.SubjectPublicKeyInfo
                 ))
             print("RSA key pair generated and saved as private_key.pem and public_key.pem.")
-            log_metric(f"RSA key generation time: {time.time() - start_time:.6f} seconds")
+            metrics.record("rsa_keygen", time.perf_counter() - start_time)
         except Exception as e:
             print(f"Error generating RSA keys: {e}")
     else:
@@ -82,10 +80,14 @@ def start_process(mode):
         args = ["python", f"{mode}.py"]
         if mode == "receiver":
             # Pass arguments to receiver script
-            args.extend([str(UDP_PORT_RX), shared_key.hex(), NONCE.hex(), "public_key.pem"])
+            args.extend([str(UDP_PORT_RX), shared_key.hex(), "public_key.pem"])
+            if AUDIO_MODE == "epoch":
+                # Otherwise packets sealed with the plain shared key would still be played
+                args.append("--require-signature")
         elif mode == "transmitter":
             # Pass arguments to transmitter script
-            args.extend([target_ip, str(UDP_PORT_RX), str(UDP_PORT_TX), shared_key.hex(), NONCE.hex(), "private_key.pem"])
+            args.extend([target_ip, str(UDP_PORT_RX), str(UDP_PORT_TX), shared_key.hex(), "private_key.pem", AUDIO_MODE,
+                         "--codec", AUDIO_CODEC, "--mtu", str(AUDIO_MTU), "--latency-ms", str(AUDIO_LATENCY_MS)])
         current_process = subprocess.Popen(args, preexec_fn=os.setsid if os.name != 'nt' else None)
     except Exception as e:
         print(f"Error starting process: {e}")
@@ -232,5 +234,5 @@ def main():
         stop_current_process()
 
 if __name__ == "__main__":
-    ensure_metrics_file()
+    metrics = MetricsWriter()
     main()
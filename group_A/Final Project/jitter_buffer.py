@@ -0,0 +1,163 @@
+import math
+import time
+from array import array
+from threading import Lock
+
+# Playout delay bounds, the target in between follows the measured jitter
+MIN_DELAY = 0.02
+MAX_DELAY = 0.25
+# Target delay = frame time + JITTER_MULTIPLIER * interarrival jitter
+JITTER_MULTIPLIER = 4
+# Frames over the target before one is dropped to bring the delay back down
+DRAIN_MARGIN = 2
+# Gain applied per consecutive concealed frame, after the first one is repeated as is
+CONCEALMENT_FADE = 0.5
+# Frames kept past the target before the oldest are discarded outright
+MAX_FRAMES = 64
+
+class JitterBuffer:
+    """Reorders packets by sequence number and plays them out at a steady delay.
+
+    The receive thread calls put() as packets arrive, the playout loop calls get()
+    once per frame and gets the next frame in sequence, whether or not it arrived.
+    Interarrival jitter is estimated as in RTP (RFC 3550, gain 1/16), with the media
+    time of packet n taken as n frames, and the buffer depth targets a few times that
+    jitter. A frame that is missing at playout time is concealed: the last good frame
+    is repeated, then faded out over the following ones. When the buffer runs dry it
+    plays silence and refills to the target before resuming.
+
+    A frame here is one packet's audio, which is `frames` chunks when the
+    transmitter aggregates them; the size is taken from the first packet of a stream.
+    """
+
+    def __init__(self, chunk_seconds, chunk_bytes, metrics=None):
+        self.chunk_seconds = chunk_seconds
+        self.chunk_bytes = chunk_bytes
+        self.frame_seconds = chunk_seconds
+        self.silence = bytes(chunk_bytes)
+        self.metrics = metrics
+        self.lock = Lock()
+        self.frames = {}  # seq -> (audio, arrival time)
+        self.stream_id = None
+        self.next_seq = None
+        self.highest_seq = None
+        self.buffering = True
+        self.last_frame = self.silence
+        self.concealed_run = 0
+        self.jitter = 0.0
+        self.last_transit = None
+        self.target_frames = self._frames_for(MIN_DELAY)
+        self.stats = dict.fromkeys(("received", "expected", "lost", "late", "duplicate", "reordered",
+                                    "dropped", "underruns"), 0)
+        self.latency_total = 0.0
+        self.latency_count = 0
+
+    def _frames_for(self, delay):
+        return max(1, math.ceil(delay / self.frame_seconds))
+
+    def put(self, stream_id, seq, audio, frames=1):
+        now = time.monotonic()
+        with self.lock:
+            if stream_id != self.stream_id:
+                # Transmitter restarted, its sequence numbers start over
+                self._reset(stream_id, frames)
+            transit = now - seq * self.frame_seconds
+            if self.last_transit is not None:
+                self.jitter += (abs(transit - self.last_transit) - self.jitter) / 16
+            self.last_transit = transit
+            delay = min(MAX_DELAY, max(MIN_DELAY, self.frame_seconds + JITTER_MULTIPLIER * self.jitter))
+            self.target_frames = self._frames_for(delay)
+
+            if self.next_seq is not None and seq < self.next_seq:
+                self.stats["late"] += 1  # already concealed
+                return
+            if seq in self.frames:
+                self.stats["duplicate"] += 1
+                return
+            if self.highest_seq is None:
+                self.highest_seq = seq - 1
+            if seq < self.highest_seq:
+                self.stats["reordered"] += 1
+            else:
+                self.stats["expected"] += seq - self.highest_seq
+                self.highest_seq = seq
+            self.stats["received"] += 1
+            self.frames[seq] = (audio, now)
+            while len(self.frames) > MAX_FRAMES + self.target_frames:
+                # Playout stalled, keep the newest audio
+                del self.frames[min(self.frames)]
+                self.stats["dropped"] += 1
+
+    def _reset(self, stream_id, frames):
+        self.stream_id = stream_id
+        self.frame_seconds = self.chunk_seconds * frames
+        self.silence = bytes(self.chunk_bytes * frames)
+        self.last_frame = self.silence
+        self.frames.clear()
+        self.next_seq = None
+        self.highest_seq = None
+        self.buffering = True
+        self.last_transit = None
+
+    def get(self):
+        """The next frame to play."""
+        with self.lock:
+            if self.buffering:
+                if len(self.frames) < self.target_frames:
+                    return self.silence
+                self.buffering = False
+                if self.next_seq is None or self.next_seq < min(self.frames):
+                    self.next_seq = min(self.frames)
+            # More buffered than the target needs: skip the oldest frame to cut the delay
+            if len(self.frames) > self.target_frames + DRAIN_MARGIN and self.next_seq in self.frames:
+                del self.frames[self.next_seq]
+                self.next_seq += 1
+                self.stats["dropped"] += 1
+
+            entry = self.frames.pop(self.next_seq, None)
+            self.next_seq += 1
+            if entry is not None:
+                audio, arrival = entry
+                latency = time.monotonic() - arrival
+                self.latency_total += latency
+                self.latency_count += 1
+                if self.metrics:
+                    self.metrics.record("playout", latency)
+                self.last_frame = audio
+                self.concealed_run = 0
+                return audio
+
+            self.stats["lost"] += 1
+            if not self.frames:
+                # Nothing left to play, refill to the target before resuming
+                self.buffering = True
+                self.stats["underruns"] += 1
+            return self._conceal()
+
+    def _conceal(self):
+        self.concealed_run += 1
+        if self.concealed_run == 1:
+            return self.last_frame
+        gain = CONCEALMENT_FADE ** (self.concealed_run - 1)
+        if gain < 0.05:
+            return self.silence
+        samples = array("h", self.last_frame)
+        return array("h", (int(sample * gain) for sample in samples)).tobytes()
+
+    def report(self):
+        """Counters since the last report, with the current jitter and delay."""
+        with self.lock:
+            stats = dict(self.stats)
+            for name in self.stats:
+                self.stats[name] = 0
+            latency = self.latency_total / self.latency_count if self.latency_count else 0.0
+            self.latency_total = 0.0
+            self.latency_count = 0
+            depth = len(self.frames)
+        loss = stats["lost"] / stats["expected"] if stats["expected"] else 0.0
+        # Lost frames are the ones concealed at playout, including those that turned up late
+        return (f"received={stats['received']} lost={stats['lost']} ({loss:.1%}) late={stats['late']} "
+                f"reordered={stats['reordered']} duplicate={stats['duplicate']} "
+                f"dropped={stats['dropped']} underruns={stats['underruns']} "
+                f"jitter={self.jitter * 1000:.1f}ms target={self.target_frames * self.frame_seconds * 1000:.1f}ms "
+                f"depth={depth} playout_latency={latency * 1000:.1f}ms")
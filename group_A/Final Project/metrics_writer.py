@@ -0,0 +1,118 @@
+import atexit
+import os
+import struct
+import sys
+import time
+from collections import deque
+from threading import Event, Lock, Thread
+
+# Samples are numbers, kept in a bounded in-memory ring until a background thread
+# appends them to disk in batches. record() is a clock read and a deque append under
+# a lock that is only ever held for a few operations, so the audio threads never
+# touch the file. When the ring is full the oldest samples are dropped, never waited on.
+#
+# Environment settings, inherited by the transmitter and receiver processes:
+#   METRICS_FORMAT          csv (metrics.csv) or binary (metrics.bin)
+#   METRICS_SAMPLE_RATE     fraction of samples kept, e.g. 0.1 keeps every 10th
+#   METRICS_FLUSH_INTERVAL  seconds between flushes
+METRIC_NAMES = ("encryption", "signing", "sending", "decryption", "verification", "rsa_keygen", "playout")
+METRIC_IDS = {name: i for i, name in enumerate(METRIC_NAMES)}
+
+# Binary format: magic "AMT1", then one record per sample
+#   timestamp (float64, seconds since the epoch) | metric id (u8) | value (float32, seconds)
+BINARY_MAGIC = b"AMT1"
+BINARY_RECORD = struct.Struct("<dBf")
+CSV_HEADER = "timestamp,metric,seconds\n"
+
+RING_CAPACITY = 1 << 16
+
+class MetricsWriter:
+    def __init__(self, path=None, fmt=None, sample_rate=None, interval=None, capacity=RING_CAPACITY):
+        self.fmt = fmt or os.environ.get("METRICS_FORMAT", "csv")
+        if self.fmt not in ("csv", "binary"):
+            raise ValueError(f"Unknown metrics format: {self.fmt}")
+        self.path = path or ("metrics.bin" if self.fmt == "binary" else "metrics.csv")
+        if sample_rate is None:
+            sample_rate = float(os.environ.get("METRICS_SAMPLE_RATE", "1.0"))
+        # Every Nth sample instead of a random draw, cheaper and just as even for a steady stream
+        self.every = max(1, round(1 / sample_rate)) if sample_rate > 0 else 0
+        self.interval = interval or float(os.environ.get("METRICS_FLUSH_INTERVAL", "1.0"))
+        self.ring = deque(maxlen=capacity)
+        # Guards the ring and its counters, record() is called from several threads
+        self.lock = Lock()
+        self.count = 0
+        self.dropped = 0
+        self.file = None
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def record(self, name, seconds):
+        if not self.every:
+            return
+        sample = (time.time(), METRIC_IDS[name], seconds)
+        with self.lock:
+            self.count += 1
+            if self.count % self.every:
+                return
+            if len(self.ring) == self.ring.maxlen:
+                self.dropped += 1
+            self.ring.append(sample)
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error writing metrics: {e}")
+
+    def flush(self):
+        # Swap in an empty ring, the lock covers only the swap and the old ring is written
+        # out after release, so record() never waits behind a copy of the samples
+        with self.lock:
+            batch, self.ring = self.ring, deque(maxlen=self.ring.maxlen)
+        if not batch:
+            return
+        if self.file is None:
+            self.file = open(self.path, "ab")
+            if self.file.tell() == 0:
+                self.file.write(BINARY_MAGIC if self.fmt == "binary" else CSV_HEADER.encode())
+        if self.fmt == "binary":
+            self.file.write(b"".join(BINARY_RECORD.pack(*sample) for sample in batch))
+        else:
+            self.file.write("".join(f"{timestamp:.6f},{METRIC_NAMES[metric]},{seconds:.9f}\n"
+                                    for timestamp, metric, seconds in batch).encode())
+        self.file.flush()
+
+    def close(self):
+        if self.stopped.is_set():
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+        if self.dropped:
+            print(f"Metrics ring overflowed, {self.dropped} samples dropped")
+
+def read_binary(path):
+    """Yields (timestamp, metric name, seconds) from a binary metrics file."""
+    with open(path, "rb") as f:
+        if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError(f"{path} is not a binary metrics file")
+        while True:
+            record = f.read(BINARY_RECORD.size)
+            if len(record) < BINARY_RECORD.size:
+                return
+            timestamp, metric, seconds = BINARY_RECORD.unpack(record)
+            yield timestamp, METRIC_NAMES[metric], seconds
+
+if __name__ == "__main__":
+    # python metrics_writer.py metrics.bin > metrics.csv
+    if len(sys.argv) != 2:
+        print("Usage: python metrics_writer.py <metrics.bin>")
+        sys.exit(1)
+    sys.stdout.write(CSV_HEADER)
+    for timestamp, name, seconds in read_binary(sys.argv[1]):
+        sys.stdout.write(f"{timestamp:.6f},{name},{seconds:.9f}\n")
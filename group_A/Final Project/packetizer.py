@@ -0,0 +1,92 @@
+import math
+import struct
+try:
+    import audioop  # ADPCM codec, removed from the standard library in Python 3.13
+except ImportError:
+    audioop = None
+
+# Payload inside the encrypted part of each audio packet
+#   codec | frame count | [ADPCM: predictor value (i16) | step index (u8)] | audio
+# One frame is one CHUNK of samples. ADPCM packets carry the encoder state they
+# start from, so each packet decodes on its own even when the previous one is lost.
+PCM = 0
+ADPCM = 1
+CODECS = {"pcm": PCM, "adpcm": ADPCM}
+PAYLOAD_HEADER = struct.Struct("!BB")
+ADPCM_STATE = struct.Struct("!hB")
+MAX_FRAMES = 255
+
+IP_UDP_OVERHEAD = 28  # IPv4 + UDP headers
+DEFAULT_MTU = 1500
+DEFAULT_LATENCY = 0.02  # seconds of audio per packet at most
+
+def payload_overhead(codec):
+    return PAYLOAD_HEADER.size + (ADPCM_STATE.size if codec == "adpcm" else 0)
+
+def frame_bytes(codec, chunk, sample_width):
+    # IMA ADPCM stores 4 bits per sample
+    return chunk // 2 if codec == "adpcm" else chunk * sample_width
+
+def frames_per_packet(codec, chunk, rate, sample_width, packet_overhead, mtu=DEFAULT_MTU, latency=DEFAULT_LATENCY):
+    """Most frames that fit both the MTU and the latency target, at least one."""
+    room = mtu - IP_UDP_OVERHEAD - packet_overhead - payload_overhead(codec)
+    by_mtu = room // frame_bytes(codec, chunk, sample_width)
+    by_latency = math.floor(latency * rate / chunk + 1e-9)
+    return max(1, min(by_mtu, by_latency, MAX_FRAMES))
+
+def tradeoff(codec, chunk, rate, sample_width, packet_overhead, max_frames=16):
+    """Rows of (frames, datagram bytes, packets/s, kbit/s on the wire, header share,
+    packetization delay in ms) for 1..max_frames frames per packet."""
+    rows = []
+    for frames in range(1, max_frames + 1):
+        size = packet_overhead + payload_overhead(codec) + frames * frame_bytes(codec, chunk, sample_width)
+        packets_per_second = rate / (chunk * frames)
+        wire = size + IP_UDP_OVERHEAD
+        rows.append((frames, size, packets_per_second, wire * 8 * packets_per_second / 1000,
+                     1 - frames * frame_bytes(codec, chunk, sample_width) / wire,
+                     1000 * chunk * frames / rate))
+    return rows
+
+def format_tradeoff(rows, chosen):
+    lines = ["frames  bytes  packets/s  kbit/s  overhead  delay ms"]
+    for frames, size, packets_per_second, kbps, overhead, delay in rows:
+        mark = "  <-" if frames == chosen else ""
+        lines.append(f"{frames:>6} {size:>6} {packets_per_second:>10.1f} {kbps:>7.1f} "
+                     f"{overhead:>8.1%} {delay:>9.1f}{mark}")
+    return "\n".join(lines)
+
+class Packetizer:
+    def __init__(self, codec="pcm", frames=1, sample_width=2):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown codec: {codec}")
+        if codec == "adpcm" and audioop is None:
+            raise ValueError("ADPCM needs the audioop module (Python 3.12 or older)")
+        self.codec = codec
+        self.frames = frames
+        self.sample_width = sample_width
+        self.state = None
+
+    def pack(self, audio):
+        """Payload for self.frames chunks of PCM audio."""
+        if self.codec == "pcm":
+            return PAYLOAD_HEADER.pack(PCM, self.frames) + audio
+        # The encoder state carries across packets, each packet records where it starts
+        valprev, index = self.state or (0, 0)
+        encoded, self.state = audioop.lin2adpcm(audio, self.sample_width, self.state)
+        return PAYLOAD_HEADER.pack(ADPCM, self.frames) + ADPCM_STATE.pack(valprev, index) + encoded
+
+def unpack(payload, sample_width=2):
+    """(frame count, PCM audio) from a packet payload."""
+    if len(payload) < PAYLOAD_HEADER.size:
+        raise ValueError("Truncated payload")
+    codec, frames = PAYLOAD_HEADER.unpack_from(payload)
+    body = payload[PAYLOAD_HEADER.size:]
+    if codec == PCM:
+        return frames, bytes(body)
+    if codec == ADPCM:
+        if audioop is None:
+            raise ValueError("ADPCM needs the audioop module (Python 3.12 or older)")
+        state = ADPCM_STATE.unpack_from(body)
+        audio, _ = audioop.adpcm2lin(bytes(body[ADPCM_STATE.size:]), sample_width, state)
+        return frames, audio
+    raise ValueError(f"Unknown codec: {codec}")
@@ -1,76 +1,70 @@
 import socket
 import pyaudio
 import sys
+import signal
 import time
-from datetime import datetime
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import padding, rsa
+from threading import Thread
 from cryptography.hazmat.primitives import serialization
-import os
+from metrics_writer import MetricsWriter
+from audio_crypto import Opener
+from jitter_buffer import JitterBuffer
+from packetizer import unpack
 
 FORMAT = pyaudio.paInt16
 CHANNELS = 1
 RATE = 44100
 CHUNK = 256
+STATS_INTERVAL = 5  # seconds between jitter buffer reports
 
-def ensure_metrics_file():
-    if not os.path.exists("metrics.log"):
-        with open("metrics.log", "w") as f:
-            f.write("Timestamp,Message\n")
-
-def log_metric(message):
-    with open("metrics.log", "a") as f:
-        f.write(f"{datetime.now()}: {message}\n")
-
-def decrypt_data(key, nonce, data):
-    start_time = time.time()
+def decrypt_data(opener, datagram):
+    start_time = time.perf_counter()
     try:
-        cipher = Cipher(algorithms.ChaCha20(key, nonce), mode=None, backend=default_backend())
-        decrypted_data = cipher.decryptor().update(data)
-        log_metric(f"Decryption time: {time.time() - start_time:.6f} seconds")
-        return decrypted_data
+        packet = opener.open(datagram)
+        metrics.record("decryption", time.perf_counter() - start_time)
+        return packet
     except Exception as e:
         print(f"Error decrypting data: {e}")
-        return b''
+        return None
 
-def verify_signature(public_key, signature, data):
-    start_time = time.time()
-    try:
-        public_key.verify(
-            signature,
-            data,
-            padding.PSS(
-                mgf=padding.MGF1(hashes.SHA256()),
-                salt_length=padding.PSS.MAX_LENGTH
-            ),
-            hashes.SHA256()
-        )
-        log_metric(f"Signature verification time: {time.time() - start_time:.6f} seconds")
-        return True
-    except Exception as e:
-        print(f"Error verifying signature: {e}")
-        print(f"Signature: {signature.hex()}")
-        print(f"Data: {data.hex()}")
-        return False
+def receive_packets(sock, opener, jitter_buffer):
+    # Network side: packets go into the jitter buffer in whatever order they arrive
+    while True:
+        try:
+            datagram, _ = sock.recvfrom(65536)  # packets carry several chunks
+        except OSError:
+            return  # socket closed on shutdown
+        packet = decrypt_data(opener, datagram)
+        if packet is None:
+            continue
+        sender, seq, payload = packet
+        try:
+            frames, audio = unpack(payload)
+        except ValueError as e:
+            print(f"Error unpacking audio: {e}")
+            continue
+        jitter_buffer.put(sender, seq, audio, frames)
 
-def receive_audio(port, key, nonce, public_key):
+def receive_audio(port, key, public_key, require_signature=False):
     try:
+        # The Poly1305 tag authenticates every packet, the peer's RSA key only signs
+        # epoch keys when the transmitter runs in epoch mode
+        opener = Opener(key, public_key, require_signature, metrics=metrics)
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.bind(('0.0.0.0', port))
         audio = pyaudio.PyAudio()
         stream = audio.open(format=FORMAT, channels=CHANNELS, rate=RATE, output=True, frames_per_buffer=CHUNK)
+        jitter_buffer = JitterBuffer(CHUNK / RATE, CHUNK * CHANNELS * audio.get_sample_size(FORMAT), metrics=metrics)
+        Thread(target=receive_packets, args=(sock, opener, jitter_buffer), daemon=True).start()
         print(f"Receiver started on port {port}, waiting for encrypted audio...")
         try:
+            # Playout side: stream.write blocks at the device rate, so this takes one
+            # packet's worth of audio from the jitter buffer at a time
+            next_report = time.monotonic() + STATS_INTERVAL
             while True:
-                encrypted_data, _ = sock.recvfrom(4096)  # Increase buffer size
-                signature_length = public_key.key_size // 8  # Calculate signature length
-                signature, encrypted_data = encrypted_data[:signature_length], encrypted_data[signature_length:]
-                if verify_signature(public_key, signature, encrypted_data):
-                    stream.write(decrypt_data(key, nonce, encrypted_data))
-                else:
-                    print("Invalid signature. Data discarded.")
+                stream.write(jitter_buffer.get())
+                if time.monotonic() >= next_report:
+                    print(f"Jitter buffer: {jitter_buffer.report()}")
+                    next_report += STATS_INTERVAL
         except KeyboardInterrupt:
             print("Stopping receiver...")
         finally:
@@ -82,12 +76,15 @@ def receive_audio(port, key, nonce, public_key):
         print(f"Error in receive_audio: {e}")
 
 if __name__ == "__main__":
-    ensure_metrics_file()
-    if len(sys.argv) != 5:
-        print("Usage: python receiver.py <port> <key> <nonce> <public_key_path>")
+    # Samples go to a ring flushed in the background, see metrics_writer.py
+    metrics = MetricsWriter()
+    # crypto_proj.py stops this process with SIGTERM, exit normally so the last samples are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if len(sys.argv) not in (4, 5) or sys.argv[4:] not in ([], ["--require-signature"]):
+        print("Usage: python receiver.py <port> <key> <public_key_path> [--require-signature]")
         sys.exit(1)
-    with open(sys.argv[4], "rb") as key_file:
+    with open(sys.argv[3], "rb") as key_file:
         public_key = serialization.load_pem_public_key(key_file.read())
     with open("peer_public_key.pem", "rb") as key_file:
         server_public_key = serialization.load_pem_public_key(key_file.read())
-    receive_audio(int(sys.argv[1]), bytes.fromhex(sys.argv[2]), bytes.fromhex(sys.argv[3]), server_public_key)
+    receive_audio(int(sys.argv[1]), bytes.fromhex(sys.argv[2]), server_public_key, len(sys.argv) == 5)
@@ -1,72 +1,73 @@
+import argparse
 import socket
 import pyaudio
 import sys
+import signal
 import time
-from datetime import datetime
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.asymmetric import padding, rsa
 from cryptography.hazmat.primitives import serialization
-import os
+from metrics_writer import MetricsWriter
+from audio_crypto import Sealer, HEADER, TAG_SIZE
+import packetizer
 
 FORMAT = pyaudio.paInt16
 CHANNELS = 1
 RATE = 44100
 CHUNK = 256
+STATS_INTERVAL = 5  # seconds between send rate reports
 
-def ensure_metrics_file():
-    if not os.path.exists("metrics.log"):
-        with open("metrics.log", "w") as f:
-            f.write("Timestamp,Message\n")
-
-def log_metric(message):
-    with open("metrics.log", "a") as f:
-        f.write(f"{datetime.now()}: {message}\n")
-
-def encrypt_data(key, nonce, data):
-    start_time = time.time()
+def encrypt_data(sealer, data):
+    start_time = time.perf_counter()
     try:
-        cipher = Cipher(algorithms.ChaCha20(key, nonce), mode=None, backend=default_backend())
-        encrypted_data = cipher.encryptor().update(data)
-        log_metric(f"Encryption time: {time.time() - start_time:.6f} seconds")
-        return encrypted_data
+        datagrams = sealer.seal(data)
+        metrics.record("encryption", time.perf_counter() - start_time)
+        return datagrams
     except Exception as e:
         print(f"Error encrypting data: {e}")
-        return b''
+        return []
 
-def sign_data(private_key, data):
-    start_time = time.time()
-    try:
-        signature = private_key.sign(
-            data,
-            padding.PSS(
-                mgf=padding.MGF1(hashes.SHA256()),
-                salt_length=padding.PSS.MAX_LENGTH
-            ),
-            hashes.SHA256()
-        )
-        log_metric(f"Signing time: {time.time() - start_time:.6f} seconds")
-        return signature
-    except Exception as e:
-        print(f"Error signing data: {e}")
-        return b''
+def choose_frames(codec, sample_width, mtu, latency, frames=None):
+    """Chunks per packet, from the MTU and latency target unless given, and prints the
+    bandwidth/latency tradeoff around the choice."""
+    overhead = HEADER.size + TAG_SIZE
+    if frames is None:
+        frames = packetizer.frames_per_packet(codec, CHUNK, RATE, sample_width, overhead, mtu, latency)
+    rows = packetizer.tradeoff(codec, CHUNK, RATE, sample_width, overhead, max_frames=max(8, frames))
+    print(f"Packetization ({codec}, MTU {mtu}, latency target {latency * 1000:.0f} ms):")
+    print(packetizer.format_tradeoff(rows, frames))
+    return frames
 
-def send_audio(target_ip, target_port, local_port, key, nonce, private_key):
+def send_audio(target_ip, target_port, local_port, key, private_key, mode="aead",
+               codec="pcm", mtu=packetizer.DEFAULT_MTU, latency=packetizer.DEFAULT_LATENCY, frames=None):
     try:
+        # Every packet is sealed with ChaCha20-Poly1305 (16-byte tag). In epoch mode the
+        # RSA key signs one epoch key per second instead of every packet.
+        sealer = Sealer(key, mode, private_key, metrics=metrics)
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.bind(('0.0.0.0', local_port))
         audio = pyaudio.PyAudio()
-        stream = audio.open(format=FORMAT, channels=CHANNELS, rate=RATE, input=True, frames_per_buffer=CHUNK)
-        print(f"Transmitter sending encrypted audio to {target_ip}:{target_port} from local port {local_port}...")
+        sample_width = audio.get_sample_size(FORMAT)
+        # Several chunks per datagram: fewer sends, seals and headers per second of audio
+        frames = choose_frames(codec, sample_width * CHANNELS, mtu, latency, frames)
+        packer = packetizer.Packetizer(codec, frames, sample_width)
+        stream = audio.open(format=FORMAT, channels=CHANNELS, rate=RATE, input=True, frames_per_buffer=CHUNK * frames)
+        print(f"Transmitter sending encrypted audio ({mode} mode, {frames} chunks per packet) to {target_ip}:{target_port} from local port {local_port}...")
         try:
+            packets = sent_bytes = 0
+            next_report = time.monotonic() + STATS_INTERVAL
             while True:
-                data = stream.read(CHUNK, exception_on_overflow=False)
-                encrypted_data = encrypt_data(key, nonce, data)
-                signature = sign_data(private_key, encrypted_data)
-                start_time = time.time()
-                sock.sendto(signature + encrypted_data, (target_ip, target_port))
-                log_metric(f"Sending time: {time.time() - start_time:.6f} seconds")
+                data = stream.read(CHUNK * frames, exception_on_overflow=False)
+                datagrams = encrypt_data(sealer, packer.pack(data))
+                start_time = time.perf_counter()
+                for datagram in datagrams:
+                    sock.sendto(datagram, (target_ip, target_port))
+                    sent_bytes += len(datagram) + packetizer.IP_UDP_OVERHEAD
+                metrics.record("sending", time.perf_counter() - start_time)
+                packets += len(datagrams)
+                if time.monotonic() >= next_report:
+                    print(f"Sent {packets / STATS_INTERVAL:.1f} packets/s, {sent_bytes * 8 / STATS_INTERVAL / 1000:.1f} kbit/s "
+                          f"on the wire, {1000 * CHUNK * frames / RATE:.1f} ms of audio per packet")
+                    packets = sent_bytes = 0
+                    next_report += STATS_INTERVAL
         except KeyboardInterrupt:
             print("Stopping transmitter...")
         finally:
@@ -78,12 +79,26 @@ def send_audio(target_ip, target_port, local_port, key, nonce, private_key):
         print(f"Error in send_audio: {e}")
 
 if __name__ == "__main__":
-    ensure_metrics_file()
-    if len(sys.argv) != 7:
-        print("Usage: python transmitter.py <target_ip> <target_port> <local_port> <key> <nonce> <private_key_path>")
-        sys.exit(1)
-    with open(sys.argv[6], "rb") as key_file:
+    # Samples go to a ring flushed in the background, see metrics_writer.py
+    metrics = MetricsWriter()
+    # crypto_proj.py stops this process with SIGTERM, exit normally so the last samples are flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    parser = argparse.ArgumentParser(description="Encrypted audio transmitter")
+    parser.add_argument("target_ip")
+    parser.add_argument("target_port", type=int)
+    parser.add_argument("local_port", type=int)
+    parser.add_argument("key", help="shared key, hex")
+    parser.add_argument("private_key_path")
+    parser.add_argument("mode", nargs="?", choices=("aead", "epoch"), default="aead")
+    parser.add_argument("--codec", choices=sorted(packetizer.CODECS), default="pcm")
+    parser.add_argument("--mtu", type=int, default=packetizer.DEFAULT_MTU)
+    parser.add_argument("--latency-ms", type=float, default=packetizer.DEFAULT_LATENCY * 1000,
+                        help="most audio per packet, in milliseconds")
+    parser.add_argument("--frames", type=int, help="chunks per packet, overrides --mtu and --latency-ms")
+    args = parser.parse_args()
+    with open(args.private_key_path, "rb") as key_file:
         private_key = serialization.load_pem_private_key(key_file.read(), password=None)
     with open("peer_public_key.pem", "rb") as key_file:
         client_public_key = serialization.load_pem_public_key(key_file.read())
-    send_audio(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), bytes.fromhex(sys.argv[4]), bytes.fromhex(sys.argv[5]), private_key)
+    send_audio(args.target_ip, args.target_port, args.local_port, bytes.fromhex(args.key), private_key, args.mode,
+               args.codec, args.mtu, args.latency_ms / 1000, args.frames)